@@ -2,7 +2,7 @@ import logging
 
 from settings import settings
 
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, inspect, text
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
 import urllib.parse
@@ -42,6 +42,39 @@ def execute_query_return_dict(query):
         result = connection.execute(query)
         return [dict(row) for row in result.mappings()]
 
+def stream_query_return_dict(query, chunk_size):
+    # server-side cursor so that only one chunk of rows is held in memory at a time
+    with engine.connect() as connection:
+        result = connection.execution_options(yield_per=chunk_size).execute(query)
+        for partition in result.mappings().partitions():
+            yield [dict(row) for row in partition]
+
+
+def keyset_query_return_dict(table_name: str, key_column: str, batch_size: int, condition: str = None,
+                             params: dict = None, after=None):
+    """
+    Reads a table in key order one page at a time, each page a short query starting after the last key
+    of the previous one, so that neither the rows nor an open cursor are held between batches.
+    :param batch_size: rows per page, or a callable returning the size of the next page
+    :param condition: extra SQL filter on the rows, with its bind parameters in params
+    :param after: key to start after, to continue an earlier read
+    """
+    filters = f"AND ({condition})" if condition else ""
+    while True:
+        page_size = batch_size() if callable(batch_size) else batch_size
+        key_filter = f"WHERE {key_column} > :after_key" if after is not None else "WHERE TRUE"
+        query = text(f"SELECT * FROM {table_name} {key_filter} {filters} ORDER BY {key_column} LIMIT :batch_size")
+        with engine.connect() as connection:
+            rows = connection.execute(query, {**(params or {}), "after_key": after, "batch_size": page_size})
+            batch = [dict(row) for row in rows.mappings()]
+        if not batch:
+            return
+        yield batch
+        if len(batch) < page_size:
+            return
+        after = batch[-1][key_column]
+
+
 def execute_raw_data_query(query):
     with engine.connect() as connection:
         result = connection.execute(query)
@@ -56,3 +89,42 @@ def execute_query(query, values=None):
             result = connection.execute(query)
         connection.commit()
         return result.rowcount
+
+
+def add_missing_columns(metadata):
+    """
+    create_all() only creates missing tables, so columns added to existing models are added here.
+    :param metadata: declarative metadata whose tables are checked
+    """
+    inspector = inspect(engine)
+    with engine.connect() as connection:
+        for table in metadata.sorted_tables:
+            if not inspector.has_table(table.name):
+                continue
+            existing_columns = {column["name"] for column in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name not in existing_columns:
+                    column_type = column.type.compile(dialect=engine.dialect)
+                    connection.execute(text(f"ALTER TABLE {table.name} ADD COLUMN IF NOT EXISTS {column.name} {column_type}"))
+                    log.info(f"+++++++ added column {table.name}.{column.name} +++++++")
+        connection.commit()
+
+
+def add_missing_indexes(metadata):
+    """
+    create_all() does not add indexes to tables that already exist, so indexes added to existing models are created here.
+    :param metadata: declarative metadata whose tables are checked
+    """
+    inspector = inspect(engine)
+    for table in metadata.sorted_tables:
+        if not inspector.has_table(table.name):
+            continue
+        existing_indexes = {index["name"] for index in inspector.get_indexes(table.name)}
+        for index in table.indexes:
+            if index.name not in existing_indexes:
+                try:
+                    index.create(engine)
+                    log.info(f"+++++++ created index {index.name} on {table.name} +++++++")
+                except Exception as e:
+                    # e.g. rows already violating a new unique index, the rest of the schema is still usable
+                    log.error("Error creating index %s ==> %s", index.name, str(e))
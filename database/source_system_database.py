@@ -73,8 +73,14 @@ def get_source_db():
         db_session.close()
 
 
+def stream_source_query(query, chunk_size):
+    with get_source_db() as session:
+        result = session.execute(query, execution_options={"yield_per": chunk_size})
+        columns = list(result.keys())
+        for partition in result.partitions():
+            yield [dict(zip(columns, row)) for row in partition]
 
 
-
-
-
+def source_system_dialect():
+    with get_source_db() as session:
+        return session.get_bind().dialect
@@ -6,7 +6,7 @@ from routes import (access_api, dictionary_mapper_api, data_dictionary_api, data
 from models import models
 from models import usl_models
 from database.user_db import UserBase, user_engine, SessionLocal
-from database.database import engine, SQL_DATABASE_URL
+from database.database import engine, SQL_DATABASE_URL, add_missing_columns, add_missing_indexes
 from routes.access_api import test_db
 
 from utils.user_utils import seed_default_user
@@ -19,6 +19,10 @@ success, error_message = test_db(SQL_DATABASE_URL)
 if success:
     models.Base.metadata.create_all(engine)
     usl_models.Base.metadata.create_all(engine)
+    add_missing_columns(models.Base.metadata)
+    add_missing_columns(usl_models.Base.metadata)
+    add_missing_indexes(models.Base.metadata)
+    add_missing_indexes(usl_models.Base.metadata)
 
 origins = [
     "*",
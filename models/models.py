@@ -1,6 +1,6 @@
 import uuid
 
-from sqlalchemy import Column, Integer, text, String, Boolean, DateTime, ForeignKey
+from sqlalchemy import Column, Integer, BigInteger, text, String, Boolean, DateTime, ForeignKey, UniqueConstraint, Index
 from sqlalchemy.dialects.postgresql import UUID, VARCHAR
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import relationship
@@ -11,6 +11,11 @@ Base = declarative_base()
 metadata = Base.metadata
 
 
+def utc_now() -> datetime:
+    # DateTime columns have no time zone, timestamps are written as naive UTC whatever the server's TZ
+    return datetime.now(timezone.utc).replace(tzinfo=None)
+
+
 class MappedVariables(Base):
     __tablename__ = 'mapped_variables'
 
@@ -21,8 +26,8 @@ class MappedVariables(Base):
     join_by = Column(String, nullable=False)
     base_repository = Column(String, nullable=False)
     base_variable_mapped_to = Column(String, nullable=False)
-    created_at = Column(DateTime, nullable=False, default=datetime.now(timezone.utc))
-    updated_at = Column(DateTime, nullable=False, default=datetime.now(timezone.utc))
+    created_at = Column(DateTime, nullable=False, default=utc_now)
+    updated_at = Column(DateTime, nullable=False, default=utc_now)
     source_system_id = Column(UUID(as_uuid=True))
 
 
@@ -34,11 +39,11 @@ class IndicatorQueries(Base):
     query = Column(String, nullable=False)
     indicator_value = Column(String, nullable=False, default="0")
     indicator_date = Column(DateTime, nullable=False,
-                            default=datetime.now(timezone.utc))
+                            default=utc_now)
     created_at = Column(DateTime, nullable=False,
-                        default=datetime.now(timezone.utc))
+                        default=utc_now)
     updated_at = Column(DateTime, nullable=False,
-                        default=datetime.now(timezone.utc))
+                        default=utc_now)
 
 
 class ExtractsQueries(Base):
@@ -49,8 +54,16 @@ class ExtractsQueries(Base):
     query = Column(String, nullable=False)
     source_system_id = Column(UUID(as_uuid=True), nullable=False)
 
-    created_at = Column(DateTime, nullable=False, default=datetime.now(timezone.utc))
-    updated_at = Column(DateTime, nullable=False, default=datetime.now(timezone.utc))
+    # incremental extraction: full | incremental
+    load_mode = Column(String, default='full')
+    watermark_column = Column(String)  # column returned by the query, e.g. DateLastModified
+    high_water_mark = Column(String)  # largest watermark value loaded so far
+    key_columns = Column(String)  # comma separated terms that identify a row, used to upsert
+    full_refresh_interval_days = Column(Integer)
+    last_full_refresh_at = Column(DateTime)
+
+    created_at = Column(DateTime, nullable=False, default=utc_now)
+    updated_at = Column(DateTime, nullable=False, default=utc_now)
 
 
 class IndicatorHistory(Base):
@@ -59,15 +72,19 @@ class IndicatorHistory(Base):
     id = Column(UUID(as_uuid=True), primary_key=True, default=uuid.uuid1)
     indicator = Column(String, nullable=False)
     indicator_value = Column(String, nullable=False, default="0")
-    indicator_date = Column(DateTime, nullable=False, default=datetime.now(timezone.utc))
+    indicator_date = Column(DateTime, nullable=False, default=utc_now)
 
     usl_repository_name = Column(String, nullable=False)
     source_system_id = Column(UUID(as_uuid=True))
-    created_at = Column(DateTime, nullable=False, default=datetime.now(timezone.utc))
+    created_at = Column(DateTime, nullable=False, default=utc_now)
 
 
 class TransmissionHistory(Base):
     __tablename__ = 'transmission_history'
+    # latest Loaded and Sent per repository for the history endpoint
+    __table_args__ = (
+        Index('ix_transmission_history_repository_action_created', 'usl_repository_name', 'action', 'created_at'),
+    )
 
     id = Column(UUID(as_uuid=True), primary_key=True, default=uuid.uuid1)
     usl_repository_name = Column(String, nullable=False)
@@ -75,10 +92,96 @@ class TransmissionHistory(Base):
     action = Column(String, nullable=False)
     source_system_id = Column(UUID(as_uuid=True))
     source_system_name = Column(String, nullable=False)
-    created_at = Column(DateTime, nullable=False, default=datetime.now(timezone.utc))
-    started_at = Column(DateTime, nullable=False, default=datetime.now(timezone.utc))
+    created_at = Column(DateTime, nullable=False, default=utc_now)
+    started_at = Column(DateTime, nullable=False, default=utc_now)
     ended_at = Column(DateTime)
     manifest_id = Column(UUID(as_uuid=True))
+    transmission_type = Column(String)  # full or delta, for Sent manifests
+    parent_manifest_id = Column(UUID(as_uuid=True))  # manifest a delta transmission is relative to
+
+
+class RepositoryTombstone(Base):
+    __tablename__ = 'repository_tombstones'
+
+    # ids of rows deleted from a base repository by a full load, sent as deletes by delta transmissions
+    usl_repository_name = Column(String, primary_key=True)
+    row_id = Column(UUID(as_uuid=True), primary_key=True)
+    load_id = Column(UUID(as_uuid=True), nullable=False, index=True)
+    deleted_at = Column(DateTime, nullable=False)
+
+
+class RepositoryStats(Base):
+    __tablename__ = 'repository_stats'
+
+    # kept by the loader at the end of every load, so that reading them does not scan the base repository
+    id = Column(UUID(as_uuid=True), primary_key=True, default=uuid.uuid4)
+    usl_repository_name = Column(String, nullable=False, unique=True)
+    row_count = Column(BigInteger, nullable=False, default=0)
+    valid_count = Column(BigInteger)
+    invalid_count = Column(BigInteger)
+    byte_size = Column(BigInteger)
+    dictionary_version = Column(Integer)
+    last_load_id = Column(UUID(as_uuid=True))
+    last_loaded_at = Column(DateTime)
+    statistics = Column(String)  # JSON column statistics and checksum, see utils.manifest_builder
+    updated_at = Column(DateTime)
+
+
+class TransmissionBatch(Base):
+    __tablename__ = 'transmission_batches'
+    __table_args__ = (UniqueConstraint('manifest_id', 'batch_no'),)
+
+    id = Column(UUID(as_uuid=True), primary_key=True, default=uuid.uuid4)
+    manifest_id = Column(UUID(as_uuid=True), nullable=False)
+    usl_repository_name = Column(String, nullable=False)
+    batch_no = Column(Integer, nullable=False)
+    batch_size = Column(Integer, nullable=False)  # rows in the batch, as chosen by the batch sizer
+    kind = Column(String, nullable=False, default='rows')  # rows, or tombstones of deleted rows
+    last_batch = Column(Boolean, default=False)  # the final batch of the manifest
+    status = Column(String, nullable=False, default='pending')  # pending, acknowledged, failed
+    # repository keys the batch was read between, after_key exclusive and last_key inclusive
+    after_key = Column(String)
+    last_key = Column(String)
+    payload_bytes = Column(Integer)
+    latency_ms = Column(Integer)
+    response_code = Column(Integer)
+    error = Column(String)
+    attempts = Column(Integer, nullable=False, default=1)
+    created_at = Column(DateTime, nullable=False, default=utc_now)
+    updated_at = Column(DateTime)
+
+
+class ExtractionJob(Base):
+    __tablename__ = 'extraction_jobs'
+    # at most one queued or running job per repository, two would load into the same shadow table
+    __table_args__ = (
+        Index('ux_extraction_jobs_active_repository', 'usl_repository_name', unique=True,
+              postgresql_where=text("status IN ('queued', 'running')")),
+    )
+
+    id = Column(UUID(as_uuid=True), primary_key=True, default=uuid.uuid4)
+    usl_repository_name = Column(String, nullable=False)
+    run_id = Column(UUID(as_uuid=True), index=True)  # jobs submitted together by load_all
+    source_system_id = Column(UUID(as_uuid=True))
+    status = Column(String, nullable=False, default='queued')  # queued, running, completed, failed, abandoned
+    full_refresh = Column(Boolean, default=False)
+    incremental = Column(Boolean, default=False)
+    rows_loaded = Column(Integer, nullable=False, default=0)
+    batches_committed = Column(Integer, nullable=False, default=0)
+    # changes compared with the previous load of the repository, by row hash
+    rows_inserted = Column(Integer)
+    rows_updated = Column(Integer)
+    rows_unchanged = Column(Integer)
+    rows_deleted = Column(Integer)
+    checkpoint = Column(String)  # JSON list of key range partitions and the last key committed in each
+    summary = Column(String)  # JSON summary of a completed load
+    error = Column(String)
+    transmission_history_id = Column(UUID(as_uuid=True))
+    owner = Column(UUID(as_uuid=True))  # token of the worker that claimed the job, only it writes to the job
+    queued_at = Column(DateTime)
+    started_at = Column(DateTime)
+    updated_at = Column(DateTime, nullable=False, default=utc_now)
+    ended_at = Column(DateTime)
 
 
 class USLDataErrorLogs(Base):
@@ -91,7 +194,7 @@ class USLDataErrorLogs(Base):
     recommended_solution = Column(String, nullable=False)
     source_system_id = Column(UUID(as_uuid=True))
     source_system_name = Column(String, nullable=False)
-    created_at = Column(DateTime, nullable=False, default=datetime.now(timezone.utc))
+    created_at = Column(DateTime, nullable=False, default=utc_now)
     is_latest = Column(Boolean, default=False)
 
 
@@ -103,8 +206,8 @@ class DataDictionaries(Base):
     name = Column(String, nullable=False)
     version_number = Column(Integer, nullable=False, default=0)
     is_published = Column(Boolean, default=False)
-    created_at = Column(DateTime, nullable=False, default=datetime.now(timezone.utc))
-    updated_at = Column(DateTime, nullable=False, default=datetime.now(timezone.utc))
+    created_at = Column(DateTime, nullable=False, default=utc_now)
+    updated_at = Column(DateTime, nullable=False, default=utc_now)
     deleted_at = Column(DateTime)
 
 
@@ -117,11 +220,12 @@ class DataDictionaryTerms(Base):
     term = Column(String, nullable=False)
     data_type = Column(String, nullable=False)
     is_required = Column(Boolean, default=False)
+    is_natural_key = Column(Boolean, default=False)  # part of the key identifying a row across loads
     term_description = Column(String, nullable=True)
     expected_values = Column(String, nullable=True)
     is_active = Column(Boolean, default=True)
-    created_at = Column(DateTime, nullable=False, default=datetime.now(timezone.utc))
-    updated_at = Column(DateTime, nullable=False, default=datetime.now(timezone.utc))
+    created_at = Column(DateTime, nullable=False, default=utc_now)
+    updated_at = Column(DateTime, nullable=False, default=utc_now)
     deleted_at = Column(DateTime)
 
 
@@ -139,8 +243,8 @@ class SiteConfig(Base):
     other_systems = Column(String, nullable=True)
     is_active = Column(Boolean, nullable=False, default=False)
 
-    created_at = Column(DateTime, nullable=False, default=datetime.now(timezone.utc))
-    updated_at = Column(DateTime, nullable=False, default=datetime.now(timezone.utc))
+    created_at = Column(DateTime, nullable=False, default=utc_now)
+    updated_at = Column(DateTime, nullable=False, default=utc_now)
     deleted_at = Column(DateTime)
 
 
@@ -152,10 +256,14 @@ class AccessCredentials(Base):
     name = Column(String, nullable=False)
     system_id = Column(ForeignKey(SiteConfig.id), primary_key=True)
     conn_type = Column(VARCHAR(20), nullable=False, default='mysql')
+    # extraction throttling, empty uses the EXTRACT_* settings
+    max_rows_per_second = Column(Integer)
+    max_concurrent_queries = Column(Integer)
+    target_latency_ms = Column(Integer)
 
     is_active = Column(Boolean, default=True)
-    created_at = Column(DateTime, nullable=False, default=datetime.now(timezone.utc))
-    updated_at = Column(DateTime, nullable=False, default=datetime.now(timezone.utc))
+    created_at = Column(DateTime, nullable=False, default=utc_now)
+    updated_at = Column(DateTime, nullable=False, default=utc_now)
     deleted_at = Column(DateTime)
 
     # relationships
@@ -169,8 +277,8 @@ class SchedulesConfig(Base):
     schedule_name = Column(String, nullable=False)
     cron_expression = Column(String, nullable=False)
     last_run = Column(DateTime)
-    created_at = Column(DateTime, nullable=False, default=datetime.now(timezone.utc))
-    updated_at = Column(DateTime, nullable=False, default=datetime.now(timezone.utc))
+    created_at = Column(DateTime, nullable=False, default=utc_now)
+    updated_at = Column(DateTime, nullable=False, default=utc_now)
     deleted_at = Column(DateTime)
 
 
@@ -184,8 +292,8 @@ class SchedulesLog(Base):
     start_time = Column(DateTime)
     end_time = Column(DateTime)
 
-    created_at = Column(DateTime, nullable=False, default=datetime.now(timezone.utc))
-    updated_at = Column(DateTime, nullable=False, default=datetime.now(timezone.utc))
+    created_at = Column(DateTime, nullable=False, default=utc_now)
+    updated_at = Column(DateTime, nullable=False, default=utc_now)
     deleted_at = Column(DateTime)
 
 
@@ -196,8 +304,8 @@ class UniversalDictionaryConfig(Base):
     universal_dictionary_url = Column(String, nullable=False)
     universal_dictionary_jwt = Column(String, nullable=False)
     universal_dictionary_update_frequency = Column(String, nullable=True)
-    created_at = Column(DateTime, nullable=False, default=datetime.now(timezone.utc))
-    updated_at = Column(DateTime, nullable=False, default=datetime.now(timezone.utc))
+    created_at = Column(DateTime, nullable=False, default=utc_now)
+    updated_at = Column(DateTime, nullable=False, default=utc_now)
     deleted_at = Column(DateTime)
 
 
@@ -211,7 +319,7 @@ class DQAReport(Base):
     total_rows = Column(Integer, nullable=False)
     null_rows = Column(Integer, nullable=False, default=0)
     dictionary_version = Column(Integer, nullable=False)
-    created_at = Column(DateTime, nullable=False, default=datetime.now(timezone.utc))
+    created_at = Column(DateTime, nullable=False, default=utc_now)
 
 
 class Transformations(Base):
@@ -241,5 +349,5 @@ class Transformations(Base):
     previous_value = Column(String, nullable=True)
     new_value = Column(String, nullable=True)
     dictionary_version = Column(Integer, nullable=False)
-    created_at = Column(DateTime, nullable=False, default=datetime.now(timezone.utc))
-    updated_at = Column(DateTime, nullable=False, default=datetime.now(timezone.utc))
+    created_at = Column(DateTime, nullable=False, default=utc_now)
+    updated_at = Column(DateTime, nullable=False, default=utc_now)
@@ -1,11 +1,11 @@
 import uuid
 
-from datetime import datetime, timezone
-
 from sqlalchemy import Column, String, DateTime, Integer, Boolean
 from sqlalchemy.dialects.postgresql import UUID, VARCHAR
 from sqlalchemy.ext.declarative import declarative_base
 
+from models.models import utc_now
+
 Base = declarative_base()
 metadata = Base.metadata
 
@@ -17,12 +17,12 @@ class DataDictionariesUSL(Base):
     name = Column(String, nullable=False)
     version_number = Column(Integer, nullable=False, default=0)  # dictionary version
     is_published = Column(Boolean, default=False)
-    created_at = Column(DateTime, nullable=False, default=datetime.now(timezone.utc))
-    updated_at = Column(DateTime, nullable=False, default=datetime.now(timezone.utc))
+    created_at = Column(DateTime, nullable=False, default=utc_now)
+    updated_at = Column(DateTime, nullable=False, default=utc_now)
     deleted_at = Column(DateTime)
 
     def save(self):
-        self.updated_at = datetime.now(timezone.utc)
+        self.updated_at = utc_now()
         super().save()
 
 
@@ -35,15 +35,16 @@ class DataDictionaryTermsUSL(Base):
     term = Column(String, nullable=False)
     data_type = Column(String, nullable=False)
     is_required = Column(Boolean, default=False)
+    is_natural_key = Column(Boolean, default=False)  # part of the key identifying a row across loads
     term_description = Column(String, nullable=True)
     expected_values = Column(String, nullable=True)
     is_active = Column(Boolean, nullable=False, default=True)
-    created_at = Column(DateTime, nullable=False, default=datetime.now(timezone.utc))
-    updated_at = Column(DateTime, nullable=False, default=datetime.now(timezone.utc))
+    created_at = Column(DateTime, nullable=False, default=utc_now)
+    updated_at = Column(DateTime, nullable=False, default=utc_now)
     deleted_at = Column(DateTime)
 
     def save(self):
-        self.updated_at = datetime.now(timezone.utc)
+        self.updated_at = utc_now()
         super().save()
 
 
@@ -57,10 +58,10 @@ class DictionaryChangeLog(Base):
     old_value = Column(String, nullable=True)  # Store JSON string of old term
     new_value = Column(String, nullable=True)  # Store JSON string of new term
     version_number = Column(Integer, nullable=False)
-    changed_at = Column(DateTime, nullable=False, default=datetime.now(timezone.utc))
+    changed_at = Column(DateTime, nullable=False, default=utc_now)
 
     def save(self):
-        self.changed_at = datetime.now(timezone.utc)
+        self.changed_at = utc_now()
         super().save()
 
 
@@ -70,12 +71,12 @@ class UniversalDictionaryTokens(Base):
     id = Column(UUID(as_uuid=True), primary_key=True, default=uuid.uuid1)
     universal_dictionary_token = Column(String, nullable=False)
     secret = Column(String, nullable=False)
-    created_at = Column(DateTime, nullable=False, default=datetime.now(timezone.utc))
-    updated_at = Column(DateTime, nullable=False, default=datetime.now(timezone.utc))
+    created_at = Column(DateTime, nullable=False, default=utc_now)
+    updated_at = Column(DateTime, nullable=False, default=utc_now)
     deleted_at = Column(DateTime)
 
     def save(self):
-        self.updated_at = datetime.now(timezone.utc)
+        self.updated_at = utc_now()
         super().save()
 
 
@@ -86,10 +87,10 @@ class UniversalDictionaryFacilityPulls(Base):
     facility_mfl_code = Column(String, nullable=False)
     date_last_updated = Column(DateTime)
     dictionary_versions = Column(String, nullable=False)
-    created_at = Column(DateTime, nullable=False, default=datetime.now(timezone.utc))
-    updated_at = Column(DateTime, nullable=False, default=datetime.now(timezone.utc))
+    created_at = Column(DateTime, nullable=False, default=utc_now)
+    updated_at = Column(DateTime, nullable=False, default=utc_now)
     deleted_at = Column(DateTime)
 
     def save(self):
-        self.updated_at = datetime.now(timezone.utc)
+        self.updated_at = utc_now()
         super().save()
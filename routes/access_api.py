@@ -1,3 +1,4 @@
+from typing import Optional
 from urllib.parse import quote_plus
 
 from fastapi import APIRouter, HTTPException, BackgroundTasks, Depends
@@ -11,6 +12,7 @@ from models.models import AccessCredentials, SiteConfig
 from serializers.access_credentials_serializer import access_credential_list_entity, systems_list_entity, system_entity, \
     access_credential_entity
 from utils.data_upload_handler import upload_data
+from utils.source_throttle import get_throttle
 
 router = APIRouter()
 
@@ -70,11 +72,13 @@ class SaveUploadData(BaseModel):
     name: str = Field(..., description="Name of connection")
     data: list = Field(..., description="")
     upload: str = Field(..., description="the upload source", examples=["csv", "api"])
+    load_method: Optional[str] = Field(None, description="how rows are loaded, defaults to LOAD_METHOD",
+                                       examples=["copy", "insert"])
 
 
 @router.post('/upload_data')
 async def upload_data_handler(data: SaveUploadData, background_tasks: BackgroundTasks = BackgroundTasks()):
-    background_tasks.add_task(upload_data, data)
+    background_tasks.add_task(upload_data, data, data.load_method)
     return {'message': 'Upload started'}
 
 
@@ -105,6 +109,35 @@ async def update_connection(data: SaveDBConnection, connection_id: str, db: Sess
     return {"message": "Connection updated successfully", "id": connection_id}
 
 
+class ThrottleConfig(BaseModel):
+    max_rows_per_second: Optional[int] = Field(None, description="rows read per second across all extract queries, "
+                                                                  "empty for no limit")
+    max_concurrent_queries: Optional[int] = Field(None, description="extract queries open at once, empty uses "
+                                                                     "EXTRACT_MAX_CONCURRENT_PER_SOURCE")
+    target_latency_ms: Optional[int] = Field(None, description="batch fetch time above which extraction backs off, "
+                                                                "empty uses EXTRACT_TARGET_LATENCY_MS")
+
+
+@router.get('/throttle/{connection_id}')
+async def get_throttle_config(connection_id: str, db: Session = Depends(get_db)):
+    credential = db.query(AccessCredentials).filter(AccessCredentials.id == connection_id).first()
+    if credential is None:
+        raise HTTPException(status_code=404, detail="Connection not found")
+    return {"data": get_throttle(credential).snapshot()}
+
+
+@router.put('/throttle/{connection_id}')
+async def update_throttle_config(data: ThrottleConfig, connection_id: str, db: Session = Depends(get_db)):
+    credential = db.query(AccessCredentials).filter(AccessCredentials.id == connection_id).first()
+    if credential is None:
+        raise HTTPException(status_code=404, detail="Connection not found")
+    credential.max_rows_per_second = data.max_rows_per_second
+    credential.max_concurrent_queries = data.max_concurrent_queries
+    credential.target_latency_ms = data.target_latency_ms
+    db.commit()
+    return {"data": get_throttle(credential).snapshot()}
+
+
 def test_db(db_url):
     try:
         engine = create_engine(db_url)
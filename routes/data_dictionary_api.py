@@ -10,6 +10,10 @@ from database.database import get_db, engine
 from models.models import DataDictionaries, DataDictionaryTerms, UniversalDictionaryConfig
 from serializers.data_dictionary_serializer import data_dictionary_terms_list_entity, data_dictionary_usl_list_entity, \
     data_dictionary_entity
+from utils.coercion import invalidate_coercion_plans
+from utils.table_cache import invalidate_repository_tables
+from utils.repository_stats import invalidate_repository_stats
+from utils.change_tracking import ROW_HASH_COLUMN, LOAD_ID_COLUMN
 
 router = APIRouter()
 
@@ -111,6 +115,7 @@ def sync_terms(terms, db):
                 new_term = DataDictionaryTerms(dictionary=usl_term['dictionary'], dictionary_id=dictionary_id,
                                                term=usl_term['term'], data_type=usl_term['data_type'],
                                                is_required=usl_term['is_required'],
+                                               is_natural_key=usl_term.get('is_natural_key', False),
                                                term_description=usl_term['term_description'],
                                                expected_values=usl_term['expected_values'],
                                                is_active=usl_term['is_active'])
@@ -119,6 +124,7 @@ def sync_terms(terms, db):
             else:
                 existing_term.data_type = usl_term['data_type']
                 existing_term.is_required = usl_term['is_required']
+                existing_term.is_natural_key = usl_term.get('is_natural_key', False)
                 existing_term.term_description = usl_term['term_description']
                 existing_term.expected_values = usl_term['expected_values']
                 existing_term.is_active = usl_term['is_active']
@@ -190,6 +196,9 @@ def create_tables(db):
         tbl_columns['data_valid'] = Column('data_valid', Boolean, default=False)
         tbl_columns['data_required_check_fail'] = Column('data_required_check_fail', Boolean, default=False)
         tbl_columns['invalid_data_reasons'] = Column('invalid_data_reasons', String, nullable=True)
+        # content hash of the row and the load that last changed it, for change detection
+        tbl_columns[ROW_HASH_COLUMN] = Column(ROW_HASH_COLUMN, String, nullable=True, index=True)
+        tbl_columns[LOAD_ID_COLUMN] = Column(LOAD_ID_COLUMN, UUID(as_uuid=True), nullable=True, index=True)
         columns_list = [column for column in tbl_columns.values()]
         # Create dynamic table class and synchronize with PSQL
         dynamic_table = Table(table_name, metadata, *columns_list)
@@ -197,8 +206,14 @@ def create_tables(db):
 
         if engine.dialect.has_table(table_name=table_name, connection=engine.connect()):
             dynamic_table.drop(engine)
+            invalidate_repository_stats(table_name)
         metadata.create_all(engine)
 
+    # term data types and columns may have changed, so loaders must recompile their coercion plans
+    # and reflect the tables again
+    invalidate_coercion_plans()
+    invalidate_repository_tables()
+
 
 def pull_dict_from_universal(universal_dict_config):
     """
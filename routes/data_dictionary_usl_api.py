@@ -130,6 +130,7 @@ def add_dict_terms(data, data_dictionary, db):
         term = row['column']
         data_type = row['data_type']
         is_required = True if row['is_required'].lower() == 'yes' else False
+        is_natural_key = True if (row.get('is_natural_key') or '').lower() == 'yes' else False
         term_description = row['description'] or None
         expected_values = row['expected_values'] or None
 
@@ -148,6 +149,7 @@ def add_dict_terms(data, data_dictionary, db):
                 new_value={
                     "data_type": data_type,
                     "is_required": is_required,
+                    "is_natural_key": is_natural_key,
                     "expected_values": expected_values,
                     "term_description": term_description
                 },
@@ -157,6 +159,7 @@ def add_dict_terms(data, data_dictionary, db):
             # If the term exists, update it
             existing_term.data_type = data_type
             existing_term.is_required = is_required
+            existing_term.is_natural_key = is_natural_key
             existing_term.term_description = term_description
             existing_term.expected_values = expected_values
             db.commit()
@@ -168,6 +171,7 @@ def add_dict_terms(data, data_dictionary, db):
                 term=term,
                 data_type=data_type,
                 is_required=is_required,
+                is_natural_key=is_natural_key,
                 term_description=term_description,
                 expected_values=expected_values
             )
@@ -187,6 +191,7 @@ def add_dict_terms(data, data_dictionary, db):
 class DataDictionaryTermsUSLUpdate(BaseModel):
     data_type: str = None
     is_required: bool = None
+    is_natural_key: bool = None
     term_description: str = None
     expected_values: str = None
     is_active: bool = None
@@ -207,6 +212,8 @@ def update_data_dictionary_term_usl(term_id: str, data: DataDictionaryTermsUSLUp
         term.data_type = data.data_type
     if data.is_required is not None:
         term.is_required = data.is_required
+    if data.is_natural_key is not None:
+        term.is_natural_key = data.is_natural_key
     if data.term_description is not None:
         term.term_description = data.term_description
     if data.expected_values is not None:
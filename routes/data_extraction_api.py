@@ -1,3 +1,4 @@
+import asyncio
 import uuid
 
 from fastapi import Depends, HTTPException, WebSocket, WebSocketDisconnect
@@ -6,28 +7,48 @@ from sqlalchemy.exc import SQLAlchemyError
 from sqlalchemy.orm import sessionmaker, Session
 import datetime
 from contextlib import contextmanager
-from pydantic import BaseModel
+from pydantic import BaseModel, Field
 import json
 from fastapi import APIRouter
-from typing import List
+from typing import List, Optional
 
 import logging
 
-from database.database import execute_data_query, get_db as get_main_db, execute_query,execute_query_return_dict, engine as postgres_engine
+from database.database import execute_data_query, get_db as get_main_db, execute_query,execute_query_return_dict, engine as postgres_engine, \
+    SessionLocal
 from database.source_system_database import get_source_db, engine as source_db_engine
 
 from models.models import AccessCredentials, MappedVariables, DataDictionaryTerms, DataDictionaries, SiteConfig, \
-    TransmissionHistory, ExtractsQueries
+    TransmissionHistory, ExtractsQueries, ExtractionJob
 from models import models
+from serializers.extraction_job_serializer import extraction_job_entity, extraction_job_list_entity
 from serializers.dictionary_mapper_serializer import mapped_variable_entity, mapped_variable_list_entity
 from serializers.data_dictionary_serializer import data_dictionary_list_entity, data_dictionary_terms_list_entity
 from utils.dqa_check import dqa_check
+from utils.incremental import split_columns, dictionary_key_columns
+from utils.extraction_runner import start_workers, submit_job, submit_run, resume_job, active_job, run_snapshot, \
+    job_snapshot, FINISHED_STATUSES
 
 
 class QueryModel(BaseModel):
     query: str
 
 
+class IncrementalConfigModel(BaseModel):
+    load_mode: str = Field("full", description="full or incremental", examples=["full", "incremental"])
+    watermark_column: Optional[str] = Field(None, description="column returned by the extract query that grows "
+                                                              "with every change", examples=["DateLastModified"])
+    key_columns: Optional[List[str]] = Field(None, description="terms that identify a row in the base repository",
+                                             examples=[["FacilityID", "ClientID", "EncounterID"]])
+    full_refresh_interval_days: Optional[int] = Field(None, description="days between forced full reloads")
+
+
+class LoadAllModel(BaseModel):
+    repositories: Optional[List[str]] = Field(None, description="base repositories to load, defaults to all "
+                                                                "repositories with an extract query")
+    full_refresh: bool = Field(False, description="reload everything even for incremental repositories")
+
+
 log = logging.getLogger()
 log.setLevel('DEBUG')
 handler = logging.StreamHandler()
@@ -36,123 +57,48 @@ log.addHandler(handler)
 
 router = APIRouter()
 
+# how often progress subscribers read the state of a job
+PROGRESS_INTERVAL_SECONDS = 1
+
 
-async def load_data(baselookup: str, websocket: WebSocket, db):
+@router.on_event("startup")
+def start_extraction_workers():
     try:
-        # system config data
-        source_system = db.query(AccessCredentials).filter(
-            AccessCredentials.is_active == True).first()
-        site_config = db.query(SiteConfig).filter(
-            SiteConfig.is_active == True).first()
-
-        existingQuery = db.query(ExtractsQueries).filter(
-            ExtractsQueries.base_repository==baselookup,
-            ExtractsQueries.source_system_id==source_system.id
-        ).first()
-        extract_source_data_query = existingQuery.query
-
-        # ------ started extraction -------
-
-        loadedHistory = TransmissionHistory(usl_repository_name=baselookup, action="Loaded",
-                                            facility=f'{site_config.site_name}-{site_config.site_code}',
-                                            source_system_id=source_system.id,
-                                            source_system_name=site_config.primary_system,
-                                            ended_at=None,
-                                            manifest_id=None)
-        db.add(loadedHistory)
-        db.commit()
-
-        processed_results=[]
-        if source_system.conn_type not in ["csv", "api"]:
-            # extract data from source DB
-            with get_source_db() as session:
-
-                extractresults = session.execute(text(extract_source_data_query))
-                result = extractresults.fetchall()
-                print([row for row in result])
-                columns = extractresults.keys()
-                baseRepoLoaded = [dict(zip(columns,row)) for row in result]
-
-                processed_results=[result for result in baseRepoLoaded]
-        else:
-            # extract data from imported csv/api schema
-            baseRepoLoaded = execute_query_return_dict(text(extract_source_data_query))
-            processed_results = [result for result in baseRepoLoaded]
-            print(processed_results)
-        # ------ --------------- -------
-        # ------ started loading -------
-
-        if len(processed_results) > 0:
-            # clear base repo data in preparation for inserting new data
-            execute_query(text(f"TRUNCATE TABLE {baselookup}"))
-
-            count_inserted = 0
-            batch_size = 300
-            idColumn = baselookup.lower() + "_id"
-
-            for i in range(0, len(processed_results), batch_size):
-                batch = processed_results[i:i + batch_size]
-                dataToBeInserted = []
-
-                for data in batch:
-                    for key, value in data.items():
-
-                        quoted_values = [ None if value is None
-                            else None if value == ''
-                            else int(value) if ((db.query(DataDictionaryTerms).filter(DataDictionaryTerms.dictionary==baselookup, DataDictionaryTerms.term==key).first()).data_type == "INT")
-                            else bool(value) if ((db.query(DataDictionaryTerms).filter(DataDictionaryTerms.dictionary==baselookup, DataDictionaryTerms.term==key).first()).data_type == "BOOLEAN")
-                            else f"{convert_datetime_to_iso(value)}" if "DATETIME" in ((db.query(DataDictionaryTerms).filter(DataDictionaryTerms.dictionary==baselookup, DataDictionaryTerms.term==key).first()).data_type)
-                            else f"{value}" if isinstance(value, str)
-                            else f"{value}" if ((db.query(DataDictionaryTerms).filter(
-                                DataDictionaryTerms.dictionary == baselookup,
-                                DataDictionaryTerms.term == key).first()).data_type == "NVARCHAR")
-                            else str(value)]
-                        data[key] = quoted_values[0]
-                    # dataToBeInserted.append(data)
-
-                    # for db case sensitivity
-                    newRecordObj = {}
-                    newRecordObj[idColumn] = uuid.uuid4()
-                    for key, val in data.items():
-                        newRecordObj[key.lower()] = val
-                    dataToBeInserted.append(newRecordObj)
-
-                    count_inserted += 1
-
-                postgres_metadata = MetaData()
-                postgres_metadata.reflect(bind=postgres_engine)
-                USLDictionaryModel = postgres_metadata.tables.get(baselookup.lower())
-
-                if USLDictionaryModel is None:
-                    print(f"Table {baselookup} does not exist in the database.")
-                    return
-
-                # new_records = [USLDictionaryModel(**data) for key, value in dataToBeInserted]
-                insert_stmt = USLDictionaryModel.insert().values(dataToBeInserted)
-                db.execute(insert_stmt)
-                # db.add_all(new_records)
-                db.commit()
-
-                await websocket.send_text(f"{count_inserted}")
-                log.info("+++++++ data batch +++++++")
-                log.info(f"+++++++ step i : count_inserted +++++++ {count_inserted} records")
-
-            log.info("+++++++ USL Base Repository Data saved +++++++")
-
-        # end batch
-        baseRepoLoaded_json_data = json.dumps(processed_results, default=str)
-
-        # Send the JSON string over the WebSocket
+        start_workers()
+    except Exception as e:
+        log.error("Extraction workers not started ==> %s", str(e))
+
+
+async def send_job_progress(job_id, websocket: WebSocket):
+    """
+    Forwards the progress of an extraction job to a websocket until the job finishes.
+    The load runs on the extraction workers, closing the websocket does not stop it.
+    """
+    rows_loaded = None
+    while True:
+        job = await asyncio.to_thread(job_snapshot, job_id)
+        if job["rows_loaded"] != rows_loaded:
+            rows_loaded = job["rows_loaded"]
+            await websocket.send_text(f"{rows_loaded}")
+        if job["status"] in FINISHED_STATUSES:
+            return job
+        await asyncio.sleep(PROGRESS_INTERVAL_SECONDS)
+
+
+async def load_data(baselookup: str, websocket: WebSocket, db, full_refresh: bool = False):
+    try:
+        # a load already queued or running for the repository is followed instead of starting another
+        job, _ = submit_job(baselookup, db, full_refresh)
+        job = await send_job_progress(job.id, websocket)
+        if job["status"] != "completed":
+            raise Exception(job["error"] or f"Extraction job {job['status']}")
+
+        # rows are streamed straight into the base repository, so only the summary goes back over the WebSocket
+        baseRepoLoaded_json_data = json.dumps({"status_code": 200, **job["summary"]}, default=str)
+
         await websocket.send_text(baseRepoLoaded_json_data)
         await websocket.close()
-        # ended loading
-        # TODO - update history
-        # loadedHistory.ended_at=datetime.utcnow()
-        # loadedHistory.save()
-        # TransmissionHistory.objects(id=loadedHistory.id).update(ended_at=datetime.utcnow())
-        dqa_check(baselookup, db)
-
-        return {"data": baseRepoLoaded}
+        return job
     except Exception as e:
         error = json.dumps({"status_code":500, "message":e}, default=str)
 
@@ -165,7 +111,7 @@ async def load_data(baselookup: str, websocket: WebSocket, db):
 
 @router.websocket("/ws/load/progress/{baselookup}")
 async def progress_websocket_endpoint(
-        baselookup: str, websocket: WebSocket, db: Session = Depends(get_main_db)
+        baselookup: str, websocket: WebSocket, full_refresh: bool = False, db: Session = Depends(get_main_db)
 ):
     await websocket.accept()
     print("websocket manifest -->", baselookup)
@@ -176,7 +122,7 @@ async def progress_websocket_endpoint(
             data = await websocket.receive_text()
             baseRepo = data
             print("websocket manifest -->", baseRepo)
-            await load_data(baselookup, websocket, db)
+            await load_data(baselookup, websocket, db, full_refresh)
     except WebSocketDisconnect:
         log.error("Client disconnected")
         await websocket.close()
@@ -185,28 +131,184 @@ async def progress_websocket_endpoint(
         await websocket.close()
 
 
-def convert_datetime_to_iso(value):
-    # if isinstance(value, datetime.date):
-    #     return value.strftime('%Y-%m-%d')
-    # else:
+def incremental_config_entity(extract_query, db) -> dict:
+    return {
+        "base_repository": extract_query.base_repository,
+        "load_mode": extract_query.load_mode or "full",
+        "watermark_column": extract_query.watermark_column,
+        "high_water_mark": extract_query.high_water_mark,
+        "key_columns": split_columns(extract_query.key_columns),
+        "dictionary_key_columns": dictionary_key_columns(extract_query.base_repository, db),
+        "full_refresh_interval_days": extract_query.full_refresh_interval_days,
+        "last_full_refresh_at": extract_query.last_full_refresh_at
+    }
+
+
+def get_extract_query(baselookup: str, db):
+    source_system = db.query(AccessCredentials).filter(AccessCredentials.is_active == True).first()
+    extract_query = db.query(ExtractsQueries).filter(
+        ExtractsQueries.base_repository == baselookup,
+        ExtractsQueries.source_system_id == source_system.id
+    ).first()
+    if extract_query is None:
+        raise HTTPException(status_code=404, detail=f"No extract query configured for {baselookup}")
+    return extract_query
+
+
+@router.get('/incremental/{baselookup}')
+async def incremental_config(baselookup: str, db: Session = Depends(get_main_db)):
+    return {"data": incremental_config_entity(get_extract_query(baselookup, db), db)}
+
+
+@router.put('/incremental/{baselookup}')
+async def update_incremental_config(baselookup: str, config: IncrementalConfigModel,
+                                    db: Session = Depends(get_main_db)):
+    if config.load_mode not in ["full", "incremental"]:
+        raise HTTPException(status_code=400, detail="load_mode must be full or incremental")
+    if config.load_mode == "incremental" and (
+            not config.watermark_column or not (config.key_columns or dictionary_key_columns(baselookup, db))):
+        raise HTTPException(status_code=400, detail="Incremental loads need a watermark column and key columns, "
+                                                    "or natural key terms in the data dictionary")
+
+    extract_query = get_extract_query(baselookup, db)
+    key_columns = ",".join(config.key_columns) if config.key_columns else None
+    if extract_query.watermark_column != config.watermark_column or extract_query.key_columns != key_columns:
+        # the saved high water mark and row ids no longer apply, the next run reloads everything
+        extract_query.high_water_mark = None
+    extract_query.load_mode = config.load_mode
+    extract_query.watermark_column = config.watermark_column
+    extract_query.key_columns = key_columns
+    extract_query.full_refresh_interval_days = config.full_refresh_interval_days
+    db.commit()
+    return {"data": incremental_config_entity(extract_query, db)}
+
+
+@router.post('/load_all')
+async def load_all(data: LoadAllModel, db: Session = Depends(get_main_db)):
+    repositories = data.repositories
+    if not repositories:
+        source_system = db.query(AccessCredentials).filter(AccessCredentials.is_active == True).first()
+        extract_queries = db.query(ExtractsQueries).filter(ExtractsQueries.source_system_id == source_system.id).all()
+        repositories = [extract_query.base_repository for extract_query in extract_queries]
+
+    run_id, skipped = submit_run(repositories, db, data.full_refresh)
+    return {"data": run_snapshot(run_id, db), "skipped": skipped}
+
+
+def find_run_snapshot(run_id: str, db):
+    try:
+        return run_snapshot(uuid.UUID(run_id), db)
+    except ValueError:
+        return None
+
+
+@router.get('/load_all/{run_id}')
+async def load_all_progress(run_id: str, db: Session = Depends(get_main_db)):
+    snapshot = find_run_snapshot(run_id, db)
+    if snapshot is None:
+        raise HTTPException(status_code=404, detail="Extraction run not found")
+    return {"data": snapshot}
+
+
+def get_run_snapshot(run_id: str):
+    db = SessionLocal()
+    try:
+        return find_run_snapshot(run_id, db)
+    finally:
+        db.close()
+
+
+@router.websocket("/ws/load_all/progress/{run_id}")
+async def load_all_progress_websocket(run_id: str, websocket: WebSocket):
+    await websocket.accept()
+    try:
+        snapshot = await asyncio.to_thread(get_run_snapshot, run_id)
+        if snapshot is None:
+            await websocket.send_text(json.dumps({"status_code": 404, "message": "Extraction run not found"}))
+            await websocket.close()
+            return
+
+        # combined progress of every repository in the run, until all of them are done
+        while True:
+            await websocket.send_text(json.dumps(snapshot, default=str))
+            if snapshot["status"] != "running":
+                break
+            await asyncio.sleep(PROGRESS_INTERVAL_SECONDS)
+            snapshot = await asyncio.to_thread(get_run_snapshot, run_id)
+        await websocket.close()
+    except WebSocketDisconnect:
+        log.error("Client disconnected")
+
+
+class SubmitJobModel(BaseModel):
+    baselookup: str = Field(..., description="base repository to load")
+    full_refresh: bool = Field(False, description="reload everything even for an incremental repository")
+
 
-    if isinstance(value, datetime.datetime):
-        return value.date()
-    elif isinstance(value, datetime.date):
-        return value
-    else:
-        date_formats = ['%d-%m-%Y', '%d/%m/%Y', '%Y-%m-%d']
-        for date_format in date_formats:
-            try:
-                date_object = datetime.datetime.strptime(value, date_format).date()
-                return date_object
-            except (ValueError, TypeError):
-                continue
+@router.post('/jobs')
+async def submit_extraction_job(data: SubmitJobModel, db: Session = Depends(get_main_db)):
+    get_extract_query(data.baselookup, db)
+    job, queued = submit_job(data.baselookup, db, data.full_refresh)
+    if not queued:
+        raise HTTPException(status_code=409, detail=f"{data.baselookup} is already being loaded by job {job.id}")
+    return {"data": extraction_job_entity(job)}
 
 
+@router.get('/jobs')
+async def extraction_jobs(baselookup: Optional[str] = None, limit: int = 50, db: Session = Depends(get_main_db)):
+    query = db.query(ExtractionJob)
+    if baselookup:
+        query = query.filter(ExtractionJob.usl_repository_name == baselookup)
+    jobs = query.order_by(ExtractionJob.queued_at.desc()).limit(limit).all()
+    return {"data": extraction_job_list_entity(jobs)}
 
 
+def get_extraction_job(job_id: str, db):
+    try:
+        job = db.query(ExtractionJob).filter(ExtractionJob.id == uuid.UUID(job_id)).first()
+    except ValueError:
+        job = None
+    if job is None:
+        raise HTTPException(status_code=404, detail="Extraction job not found")
+    return job
+
 
+@router.get('/jobs/{job_id}')
+async def extraction_job(job_id: str, db: Session = Depends(get_main_db)):
+    return {"data": extraction_job_entity(get_extraction_job(job_id, db))}
 
 
+@router.post('/jobs/{job_id}/resume')
+async def resume_extraction_job(job_id: str, db: Session = Depends(get_main_db)):
+    job = get_extraction_job(job_id, db)
+    if job.status != "failed":
+        raise HTTPException(status_code=409, detail=f"Only failed jobs can be resumed, this job is {job.status}")
+    if active_job(job.usl_repository_name, db) is not None:
+        raise HTTPException(status_code=409, detail=f"{job.usl_repository_name} is already being loaded")
 
+    # continues from the last committed checkpoint
+    if not resume_job(job, db):
+        raise HTTPException(status_code=409, detail=f"{job.usl_repository_name} is already being loaded")
+    return {"data": extraction_job_entity(job)}
+
+
+@router.websocket("/ws/jobs/{job_id}")
+async def extraction_job_websocket(job_id: str, websocket: WebSocket):
+    await websocket.accept()
+    try:
+        job = await asyncio.to_thread(job_snapshot, job_id)
+        if job is None:
+            await websocket.send_text(json.dumps({"status_code": 404, "message": "Extraction job not found"}))
+            await websocket.close()
+            return
+
+        # subscribes to the job only, the load carries on if the client goes away
+        while True:
+            await websocket.send_text(json.dumps(job, default=str))
+            if job["status"] in FINISHED_STATUSES:
+                break
+            await asyncio.sleep(PROGRESS_INTERVAL_SECONDS)
+            job = await asyncio.to_thread(job_snapshot, job_id)
+        await websocket.close()
+    except WebSocketDisconnect:
+        log.error("Client disconnected")
@@ -2,21 +2,37 @@ from fastapi import Depends, HTTPException, BackgroundTasks, WebSocket, WebSocke
 from sqlalchemy import text
 from sqlalchemy.orm import Session
 
-from sqlalchemy import desc
-
-from database.database import get_db, execute_data_query
+from sqlalchemy import desc, func, select
+from sqlalchemy.orm import aliased
+
+from database.database import get_db, execute_data_query, keyset_query_return_dict
+from utils.batch_sizer import BatchSizer
+from utils.transmitter import BatchTransmitter, TransmissionError
+from utils.outbox import get_outbox, drain_outbox_forever, drop_batches, OutboxFull
+from utils.transmission_ledger import record_batch, acknowledge_batch, fail_batch, unacknowledged_batches, \
+    ledger_summary, complete_manifest, ROWS, TOMBSTONES
+from serializers.transmission_batch_serializer import transmission_batch_list_entity
+from utils.manifest_builder import manifest_statistics
+from utils.table_cache import get_repository_table
+from utils.repository_stats import get_repository_stats, list_repository_stats
+from utils.delta import last_acknowledged_manifest, supports_delta, delta_params, tombstone_count, \
+    changed_rows_condition, tombstones_condition, loaded_since
+from utils.change_tracking import TOMBSTONE_TABLE
+from utils.payload_formats import encode_batch, validate_encoding, available_encodings
 from models.models import AccessCredentials
+import asyncio
 import json
+import math
 import uuid
 import datetime
 from fastapi import APIRouter
 from uuid import UUID
-import requests
+from typing import Optional
 import logging
 import settings
 from database import database
 from settings import settings
-from models.models import SiteConfig, TransmissionHistory, DataDictionaries
+from models.models import SiteConfig, TransmissionHistory, DataDictionaries, TransmissionBatch, utc_now
 
 log = logging.getLogger()
 log.setLevel('DEBUG')
@@ -44,56 +60,122 @@ async def extracted_data(baselookup: str):
 
 
 @router.get('/transmission/history')
-async def history(db: Session = Depends(get_db)):
+async def history(page: Optional[int] = None, page_size: Optional[int] = None,
+                  start_date: Optional[datetime.datetime] = None, end_date: Optional[datetime.datetime] = None,
+                  db: Session = Depends(get_db)):
     try:
-        dictionaries = db.query(DataDictionaries).all()
-
-        history = []
-        for dictionary in dictionaries:
-            lastLoaded = db.query(TransmissionHistory).filter(
-                    TransmissionHistory.usl_repository_name == dictionary.name, TransmissionHistory.action == 'Loaded')\
-                .order_by(desc(TransmissionHistory.facility), desc(TransmissionHistory.created_at)).limit(10).first()
-            lastSent = db.query(TransmissionHistory).filter(
-                    TransmissionHistory.usl_repository_name == dictionary.name, TransmissionHistory.action == 'Sent')\
-                .order_by(desc(TransmissionHistory.facility), desc(TransmissionHistory.created_at)).limit(10).first()
-
-            if lastSent:
-                history.append(lastSent)
-            if lastLoaded:
-                history.append(lastLoaded)
-
-        return {"data": history}
+        # the latest Loaded and Sent of every repository in one query, read off the repository/action/created_at index
+        filters = [TransmissionHistory.action.in_(['Loaded', 'Sent']),
+                   TransmissionHistory.usl_repository_name.in_(select(DataDictionaries.name))]
+        if start_date:
+            filters.append(TransmissionHistory.created_at >= start_date)
+        if end_date:
+            filters.append(TransmissionHistory.created_at <= end_date)
+        ranked = select(TransmissionHistory, func.row_number().over(
+            partition_by=(TransmissionHistory.usl_repository_name, TransmissionHistory.action),
+            order_by=desc(TransmissionHistory.created_at)
+        ).label("position")).where(*filters).subquery()
+        latest = aliased(TransmissionHistory, ranked)
+
+        query = db.query(latest, func.count().over().label("total")).filter(ranked.c.position == 1)\
+            .order_by(latest.usl_repository_name, desc(latest.action))
+        if page_size:
+            query = query.offset((max(page or 1, 1) - 1) * page_size).limit(page_size)
+        rows = query.all()
+
+        history = [row[0] for row in rows]
+        total = rows[0].total if rows else 0
+        return {"data": history, "total": total, "page": page, "page_size": page_size}
     except Exception as e:
         log.error("Error fetching history data ==> %s", str(e))
         raise HTTPException(status_code=500, detail="An internal error has occurred.")
 
 
+@router.on_event("startup")
+async def start_outbox_drainer():
+    try:
+        asyncio.create_task(drain_outbox_forever())
+    except Exception as e:
+        log.error("Outbox drainer not started ==> %s", str(e))
+
+
+@router.get('/transmission/outbox')
+async def outbox_status():
+    try:
+        return get_outbox().snapshot()
+    except Exception as e:
+        log.error("Error fetching outbox status ==> %s", str(e))
+        raise HTTPException(status_code=500, detail="An internal error has occurred.")
+
+
+@router.get('/repository_stats')
+async def repository_stats(db: Session = Depends(get_db)):
+    try:
+        return {"data": list_repository_stats(db)}
+    except Exception as e:
+        log.error("Error fetching repository statistics ==> %s", str(e))
+        raise HTTPException(status_code=500, detail="An internal error has occurred.")
+
+
+@router.get('/repository_stats/{baselookup}')
+async def repository_stats_detail(baselookup: str, db: Session = Depends(get_db)):
+    try:
+        stats = get_repository_stats(baselookup, db)
+    except Exception as e:
+        log.error("Error fetching repository statistics ==> %s", str(e))
+        raise HTTPException(status_code=500, detail="An internal error has occurred.")
+    if stats is None:
+        raise HTTPException(status_code=404, detail=f"No statistics kept for {baselookup}, it has not been loaded")
+    return stats
+
+
+@router.get('/transmission/encodings')
+async def encodings():
+    return {"default": settings.TRANSMIT_ENCODING, "data": available_encodings()}
+
+
 @router.get('/manifest/repository/{baselookup}')
-async def manifest(baselookup: str, db: Session = Depends(get_db)):
+async def manifest(baselookup: str, encoding: Optional[str] = None, delta: bool = False,
+                   db: Session = Depends(get_db)):
     try:
+        # the encoding is agreed once per transmission and every batch of the manifest is sent in it
+        encoding = validate_encoding(encoding or settings.TRANSMIT_ENCODING)
+        # rows changed after this point are left to the next delta
+        built_at = utc_now()
+        site_config = db.query(SiteConfig).filter(SiteConfig.is_active == True).first()
+        facility = f'{site_config.site_name}-{site_config.site_code}'
         # cass_session = database.cassandra_session_factory()
 
-        count_query = text(f"""
-                           SELECT count(*) count FROM {baselookup}
-                       """)
-        count = execute_data_query(count_query)
-        print(count[0].count)
-
-        columns_query = text(f"""
-                SELECT column_name FROM information_schema.columns
-                WHERE table_schema = 'public' AND table_name = '{baselookup}';
-                """)
-        columns = execute_data_query(columns_query)
+        # a delta is relative to the last manifest the staging API acknowledged completely,
+        # without one (or without stable row ids) the whole repository is sent
+        parent = last_acknowledged_manifest(baselookup, facility, db) if delta else None
+        if delta and parent is None:
+            log.info(f"+++++++++ no acknowledged manifest of {baselookup}, sending it in full +++++++++")
+        elif parent is not None and not supports_delta(baselookup, db):
+            log.info(f"+++++++++ {baselookup} has no natural key, sending it in full +++++++++")
+            parent = None
+
+        table = get_repository_table(baselookup, db)
+        if table is None:
+            raise ValueError(f"Table {baselookup} does not exist in the database.")
+        # count, column statistics and checksum of the rows sent, so the receiver can check it got all of them;
+        # a scan of the repository runs on a worker thread so the event loop stays free
+        if parent is not None:
+            statistics = await asyncio.to_thread(manifest_statistics, baselookup, table, db, changed_rows_condition(),
+                                                 delta_params(baselookup, parent.started_at))
+            deleted = await asyncio.to_thread(tombstone_count, baselookup, parent.started_at)
+        else:
+            statistics = await asyncio.to_thread(manifest_statistics, baselookup, table, db)
+            deleted = 0
 
         source_system = db.query(AccessCredentials).filter(AccessCredentials.is_active == True).first()
-        site_config = db.query(SiteConfig).filter(SiteConfig.is_active == True).first()
 
         new_manifest = uuid.uuid1()
         manifest = {
             "manifest_id": new_manifest,
             "usl_repository_name": baselookup.lower(),
-            "count": [row.count for row in count][0],
-            "columns": [row.column_name for row in columns],
+            "count": statistics["count"] + deleted,
+            "columns": [column.name for column in table.columns],
             "session_id": uuid.uuid4(),
             # "source_system_version": source_system['system_version'],
             "source_system_version": "1",
@@ -104,21 +186,33 @@ async def manifest(baselookup: str, db: Session = Depends(get_db)):
             "facility_region": site_config.region,
             "facility_organization": site_config.organization,
             "source_system_name": site_config.primary_system,
-
+            "encoding": encoding,
+            "transmission_type": "delta" if parent is not None else "full",
+            "parent_manifest_id": parent.manifest_id if parent is not None else None,
+            "deleted_count": deleted,
+            "statistics": statistics["columns"],
+            "checksum": statistics["checksum"],
+            "checksum_algorithm": statistics["checksum_algorithm"],
         }
 
         # cass_session.cluster.shutdown()
         log.info(f"+++++++++ NEW MANIFEST ID: {new_manifest} GENERATED +++++++++", manifest)
 
         trans_history = TransmissionHistory(usl_repository_name=baselookup, action="Sent",
-                                            facility=f'{site_config.site_name}-{site_config.site_code}',
+                                            facility=facility,
                                             source_system_id=site_config.id,
                                             source_system_name=site_config.primary_system,
+                                            started_at=built_at,
                                             ended_at=None,
-                                            manifest_id=new_manifest)
+                                            manifest_id=new_manifest,
+                                            transmission_type=manifest["transmission_type"],
+                                            parent_manifest_id=manifest["parent_manifest_id"])
         db.add(trans_history)
         db.commit()
         return manifest
+    except ValueError as e:
+        log.error("Error sending data ==> %s", str(e))
+        raise HTTPException(status_code=400, detail=str(e))
     except Exception as e:
         log.error("Error sending data ==> %s", str(e))
 
@@ -129,66 +223,233 @@ async def manifest(baselookup: str, db: Session = Depends(get_db)):
         raise HTTPException(status_code=500, detail=be)
 
 
-async def send_progress(baselookup: str, manifest: object, websocket: WebSocket, db):
+async def send_progress(baselookup: str, manifest: object, websocket: WebSocket, db, resume: bool = False):
     try:
 
-        totalRecordsquery = text(f"SELECT COUNT(*) as count FROM {baselookup} ")
-        totalRecordsresult = execute_data_query(totalRecordsquery)
-
-        total_records = totalRecordsresult[0][0]
-        # total_records = [row for row in totalRecordsresult][0]["count"]
-
-        # Define batch size (how many records per batch)
-        batch_size = settings.BATCH_SIZE
-        total_batches = total_records // batch_size + (1 if total_records % batch_size != 0 else 0)
-        if total_batches==0:
-            total_batches=1
-        processed_batches = 0
-
-        select_statement = text(f"""
-                                       SELECT * FROM {baselookup} 
-                                   """)
-        allDataResults = execute_data_query(select_statement)
-        allDataResults = [dict(row._mapping) for row in allDataResults]
-
-        for batch in range(total_batches):
-            offset = batch * batch_size
-            limit = batch_size
-            result = allDataResults[offset:offset + limit]
-            log.info("++++++++ off set and limit +++++++", offset, limit)
-            baseRepoLoaded = [
-                {key: (str(value) if isinstance(value, uuid.UUID)
-                       else value.strftime('%Y-%m-%d') if isinstance(value, datetime.date) else value)
-                 for key, value in
-                 row.items()} for row in result
-            ]
-
-            # print('staging to send ', settings.STAGING_API+baselookup)
-            log.info('===== USL REPORITORY DATA BATCH LOADED ====== ')
-
-            site_config = db.query(SiteConfig).filter(SiteConfig.is_active == True).first()
-
-            data = {
-                "manifest_id": manifest["manifest_id"],
-                "batch_no": batch,
-                "total_batches": total_batches,
-                "facility": site_config.site_name,
-                "facility_id": site_config.site_code,
-                "data": baseRepoLoaded
-            }
-
-            log.info(f'===== STARTED SENDING DATA TO STAGING_API ===== Batch No. {batch}')
-            res = requests.post(settings.STAGING_API + baselookup,
-                                json=data)
-            log.info(f'===== SUCCESSFULLY SENT BATCH No. {batch} TO STAGING_API ===== Status Code :{res.status_code} ')
-
-            # Increment processed batches
-            processed_batches += 1
-            progress = int((processed_batches / total_batches) * 100)
+        manifest_id = manifest["manifest_id"]
+        key_column = f"{baselookup.lower()}_id"
+        # what a manifest reads, in this order, as (table, key column, filter): the repository rows, and for
+        # a delta only the rows changed since its parent followed by the ids of rows deleted since then
+        sources = {ROWS: (baselookup, key_column, None)}
+        params = {}
+        if manifest.get("transmission_type") == "delta":
+            parent = db.query(TransmissionHistory).filter(
+                TransmissionHistory.manifest_id == manifest["parent_manifest_id"],
+                TransmissionHistory.action == "Sent").first()
+            if parent is None:
+                raise ValueError(f"Parent manifest {manifest['parent_manifest_id']} of {manifest_id} is unknown")
+            params = delta_params(baselookup, parent.started_at)
+            sources = {ROWS: (baselookup, key_column, changed_rows_condition()),
+                       TOMBSTONES: (TOMBSTONE_TABLE, "row_id", tombstones_condition(baselookup))}
+        # the manifest counted the rows when it was built, manifests from before then use the load statistics
+        total_records = manifest.get("count")
+        if total_records is None and get_repository_stats(baselookup, db):
+            total_records = get_repository_stats(baselookup, db)["row_count"]
+        if total_records is None:
+            totalRecordsquery = text(f"SELECT COUNT(*) as count FROM {baselookup} ")
+            totalRecordsresult = execute_data_query(totalRecordsquery)
+
+            total_records = totalRecordsresult[0][0]
+            # total_records = [row for row in totalRecordsresult][0]["count"]
+
+        # batches are sized as they are read, starting from BATCH_SIZE
+        sizer = BatchSizer()
+        total_batches = max(1, math.ceil(total_records / sizer.next_size()))
+        site_config = db.query(SiteConfig).filter(SiteConfig.is_active == True).first()
+        # manifests from before payload encodings were sent as plain JSON
+        encoding = manifest.get("encoding") or "json"
+
+        outbox = get_outbox()
+        url = settings.STAGING_API + baselookup
+        spooled = {}
+
+        # a resume resends the batches of the manifest without an acknowledgement, then reads on from
+        # where the interrupted transmission stopped reading
+        resend = []
+        first_batch_no = 0
+        resume_after = None
+        resume_kind = None
+        sent_records = 0
+        # the interrupted transmission read its last batch, a resume only sends again what it had read
+        read_complete = False
+        if resume:
+            ledger = ledger_summary(manifest_id)
+            if ledger["last_batch_no"] is not None:
+                resend = unacknowledged_batches(manifest_id)
+                first_batch_no = ledger["last_batch_no"] + 1
+                resume_after = ledger["last_key"]
+                resume_kind = ledger["last_kind"]
+                sent_records = ledger["rows_acknowledged"]
+                read_complete = ledger["last_batch_read"]
+            log.info(f'===== RESUMING MANIFEST {manifest_id} ===== {ledger}')
+            # batches still in the outbox are resent as they were encoded, the others are read again
+            spooled.update(outbox.claim_batches(manifest_id, [entry["batch_no"] for entry in resend]))
+            history = db.query(TransmissionHistory).filter(TransmissionHistory.manifest_id == manifest_id,
+                                                           TransmissionHistory.action == "Sent").first()
+            reread = len(spooled) < len(resend) or not ledger["last_batch_read"]
+            if reread and history is not None and loaded_since(baselookup, history.started_at, db):
+                # rows read now would not be the rows counted and checksummed by the manifest
+                outbox.release(list(spooled.values()))
+                log.info(f'===== MANIFEST {manifest_id} NOT RESUMED, {baselookup} WAS LOADED AFTER IT =====')
+                await websocket.send_text(json.dumps({
+                    "status_code": 409,
+                    "message": f"{baselookup} was loaded again after manifest {manifest_id} was built, "
+                               f"request a new manifest"
+                }))
+                await websocket.close()
+                return {"status_code": 409, "message": "repository loaded after the manifest"}
+
+        def read_source(kind, after=None, last_key=None):
+            # pages are read on the key as they are sent, only the batches in flight are held in memory
+            table, key, condition = sources[kind]
+            if last_key is not None:
+                condition = f"({condition}) AND {key} <= :last_key" if condition else f"{key} <= :last_key"
+            return keyset_query_return_dict(table, key, sizer.next_size, condition=condition,
+                                            params={**params, "last_key": last_key}, after=after)
+
+        def batch_pages():
+            for entry in resend:
+                if entry["batch_no"] in spooled:
+                    continue
+                kind = entry["kind"] or ROWS
+                rows = [] if entry["last_key"] is None else [
+                    row for page in read_source(kind, entry["after_key"], entry["last_key"]) for row in page
+                ]
+                yield entry["batch_no"], kind, entry["after_key"], rows
+            if read_complete:
+                # reading on past the ledger would send rows that are not part of the manifest
+                return
+            if not total_records and first_batch_no == 0:
+                # an empty repository is still sent as one empty batch
+                yield 0, ROWS, None, []
+                return
+            batch = first_batch_no
+            kinds = list(sources)
+            for kind in kinds[kinds.index(resume_kind) if resume_kind in sources else 0:]:
+                after = resume_after if kind == resume_kind else None
+                for result in read_source(kind, after):
+                    yield batch, kind, after, result
+                    after = result[-1][sources[kind][1]]
+                    batch += 1
+
+        def batch_payloads():
+            nonlocal total_batches
+            read_records = sent_records
+            highest_batch_no = first_batch_no - 1
+            for entry in resend:
+                if entry["batch_no"] in spooled:
+                    payload = outbox.read(spooled[entry["batch_no"]])[1]
+                    record_batch(manifest_id, baselookup, entry["batch_no"], entry["batch_size"], entry["after_key"],
+                                 entry["last_key"], payload.size, entry["kind"] or ROWS, entry["last_batch"])
+                    read_records += payload.rows
+                    yield entry["batch_no"], payload
+            # pages are read one ahead to know which batch is the last
+            pages = batch_pages()
+            following = next(pages, None)
+            while following is not None:
+                batch, kind, after, result = following
+                following = next(pages, None)
+                if kind == TOMBSTONES:
+                    baseRepoLoaded = [{key_column: str(row["row_id"])} for row in result]
+                else:
+                    baseRepoLoaded = [
+                        {key: (str(value) if isinstance(value, uuid.UUID)
+                               else value.strftime('%Y-%m-%d') if isinstance(value, datetime.date) else value)
+                         for key, value in
+                         row.items()} for row in result
+                    ]
+                read_records += len(result)
+                highest_batch_no = max(highest_batch_no, batch)
+                last_batch = following is None and batch == highest_batch_no
+                # the batch count is an estimate at the current batch size until the last batch is read
+                remaining = 0 if following is None else max(1, total_records - read_records)
+                total_batches = highest_batch_no + 1 + math.ceil(remaining / sizer.next_size())
+                log.info(f'===== USL REPORITORY DATA BATCH LOADED ====== {len(result)} rows')
+
+                # encoding runs here on the reader thread, not on the event loop
+                payload = encode_batch({
+                    "manifest_id": manifest_id,
+                    "batch_no": batch,
+                    "batch_size": len(result),
+                    "operation": "delete" if kind == TOMBSTONES else "upsert",
+                    "total_batches": total_batches,
+                    "last_batch": last_batch,
+                    "facility": site_config.site_name,
+                    "facility_id": site_config.site_code
+                }, baseRepoLoaded, encoding)
+                record_batch(manifest_id, baselookup, batch, len(result), after,
+                             result[-1][sources[kind][1]] if result else None, payload.size, kind, last_batch)
+                # spooled to disk before it is posted, so it survives losing the connection or the process
+                spooled[batch] = outbox.append(url, manifest_id, batch, payload)
+                yield batch, payload
+
+        async def batch_sent(batch, payload, res):
+            nonlocal sent_records
+            log.info(f'===== SUCCESSFULLY SENT BATCH No. {batch} TO STAGING_API ===== Status Code :{res.status_code} '
+                     f'{payload.rows} rows, {payload.size} bytes in {payload.latency:.2f}s')
+            await asyncio.to_thread(acknowledge_batch, manifest_id, batch, res.status_code, payload.latency)
+            await asyncio.to_thread(outbox.acknowledge, spooled.pop(batch))
+            # batches are reported in order, so progress only counts batches with every earlier one sent
+            sent_records += payload.rows
+            progress = min(100, int(sent_records / total_records * 100)) if total_records else 100
 
             # Send the progress to the WebSocket
             await websocket.send_text(f"{progress}")
 
+        async def batch_failed(batch, payload, error):
+            log.error(f'===== FAILED TO SEND BATCH No. {batch} TO STAGING_API ===== {error}')
+            await asyncio.to_thread(fail_batch, manifest_id, batch, getattr(error, "status_code", None), str(error))
+            if not getattr(error, "retryable", True):
+                # the staging API rejected the batch, it is not kept for the outbox to send again
+                await asyncio.to_thread(outbox.acknowledge, spooled.pop(batch))
+
+        payloads = batch_payloads()
+        log.info(f'===== STARTED SENDING DATA TO STAGING_API ===== about {total_batches} batches as {encoding}')
+        def spool_rest() -> bool:
+            # the rest of the manifest is spooled up to the outbox budget, a resume reads on from where it stopped
+            try:
+                for _ in payloads:
+                    pass
+                return True
+            except OutboxFull as full:
+                log.warning(f"++++++++++ {full} +++++++++++")
+                return False
+
+        async def outbox_full():
+            log.info(f"++++++++++ outbox full, {len(spooled)} batches of {manifest_id} queued +++++++++++")
+            await websocket.send_text(json.dumps({
+                "status_code": 507,
+                "message": f"The outbox is full, {len(spooled)} batches of manifest {manifest_id} were queued. "
+                           f"Resume the manifest to send the rest once they are delivered"
+            }))
+            await websocket.close()
+            return {"status_code": 507, "message": "outbox full, manifest to be resumed"}
+
+        transmitter = BatchTransmitter(url, sizer=sizer)
+        try:
+            await transmitter.send(payloads, batch_sent, batch_failed)
+        except OutboxFull:
+            return await outbox_full()
+        except TransmissionError as e:
+            if not e.retryable:
+                # the rest of a rejected manifest is not left for the outbox to deliver
+                await asyncio.to_thread(drop_batches, outbox, manifest_id, dict(spooled), e)
+                spooled.clear()
+                raise
+            # the staging API cannot be reached, the rest of the manifest is spooled for the outbox to deliver
+            if not await asyncio.to_thread(spool_rest):
+                return await outbox_full()
+            log.info(f"++++++++++ {len(spooled)} batches of {manifest_id} left in the outbox: {e} +++++++++++")
+            await websocket.send_text("queued")
+            await websocket.close()
+            return {"status_code": 202, "message": "batches queued in the outbox"}
+        finally:
+            outbox.release(list(spooled.values()))
+        log.info(f"++++++++++ batch sizing {sizer.snapshot()} +++++++++++")
+
+        # every batch of the manifest is acknowledged
+        await asyncio.to_thread(complete_manifest, manifest_id)
+
         # websocket.send_text(f"100")
         await websocket.close()
         log.info("++++++++++ All batches loaded and sent +++++++++++")
@@ -220,6 +481,34 @@ async def websocket_endpoint(baselookup: str, websocket: WebSocket, db: Session
         log.error("Websocket error ==> %s", str(e))
         # await websocket.close()
 
+
+@router.websocket("/ws/progress/{baselookup}/resume")
+async def resume_websocket_endpoint(baselookup: str, websocket: WebSocket, db: Session = Depends(get_db)):
+    """
+    Takes the manifest of an interrupted transmission and sends only its batches not yet acknowledged.
+    """
+    await websocket.accept()
+    try:
+        while True:
+            data = await websocket.receive_text()
+            manifest = json.loads(data)
+            await send_progress(baselookup, manifest, websocket, db, resume=True)
+    except WebSocketDisconnect:
+        log.error("Client disconnected")
+    except Exception as e:
+        log.error("Websocket error ==> %s", str(e))
+
+
+@router.get('/transmission/{manifest_id}/batches')
+async def transmission_batches(manifest_id: UUID, db: Session = Depends(get_db)):
+    try:
+        batches = db.query(TransmissionBatch).filter(TransmissionBatch.manifest_id == manifest_id)\
+            .order_by(TransmissionBatch.batch_no).all()
+        return {"summary": ledger_summary(manifest_id), "data": transmission_batch_list_entity(batches)}
+    except Exception as e:
+        log.error("Error fetching transmission batches ==> %s", str(e))
+        raise HTTPException(status_code=500, detail="An internal error has occurred.")
+
 # @router.websocket("/ws/progress")
 # async def progress_updates(websocket: WebSocket):
 #    await websocket.accept()
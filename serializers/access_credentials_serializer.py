@@ -5,6 +5,9 @@ def access_credential_entity(credential) -> dict:
         "conn_type": str(credential.conn_type),
         "name": str(credential.name),
         "is_active": bool(credential.is_active),
+        "max_rows_per_second": credential.max_rows_per_second,
+        "max_concurrent_queries": credential.max_concurrent_queries,
+        "target_latency_ms": credential.target_latency_ms,
         "created_at": credential.created_at,
         "updated_at": credential.updated_at
     }
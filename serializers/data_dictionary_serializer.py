@@ -18,6 +18,7 @@ def data_dictionary_term_entity(dictionary) -> dict:
         "term": str(dictionary.term),
         "data_type": str(dictionary.data_type),
         "is_required": bool(dictionary.is_required),
+        "is_natural_key": bool(dictionary.is_natural_key),
         "term_description": str(dictionary.term_description),
         "expected_values": str(dictionary.expected_values),
         "is_active": bool(dictionary.is_active),
@@ -0,0 +1,30 @@
+import json
+
+
+def extraction_job_entity(job) -> dict:
+    return {
+        "id": str(job.id),
+        "usl_repository_name": job.usl_repository_name,
+        "run_id": str(job.run_id) if job.run_id else None,
+        "source_system_id": str(job.source_system_id) if job.source_system_id else None,
+        "status": job.status,
+        "full_refresh": bool(job.full_refresh),
+        "incremental": bool(job.incremental),
+        "rows_loaded": job.rows_loaded,
+        "batches_committed": job.batches_committed,
+        "rows_inserted": job.rows_inserted,
+        "rows_updated": job.rows_updated,
+        "rows_unchanged": job.rows_unchanged,
+        "rows_deleted": job.rows_deleted,
+        "checkpoint": json.loads(job.checkpoint) if job.checkpoint else None,
+        "summary": json.loads(job.summary) if job.summary else None,
+        "error": job.error,
+        "queued_at": job.queued_at,
+        "started_at": job.started_at,
+        "updated_at": job.updated_at,
+        "ended_at": job.ended_at
+    }
+
+
+def extraction_job_list_entity(jobs) -> list:
+    return [extraction_job_entity(job) for job in jobs]
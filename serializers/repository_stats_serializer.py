@@ -0,0 +1,17 @@
+import json
+
+
+def repository_stats_entity(stats) -> dict:
+    return {
+        "id": str(stats.id),
+        "usl_repository_name": stats.usl_repository_name,
+        "row_count": stats.row_count,
+        "valid_count": stats.valid_count,
+        "invalid_count": stats.invalid_count,
+        "byte_size": stats.byte_size,
+        "dictionary_version": stats.dictionary_version,
+        "last_load_id": str(stats.last_load_id) if stats.last_load_id else None,
+        "last_loaded_at": stats.last_loaded_at,
+        "statistics": json.loads(stats.statistics) if stats.statistics else None,
+        "updated_at": stats.updated_at
+    }
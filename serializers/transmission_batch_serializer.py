@@ -0,0 +1,24 @@
+def transmission_batch_entity(batch) -> dict:
+    return {
+        "id": str(batch.id),
+        "manifest_id": str(batch.manifest_id),
+        "usl_repository_name": batch.usl_repository_name,
+        "batch_no": batch.batch_no,
+        "batch_size": batch.batch_size,
+        "kind": batch.kind,
+        "last_batch": batch.last_batch,
+        "status": batch.status,
+        "after_key": batch.after_key,
+        "last_key": batch.last_key,
+        "payload_bytes": batch.payload_bytes,
+        "latency_ms": batch.latency_ms,
+        "response_code": batch.response_code,
+        "error": batch.error,
+        "attempts": batch.attempts,
+        "created_at": batch.created_at,
+        "updated_at": batch.updated_at
+    }
+
+
+def transmission_batch_list_entity(batches) -> list:
+    return [transmission_batch_entity(batch) for batch in batches]
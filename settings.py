@@ -10,6 +10,26 @@ class Settings(BaseSettings):
 
     STAGING_API: str
     BATCH_SIZE: int
+    TRANSMIT_CONCURRENCY: int = 4
+    TRANSMIT_RETRIES: int = 5
+    TRANSMIT_TIMEOUT_SECONDS: int = 60
+    TRANSMIT_ENCODING: str = "json"
+    TRANSMIT_TARGET_BATCH_BYTES: int = 1048576
+    TRANSMIT_TARGET_LATENCY_MS: int = 5000
+    TRANSMIT_MIN_BATCH_SIZE: int = 50
+    TRANSMIT_MAX_BATCH_SIZE: int = 20000
+    OUTBOX_DIR: str = "outbox"
+    OUTBOX_MAX_BYTES: int = 1073741824
+    OUTBOX_SEGMENT_BYTES: int = 67108864
+    OUTBOX_DRAIN_SECONDS: int = 60
+    EXTRACT_CHUNK_SIZE: int = 1000
+    LOAD_METHOD: str = "copy"
+    EXTRACT_WORKERS: int = 4
+    EXTRACT_MAX_CONCURRENT_PER_SOURCE: int = 2
+    EXTRACT_PARTITIONS: int = 1
+    EXTRACT_QUEUE_BATCHES: int = 4
+    EXTRACT_TARGET_LATENCY_MS: int = 2000
+    EXTRACT_JOB_STALE_SECONDS: int = 900
     JWT_SECRET_KEY: str
     REFRESH_SECRET_KEY: str
     # REPORTING_DB: str
@@ -0,0 +1,75 @@
+import logging
+import threading
+
+from settings import settings
+
+
+log = logging.getLogger()
+
+# the batch is cut by this factor whenever a round trip takes longer than the target latency
+BACKOFF_FACTOR = 0.5
+# and grown by at most this factor per batch while round trips stay within it
+GROWTH_FACTOR = 1.5
+# weight of the latest batch in the running bytes per row estimate
+BYTES_PER_ROW_WEIGHT = 0.3
+
+
+class BatchSizer:
+    """
+    Chooses how many rows go into the next transmission batch. Batches are sized to a target payload size
+    from the bytes per row seen so far, so narrow repositories are sent in large batches and wide ones in
+    small batches, and cut back whenever the staging API takes longer than the target latency to answer.
+    Batches are read on a worker thread while round trips are observed on the event loop.
+    """
+
+    def __init__(self, initial_size: int = None, target_bytes: int = None, target_latency_ms: int = None,
+                 min_size: int = None, max_size: int = None):
+        self.target_bytes = target_bytes or settings.TRANSMIT_TARGET_BATCH_BYTES
+        self.target_latency = (target_latency_ms or settings.TRANSMIT_TARGET_LATENCY_MS) / 1000
+        self.min_size = min_size or settings.TRANSMIT_MIN_BATCH_SIZE
+        self.max_size = max(self.min_size, max_size or settings.TRANSMIT_MAX_BATCH_SIZE)
+        self.size = self._bounded(initial_size or settings.BATCH_SIZE)
+        self.bytes_per_row = None
+        self.backoffs = 0
+        self.lock = threading.Lock()
+
+    def _bounded(self, size: float) -> int:
+        return int(min(self.max_size, max(self.min_size, size)))
+
+    def next_size(self) -> int:
+        with self.lock:
+            return self.size
+
+    def observe(self, rows: int, payload_bytes: int, latency: float):
+        """
+        Adjusts the batch size after a batch was acknowledged.
+        :param rows: rows in the batch
+        :param payload_bytes: size of the batch on the wire
+        :param latency: seconds from posting the batch to its response
+        """
+        if not rows:
+            return
+        with self.lock:
+            batch_bytes_per_row = payload_bytes / rows
+            if self.bytes_per_row is None:
+                self.bytes_per_row = batch_bytes_per_row
+            else:
+                self.bytes_per_row += BYTES_PER_ROW_WEIGHT * (batch_bytes_per_row - self.bytes_per_row)
+            size = self.target_bytes / self.bytes_per_row
+            if latency > self.target_latency:
+                size = min(size, self.size * BACKOFF_FACTOR)
+                self.backoffs += 1
+                log.info(f"+++++++ staging API slow ({latency:.2f}s for {rows} rows), "
+                         f"cutting batches to {self._bounded(size)} rows +++++++")
+            else:
+                size = min(size, self.size * GROWTH_FACTOR)
+            self.size = self._bounded(size)
+
+    def snapshot(self) -> dict:
+        return {
+            "batch_size": self.size,
+            "bytes_per_row": round(self.bytes_per_row, 1) if self.bytes_per_row is not None else None,
+            "target_bytes": self.target_bytes,
+            "target_latency_ms": int(self.target_latency * 1000),
+            "backoffs": self.backoffs
+        }
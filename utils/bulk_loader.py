@@ -0,0 +1,276 @@
+import datetime
+import logging
+import time
+import uuid
+
+from sqlalchemy import MetaData, Table, inspect, literal_column, text
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.exc import OperationalError
+
+from database.database import engine
+from settings import settings
+
+
+log = logging.getLogger()
+
+LOAD_METHODS = ["copy", "insert"]
+
+# flags written by dqa_check, reset when an upsert changes a row so the row is checked afresh
+DQA_COLUMN_RESETS = {"data_valid": "FALSE", "data_required_check_fail": "FALSE", "invalid_data_reasons": "NULL"}
+
+
+def _csv_field(value):
+    # unquoted empty field is NULL for COPY ... CSV, everything else is quoted so that '' stays an empty string
+    if value is None:
+        return ''
+    if isinstance(value, bool):
+        return 't' if value else 'f'
+    if isinstance(value, (datetime.date, datetime.datetime)):
+        value = value.isoformat()
+    return '"' + str(value).replace('"', '""') + '"'
+
+
+class RowStream:
+    """
+    Read-only file-like object that renders rows as CSV lines on demand, so COPY can consume
+    an iterator of rows without the whole payload being built in memory first.
+    """
+
+    def __init__(self, rows, columns):
+        self.rows = iter(rows)
+        self.columns = columns
+        self.buffer = ''
+        self.count = 0
+
+    def _next_line(self):
+        row = next(self.rows)
+        self.count += 1
+        return ','.join(_csv_field(row.get(column)) for column in self.columns) + '\n'
+
+    def read(self, size=-1):
+        try:
+            while size < 0 or len(self.buffer) < size:
+                self.buffer += self._next_line()
+        except StopIteration:
+            pass
+
+        if size < 0:
+            chunk, self.buffer = self.buffer, ''
+        else:
+            chunk, self.buffer = self.buffer[:size], self.buffer[size:]
+        return chunk
+
+
+def copy_rows(connection, table_name: str, columns: list, rows) -> int:
+    """
+    Streams rows into a table using COPY ... FROM STDIN in CSV form.
+    :param connection: SQLAlchemy connection, the COPY joins its transaction
+    :param table_name: target table
+    :param columns: target column names, each row dict is read in this order
+    :param rows: iterable of row dicts
+    :return: number of rows copied
+    """
+    column_list = ', '.join(columns)
+    stream = RowStream(rows, columns)
+    cursor = connection.connection.cursor()
+    try:
+        cursor.copy_expert(f"COPY {table_name} ({column_list}) FROM STDIN WITH (FORMAT csv)", stream)
+        return stream.count
+    finally:
+        cursor.close()
+
+
+def insert_rows(connection, table, rows: list) -> int:
+    if not rows:
+        return 0
+    connection.execute(table.insert().values(rows))
+    return len(rows)
+
+
+def load_rows(connection, table, rows: list, load_method: str = None) -> int:
+    """
+    Loads a batch of row dicts into a reflected base repository table using the configured load method.
+    COPY is only available on PostgreSQL, any other dialect falls back to a multi-row INSERT.
+    """
+    load_method = load_method or settings.LOAD_METHOD
+    if load_method == "copy" and connection.dialect.name == "postgresql":
+        if not rows:
+            return 0
+        return copy_rows(connection, table.name, list(rows[0].keys()), rows)
+    return insert_rows(connection, table, rows)
+
+
+def upsert_rows(connection, table, rows: list, id_column: str, load_method: str = None,
+                compare_column: str = None) -> dict:
+    """
+    Inserts a batch of rows into a base repository table, updating rows whose id already exists.
+    With COPY the batch goes through a temporary staging table and is merged with INSERT ... ON CONFLICT,
+    on any other dialect than PostgreSQL it falls back to INSERT like load_rows.
+    :param connection: SQLAlchemy connection on the datamap database
+    :param table: reflected base repository table
+    :param rows: row dicts, all with the same keys including id_column
+    :param id_column: primary key column the rows are matched on
+    :param load_method: copy or insert, defaults to LOAD_METHOD
+    :param compare_column: existing rows whose value in this column (the row hash) is unchanged are not updated
+    :return: number of rows inserted, updated and left unchanged
+    """
+    if not rows:
+        return {"inserted": 0, "updated": 0, "unchanged": 0}
+
+    # a row may only be touched once per statement, the last occurrence in the batch wins
+    rows = list({row[id_column]: row for row in rows}.values())
+    columns = list(rows[0].keys())
+    resets = {column: value for column, value in DQA_COLUMN_RESETS.items()
+              if column in table.c and column not in columns}
+
+    if (load_method or settings.LOAD_METHOD) == "copy" and connection.dialect.name == "postgresql":
+        staging_table = f"{table.name}_staging"
+        column_list = ', '.join(columns)
+        updates = [f"{column} = EXCLUDED.{column}" for column in columns if column != id_column]
+        updates += [f"{column} = {value}" for column, value in resets.items()]
+        condition = f" WHERE {table.name}.{compare_column} IS DISTINCT FROM EXCLUDED.{compare_column}" \
+            if compare_column else ""
+
+        connection.execute(text(f"CREATE TEMP TABLE IF NOT EXISTS {staging_table} "
+                                f"(LIKE {table.name} INCLUDING DEFAULTS) ON COMMIT DROP"))
+        copy_rows(connection, staging_table, columns, rows)
+        written = connection.execute(text(f"""
+            INSERT INTO {table.name} ({column_list})
+            SELECT {column_list} FROM {staging_table}
+            ON CONFLICT ({id_column}) DO UPDATE SET {', '.join(updates)}{condition}
+            RETURNING (xmax = 0) AS inserted
+        """)).scalars().all()
+        connection.execute(text(f"TRUNCATE {staging_table}"))
+    else:
+        insert_stmt = pg_insert(table).values(rows)
+        updates = {column: insert_stmt.excluded[column] for column in columns if column != id_column}
+        updates.update({column: literal_column(value) for column, value in resets.items()})
+        condition = table.c[compare_column].is_distinct_from(insert_stmt.excluded[compare_column]) \
+            if compare_column else None
+        written = connection.execute(insert_stmt.on_conflict_do_update(
+            index_elements=[id_column], set_=updates, where=condition
+        ).returning(literal_column("xmax = 0"))).scalars().all()
+
+    # xmax is 0 for freshly inserted rows, rows skipped by the condition are not returned at all
+    inserted = sum(1 for is_insert in written if is_insert)
+    return {"inserted": inserted, "updated": len(written) - inserted, "unchanged": len(rows) - len(written)}
+
+
+def shadow_table_name(table_name: str) -> str:
+    return f"{table_name}_shadow"
+
+
+def create_shadow_table(table, guard=None):
+    """
+    Creates an empty copy of a base repository table (columns, defaults, constraints and indexes)
+    for a full load to be written to without touching the live table.
+    :param table: reflected live table
+    :param guard: callable run first in the same transaction with the connection, raising to keep the shadow
+    :return: Table bound to the shadow table
+    """
+    shadow_name = shadow_table_name(table.name)
+    with engine.connect() as connection:
+        if guard:
+            guard(connection)
+        # a shadow left behind by an interrupted load is discarded
+        connection.execute(text(f"DROP TABLE IF EXISTS {shadow_name}"))
+        connection.execute(text(f"CREATE TABLE {shadow_name} (LIKE {table.name} INCLUDING ALL)"))
+        connection.commit()
+    return table.to_metadata(MetaData(), name=shadow_name)
+
+
+def get_shadow_table(table):
+    """
+    Returns the shadow table of a base repository kept by a failed full load, or None if there is none.
+    """
+    shadow_name = shadow_table_name(table.name)
+    if not inspect(engine).has_table(shadow_name):
+        return None
+    return table.to_metadata(MetaData(), name=shadow_name)
+
+
+def drop_shadow_table(table_name: str):
+    with engine.connect() as connection:
+        connection.execute(text(f"DROP TABLE IF EXISTS {shadow_table_name(table_name)}"))
+        connection.commit()
+
+
+def swap_shadow_table(table_name: str, attempts: int = 5, lock_timeout_ms: int = 2000, guard=None):
+    """
+    Replaces a live base repository table with its loaded shadow in a single transaction.
+    The renames need an exclusive lock, a short lock_timeout makes the swap give way and retry
+    instead of queueing readers behind it while a long read is running.
+    :param guard: callable run first in the swap transaction with the connection, raising to call the swap off
+    """
+    shadow_name = shadow_table_name(table_name)
+    retired_name = f"{table_name}_retired"
+    for attempt in range(1, attempts + 1):
+        try:
+            with engine.begin() as connection:
+                connection.execute(text(f"SET LOCAL lock_timeout = '{lock_timeout_ms}ms'"))
+                if guard:
+                    guard(connection)
+                connection.execute(text(f"DROP TABLE IF EXISTS {retired_name}"))
+                connection.execute(text(f"ALTER TABLE {table_name} RENAME TO {retired_name}"))
+                connection.execute(text(f"ALTER TABLE {shadow_name} RENAME TO {table_name}"))
+                connection.execute(text(f"DROP TABLE {retired_name}"))
+
+                # indexes copied with LIKE are named after the shadow, give them back the live names
+                indexes = connection.execute(text("""
+                    SELECT indexname FROM pg_indexes
+                    WHERE schemaname = current_schema() AND tablename = :table_name AND indexname LIKE :shadow_prefix
+                """), {"table_name": table_name, "shadow_prefix": f"{shadow_name}%"}).scalars().all()
+                for index_name in indexes:
+                    live_index_name = table_name + index_name[len(shadow_name):]
+                    connection.execute(text(f"ALTER INDEX {index_name} RENAME TO {live_index_name}"))
+            log.info(f"+++++++ swapped {shadow_name} into {table_name} +++++++")
+            return
+        except OperationalError as e:
+            if attempt == attempts:
+                raise
+            log.warning(f"+++++++ swap of {table_name} waiting on readers, retry {attempt}: {e} +++++++")
+            time.sleep(attempt)
+
+
+def benchmark(total_rows: int = 100000, batch_size: int = 1000):
+    """
+    Compares throughput of the multi-row INSERT path against COPY on a temporary table.
+    Run with: python -m utils.bulk_loader
+    """
+    rows = [{
+        "benchmark_id": uuid.uuid4(),
+        "patientpk": i,
+        "visitdate": datetime.date(2024, 1, 1) + datetime.timedelta(days=i % 365),
+        "clinician": f"clinician, \"{i % 50}\"",
+        "is_active": i % 2 == 0
+    } for i in range(total_rows)]
+
+    results = {}
+    for load_method in LOAD_METHODS:
+        with engine.connect() as connection:
+            connection.execute(text("""
+                CREATE TEMP TABLE bulk_loader_benchmark (
+                    benchmark_id UUID PRIMARY KEY, patientpk INTEGER, visitdate TIMESTAMP,
+                    clinician VARCHAR, is_active BOOLEAN
+                ) ON COMMIT PRESERVE ROWS
+            """))
+            table = Table("bulk_loader_benchmark", MetaData(), autoload_with=connection)
+
+            started = time.perf_counter()
+            for i in range(0, total_rows, batch_size):
+                load_rows(connection, table, rows[i:i + batch_size], load_method)
+                connection.commit()
+            elapsed = time.perf_counter() - started
+
+            loaded = connection.execute(text("SELECT count(*) FROM bulk_loader_benchmark")).scalar()
+            connection.execute(text("DROP TABLE bulk_loader_benchmark"))
+            connection.commit()
+
+        results[load_method] = {"rows": loaded, "seconds": round(elapsed, 3),
+                                "rows_per_second": int(loaded / elapsed) if elapsed else None}
+        log.info(f"+++++++ {load_method}: {results[load_method]} +++++++")
+    return results
+
+
+if __name__ == "__main__":
+    print(benchmark())
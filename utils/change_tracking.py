@@ -0,0 +1,106 @@
+import hashlib
+import logging
+
+from sqlalchemy import text
+
+from database.database import engine
+
+
+log = logging.getLogger()
+
+ROW_HASH_COLUMN = "row_hash"
+LOAD_ID_COLUMN = "load_id"
+TOMBSTONE_TABLE = "repository_tombstones"
+# columns written by the loader or DQA rather than read from the source, left out of the content hash
+NON_CONTENT_COLUMNS = {"data_valid", "data_required_check_fail", "invalid_data_reasons", ROW_HASH_COLUMN,
+                       LOAD_ID_COLUMN}
+NULL_MARKER = "\\N"
+FIELD_SEPARATOR = "\x1f"
+
+
+def row_hash(row: dict, columns: list) -> str:
+    """
+    md5 of the values of a row in a fixed column order, equal for rows with the same content.
+    :param row: coerced row dict with lower case keys
+    :param columns: sorted content columns of the base repository
+    """
+    content = FIELD_SEPARATOR.join(NULL_MARKER if row.get(column) is None else str(row.get(column))
+                                   for column in columns)
+    return hashlib.md5(content.encode("utf-8")).hexdigest()
+
+
+def content_columns(table, id_column: str) -> list:
+    return sorted(column.name for column in table.columns
+                  if column.name != id_column and column.name not in NON_CONTENT_COLUMNS)
+
+
+def ensure_change_tracking(table) -> bool:
+    """
+    Adds the row hash and load id columns and their indexes to a base repository created before they existed.
+    :return: True if the table was altered and has to be reflected again
+    """
+    if ROW_HASH_COLUMN in table.c and LOAD_ID_COLUMN in table.c:
+        return False
+    with engine.connect() as connection:
+        connection.execute(text(f"ALTER TABLE {table.name} ADD COLUMN IF NOT EXISTS {ROW_HASH_COLUMN} VARCHAR"))
+        connection.execute(text(f"ALTER TABLE {table.name} ADD COLUMN IF NOT EXISTS {LOAD_ID_COLUMN} UUID"))
+        connection.execute(text(f"CREATE INDEX IF NOT EXISTS ix_{table.name}_{LOAD_ID_COLUMN} "
+                                f"ON {table.name} ({LOAD_ID_COLUMN})"))
+        connection.execute(text(f"CREATE INDEX IF NOT EXISTS ix_{table.name}_{ROW_HASH_COLUMN} "
+                                f"ON {table.name} ({ROW_HASH_COLUMN})"))
+        connection.commit()
+    log.info(f"+++++++ added change tracking columns to {table.name} +++++++")
+    return True
+
+
+def compare_with_live(connection, shadow_table: str, live_table: str, id_column: str, keyed: bool,
+                      load_id=None) -> dict:
+    """
+    Counts how a fully loaded shadow table differs from the live base repository it replaces, and carries
+    the load id of unchanged rows over so that only rows changed by this load carry its id.
+    Rows are matched on their id when ids come from a natural key, otherwise on their content hash alone,
+    in which case a changed row counts as one deleted and one inserted row.
+    With natural key ids the ids of deleted rows are kept as tombstones of the load, for delta transmissions.
+    """
+    if keyed:
+        match = f"l.{id_column} = s.{id_column}"
+        connection.execute(text(f"""
+            UPDATE {shadow_table} s SET {LOAD_ID_COLUMN} = l.{LOAD_ID_COLUMN}
+            FROM {live_table} l WHERE {match} AND s.{ROW_HASH_COLUMN} = l.{ROW_HASH_COLUMN}
+        """))
+        inserted, updated, unchanged = connection.execute(text(f"""
+            SELECT COUNT(*) FILTER (WHERE l.{id_column} IS NULL),
+                   COUNT(*) FILTER (WHERE l.{id_column} IS NOT NULL
+                                    AND s.{ROW_HASH_COLUMN} IS DISTINCT FROM l.{ROW_HASH_COLUMN}),
+                   COUNT(*) FILTER (WHERE s.{ROW_HASH_COLUMN} = l.{ROW_HASH_COLUMN})
+            FROM {shadow_table} s LEFT JOIN {live_table} l ON {match}
+        """)).one()
+    else:
+        match = f"l.{ROW_HASH_COLUMN} = s.{ROW_HASH_COLUMN}"
+        connection.execute(text(f"""
+            UPDATE {shadow_table} s SET {LOAD_ID_COLUMN} = l.{LOAD_ID_COLUMN}
+            FROM {live_table} l WHERE {match}
+        """))
+        inserted, unchanged = connection.execute(text(f"""
+            SELECT COUNT(*) FILTER (WHERE NOT EXISTS (SELECT 1 FROM {live_table} l WHERE {match})),
+                   COUNT(*) FILTER (WHERE EXISTS (SELECT 1 FROM {live_table} l WHERE {match}))
+            FROM {shadow_table} s
+        """)).one()
+        updated = 0
+    deleted = connection.execute(text(f"""
+        SELECT COUNT(*) FROM {live_table} l WHERE NOT EXISTS (SELECT 1 FROM {shadow_table} s WHERE {match})
+    """)).scalar()
+    if keyed and load_id is not None:
+        connection.execute(text(f"""
+            INSERT INTO {TOMBSTONE_TABLE} (usl_repository_name, row_id, load_id, deleted_at)
+            SELECT :repository, l.{id_column}, :load_id, now() FROM {live_table} l
+            WHERE NOT EXISTS (SELECT 1 FROM {shadow_table} s WHERE {match})
+            ON CONFLICT (usl_repository_name, row_id)
+            DO UPDATE SET load_id = EXCLUDED.load_id, deleted_at = EXCLUDED.deleted_at
+        """), {"repository": live_table, "load_id": load_id})
+        # rows that came back are no longer deleted
+        connection.execute(text(f"""
+            DELETE FROM {TOMBSTONE_TABLE} t WHERE t.usl_repository_name = :repository
+            AND EXISTS (SELECT 1 FROM {shadow_table} s WHERE s.{id_column} = t.row_id)
+        """), {"repository": live_table})
+    return {"inserted": inserted, "updated": updated, "unchanged": unchanged, "deleted": deleted}
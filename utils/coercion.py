@@ -0,0 +1,237 @@
+import datetime
+import logging
+import threading
+
+from models.models import DataDictionaries, DataDictionaryTerms
+
+
+log = logging.getLogger()
+
+# compiled plans keyed by (dictionary name, dictionary version)
+_plans = {}
+_plans_lock = threading.Lock()
+
+DATE_FORMATS = ['%d-%m-%Y', '%d/%m/%Y', '%Y-%m-%d', '%Y-%m-%d %H:%M:%S', '%Y-%m-%dT%H:%M:%S',
+                '%Y-%m-%d %H:%M:%S.%f', '%Y-%m-%dT%H:%M:%S.%f']
+ISO_DATE_FORMATS = ['%Y-%m-%d', '%Y-%m-%d %H:%M:%S', '%Y-%m-%dT%H:%M:%S',
+                    '%Y-%m-%d %H:%M:%S.%f', '%Y-%m-%dT%H:%M:%S.%f']
+# string values of a column looked at to infer its date format
+DATE_SAMPLE_SIZE = 100
+# share of values the inferred format fails on, over at least a sample, after which it is inferred again
+DATE_REINFER_MISS_RATE = 0.5
+
+
+def convert_datetime_to_iso(value):
+    if isinstance(value, datetime.datetime):
+        return value.date()
+    elif isinstance(value, datetime.date):
+        return value
+    else:
+        date_formats = ['%d-%m-%Y', '%d/%m/%Y', '%Y-%m-%d']
+        for date_format in date_formats:
+            try:
+                date_object = datetime.datetime.strptime(value, date_format).date()
+                return date_object
+            except (ValueError, TypeError):
+                continue
+
+
+def date_format_parser(date_format: str):
+    """
+    Returns a callable parsing a string in the given format to a date.
+    ISO formats are parsed with fromisoformat, which is several times faster than strptime.
+    """
+    if date_format in ISO_DATE_FORMATS:
+        return lambda value: datetime.datetime.fromisoformat(value).date()
+    return lambda value: datetime.datetime.strptime(value, date_format).date()
+
+
+def infer_date_format(values: list):
+    """
+    Picks the date format that parses the most of a sample of string values.
+    :return: the format, or None if no format parses any of them
+    """
+    best_format, best_parsed = None, 0
+    for date_format in DATE_FORMATS:
+        parsed = 0
+        for value in values:
+            try:
+                datetime.datetime.strptime(value, date_format)
+                parsed += 1
+            except (ValueError, TypeError):
+                continue
+        if parsed > best_parsed:
+            best_format, best_parsed = date_format, parsed
+    return best_format
+
+
+class DateParser:
+    """
+    Parses the DATETIME columns of one load. The format of each column is inferred from a sample of its
+    first string values and used for the following batches; values it fails on fall back to the other
+    formats and are counted as failures when none of them fits. A format failing on more than
+    DATE_REINFER_MISS_RATE of the values since it was inferred is inferred again from the next batch.
+    """
+
+    def __init__(self):
+        self.formats = {}
+        self.parsers = {}
+        self.failures = {}
+        # values parsed and values the inferred format failed on, since it was inferred
+        self.attempts = {}
+        self.misses = {}
+
+    def _parser_for(self, column, rows: list):
+        if column not in self.parsers:
+            sample = [row[column] for row in rows if isinstance(row[column], str) and row[column] != '']
+            sample = sample[:DATE_SAMPLE_SIZE]
+            if not sample:
+                return None
+            date_format = infer_date_format(sample)
+            self.formats[column] = date_format
+            self.parsers[column] = date_format_parser(date_format) if date_format else None
+            self.attempts[column] = self.misses[column] = 0
+            log.info(f"+++++++ {column} dates parsed as {date_format} +++++++")
+        return self.parsers[column]
+
+    def _fallback(self, column, value):
+        for date_format in DATE_FORMATS:
+            if date_format == self.formats.get(column):
+                continue
+            try:
+                return datetime.datetime.strptime(value, date_format).date()
+            except ValueError:
+                continue
+        self.failures[column] = self.failures.get(column, 0) + 1
+        return None
+
+    def parse_column(self, column, rows: list):
+        parse = None
+        for row in rows:
+            value = row[column]
+            if value is None or value == '':
+                row[column] = None
+            elif isinstance(value, datetime.datetime):
+                row[column] = value.date()
+            elif isinstance(value, datetime.date):
+                continue
+            elif not isinstance(value, str):
+                self.failures[column] = self.failures.get(column, 0) + 1
+                row[column] = None
+            else:
+                if parse is None:
+                    parse = self._parser_for(column, rows)
+                self.attempts[column] += 1
+                try:
+                    if not parse:
+                        raise ValueError(f"no date format inferred for {column}")
+                    row[column] = parse(value)
+                except ValueError:
+                    self.misses[column] += 1
+                    row[column] = self._fallback(column, value)
+
+        attempts = self.attempts.get(column, 0)
+        if attempts >= DATE_SAMPLE_SIZE and self.misses[column] > attempts * DATE_REINFER_MISS_RATE:
+            log.info(f"+++++++ {column} dates do not fit {self.formats.get(column)} "
+                     f"({self.misses[column]} of {attempts}), inferring the format again +++++++")
+            del self.parsers[column]
+
+
+def to_int(value):
+    return int(value)
+
+
+def to_bool(value):
+    return bool(value)
+
+
+def to_date(value):
+    return convert_datetime_to_iso(value)
+
+
+def to_str(value):
+    return f"{value}"
+
+
+def get_converter(data_type):
+    """
+    Maps a data dictionary term data type to the converter used when loading base repositories.
+    :param data_type: data type of the data dictionary term
+    :return: callable that converts a single non-empty value
+    """
+    data_type = str(data_type).upper()
+    if data_type == "INT":
+        return to_int
+    elif data_type == "BOOLEAN":
+        return to_bool
+    elif "DATETIME" in data_type:
+        return to_date
+    else:
+        return to_str
+
+
+class CoercionPlan:
+    """
+    Column -> converter mapping for one version of a data dictionary.
+
+    Compiled once from DataDictionaryTerms so that loading a batch of rows does not touch the database.
+    """
+
+    def __init__(self, dictionary: str, version: int, converters: dict):
+        self.dictionary = dictionary
+        self.version = version
+        self.converters = converters
+
+    def converter_for(self, column):
+        return self.converters.get(column, to_str)
+
+    def apply(self, rows: list, date_parser: DateParser = None) -> list:
+        """
+        Coerces a batch of row dicts in place, one column at a time.
+        :param rows: rows sharing the same columns, as returned by the extract query
+        :param date_parser: parses DATETIME columns with an inferred format and counts failures,
+                            without one every value is tried against each format in turn
+        :return: the same rows with typed values
+        """
+        if not rows:
+            return rows
+
+        for column in rows[0].keys():
+            convert = self.converter_for(column)
+            if convert is to_date and date_parser is not None:
+                date_parser.parse_column(column, rows)
+                continue
+            for row in rows:
+                value = row[column]
+                row[column] = None if value is None or value == '' else convert(value)
+        return rows
+
+
+def compile_coercion_plan(baselookup: str, version: int, db) -> CoercionPlan:
+    terms = db.query(DataDictionaryTerms.term, DataDictionaryTerms.data_type).filter(
+        DataDictionaryTerms.dictionary == baselookup).all()
+    converters = {term: get_converter(data_type) for term, data_type in terms}
+    return CoercionPlan(baselookup, version, converters)
+
+
+def get_coercion_plan(baselookup: str, db) -> CoercionPlan:
+    """
+    Returns the cached coercion plan for the current version of a dictionary, compiling it on first use.
+    """
+    dictionary = db.query(DataDictionaries).filter(DataDictionaries.name == baselookup).first()
+    version = dictionary.version_number if dictionary else 0
+    key = (baselookup, version)
+
+    with _plans_lock:
+        plan = _plans.get(key)
+    if plan is None:
+        plan = compile_coercion_plan(baselookup, version, db)
+        with _plans_lock:
+            _plans[key] = plan
+        log.info(f"+++++++ compiled coercion plan for {baselookup} v{version} +++++++")
+    return plan
+
+
+def invalidate_coercion_plans():
+    with _plans_lock:
+        _plans.clear()
@@ -4,7 +4,9 @@ import uuid
 
 from sqlalchemy import text
 
-from database.database import execute_query
+from database.database import execute_query, engine
+from settings import settings
+from utils.bulk_loader import copy_rows
 
 
 def sanitize_identifier(identifier: str) -> str:
@@ -22,18 +24,37 @@ def create_table(data):
     """))
 
 
-def upload_data(data):
+def record_values(record: dict) -> dict:
+    # both load methods write the same values: text columns, with missing values as NULL
+    return {'generated_id_unique': uuid.uuid4(),
+            **{sanitize_identifier(key): None if value is None else str(value) for key, value in record.items()}}
+
+
+def copy_data(data):
+    table_name = f"{sanitize_identifier(data.name)}_{data.upload.upper()}_EXTRACT"
+    columns = ['generated_id_unique', *(sanitize_identifier(key) for key in data.data[0].keys())]
+    rows = (record_values(record) for record in data.data)
+    with engine.connect() as connection:
+        copy_rows(connection, table_name, columns, rows)
+        connection.commit()
+
+
+def upload_data(data, load_method: str = None):
     try:
         create_table(data)
+        if (load_method or settings.LOAD_METHOD) == "copy" and engine.dialect.name == "postgresql":
+            copy_data(data)
+            return
+
         for record in data.data:
-            columns = ', '.join([sanitize_identifier(key) for key in record.keys()])
-            placeholders = ', '.join(['%s'] * len(record))
-            values = (uuid.uuid4(), *(str(value) for value in record.values()))
+            values = record_values(record)
+            columns = ', '.join(values.keys())
+            placeholders = ', '.join(f':{column}' for column in values.keys())
 
             query = text(f"""
-                INSERT INTO {sanitize_identifier(data.name)}_{data.upload.upper()}_EXTRACT (generated_id_unique, {columns})
-                VALUES {values}
+                INSERT INTO {sanitize_identifier(data.name)}_{data.upload.upper()}_EXTRACT ({columns})
+                VALUES ({placeholders})
             """)
-            execute_query(query)
+            execute_query(query, values)
     except Exception as e:
         logging.error("Error occurred in uploading data", exc_info=True)
@@ -0,0 +1,70 @@
+import logging
+
+from sqlalchemy import text
+
+from database.database import engine
+from models.models import TransmissionHistory, ExtractsQueries, AccessCredentials, ExtractionJob
+from utils.change_tracking import LOAD_ID_COLUMN, TOMBSTONE_TABLE
+from utils.incremental import natural_key_columns
+
+
+log = logging.getLogger()
+
+# rows written by loads that had completed before the parent manifest was built were sent with it,
+# rows of any later, running or failed load were not
+LOADS_SENT = """SELECT id FROM extraction_jobs WHERE usl_repository_name = :repository
+                AND status = 'completed' AND ended_at <= :since"""
+
+
+def last_acknowledged_manifest(baselookup: str, facility: str, db):
+    """
+    The latest manifest of a repository and facility with every batch acknowledged by the staging API.
+    """
+    return db.query(TransmissionHistory).filter(
+        TransmissionHistory.usl_repository_name == baselookup, TransmissionHistory.facility == facility,
+        TransmissionHistory.action == "Sent", TransmissionHistory.ended_at.isnot(None)
+    ).order_by(TransmissionHistory.ended_at.desc()).first()
+
+
+def loaded_since(baselookup: str, since, db) -> bool:
+    """
+    Whether a load of the repository completed after the given time, replacing or changing rows read before it.
+    """
+    return db.query(ExtractionJob).filter(
+        ExtractionJob.usl_repository_name == baselookup, ExtractionJob.status == "completed",
+        ExtractionJob.ended_at > since
+    ).first() is not None
+
+
+def supports_delta(baselookup: str, db) -> bool:
+    """
+    Deltas need rows to keep their id across loads, which they only do with a natural key.
+    """
+    source_system = db.query(AccessCredentials).filter(AccessCredentials.is_active == True).first()
+    extract_query = db.query(ExtractsQueries).filter(
+        ExtractsQueries.base_repository == baselookup, ExtractsQueries.source_system_id == source_system.id
+    ).first() if source_system else None
+    return extract_query is not None and bool(natural_key_columns(baselookup, extract_query, db))
+
+
+def delta_params(baselookup: str, since) -> dict:
+    return {"repository": baselookup, "repository_table": baselookup.lower(), "since": since}
+
+
+def changed_rows_condition() -> str:
+    return f"{LOAD_ID_COLUMN} IS NOT NULL AND {LOAD_ID_COLUMN} NOT IN ({LOADS_SENT})"
+
+
+def tombstones_condition(baselookup: str) -> str:
+    # a deleted row that was loaded again is sent as a row instead
+    return f"""usl_repository_name = :repository_table AND {LOAD_ID_COLUMN} NOT IN ({LOADS_SENT})
+               AND NOT EXISTS (SELECT 1 FROM {baselookup} r WHERE r.{baselookup.lower()}_id = {TOMBSTONE_TABLE}.row_id)"""
+
+
+def tombstone_count(baselookup: str, since) -> int:
+    """
+    :return: number of rows deleted since the parent manifest was built
+    """
+    with engine.connect() as connection:
+        return connection.execute(text(f"SELECT COUNT(*) FROM {TOMBSTONE_TABLE} WHERE {tombstones_condition(baselookup)}"),
+                                  delta_params(baselookup, since)).scalar()
@@ -2,57 +2,95 @@ import re
 import json
 from sqlalchemy import text
 
-from database.database import execute_raw_data_query, execute_query
+from database.database import execute_raw_data_query, execute_query, keyset_query_return_dict
 from models.models import DataDictionaries, DataDictionaryTerms, DQAReport
 
 
-def dqa_check(baselookup: str, db):
+# rows checked per keyset page, only one page is held in memory at a time
+DQA_PAGE_SIZE = 5000
+
+
+def failed_checks(row: dict, terms: list):
+    """
+    :return: terms of a row not matching their expected values, and whether a required term is empty
+    """
+    failed_expected = []
+    failed_null_check = False
+    for term in terms:
+        term_value = row[term.term.lower()]
+        is_valid = re.match(term.expected_values, str(term_value), flags=re.IGNORECASE)
+        if term.is_required and term_value is None:
+            failed_null_check = True
+        if not is_valid:
+            failed_expected.append({
+                'term': term.term.lower(),
+                'expected': term.expected_values,
+                'actual': term_value
+            })
+    return failed_expected, failed_null_check
+
+
+def dqa_check(baselookup: str, db, table_name: str = None, load_id=None, keep_records: bool = True, on_page=None):
+    """
+    Checks the rows of a base repository against the expected values of its dictionary terms, a keyset page at
+    a time, and marks the failed rows with one UPDATE per page.
+    :param table_name: lets a load check its shadow table before it replaces the live base repository
+    :param load_id: only check the rows inserted or changed by this load, the others keep the result of an earlier check
+    :param keep_records: return every checked row with its failures, loads leave it off to keep memory bounded
+    :param on_page: callable called after every page, e.g. to keep a job heartbeat
+    """
+    table_name = table_name or baselookup
     dictionary = db.query(DataDictionaries).filter(DataDictionaries.name == baselookup).first()
     terms = db.query(DataDictionaryTerms).filter(DataDictionaryTerms.dictionary == baselookup).all()
-    query = text(f"SELECT * FROM {baselookup}")
-    data = execute_raw_data_query(query)
-    count_data = len(data)
+    table_id = baselookup.lower() + '_id'
+    condition, params = ("load_id = :load_id", {"load_id": load_id}) if load_id is not None else (None, None)
+    count_data = 0
     total_failed = 0
     total_failed_null_check = 0
     processed_records = []
-    table_name = baselookup
-    table_id = baselookup.lower() + '_id'
-    for row in data:
-        failed_expected = []
-        failed_null_check = False
-        for term in terms:
-            term_value = row[term.term.lower()]
-            is_valid = re.match(term.expected_values, str(term_value), flags=re.IGNORECASE)
-            if term.is_required and term_value is None:
-                failed_null_check = True
-            if not is_valid:
-                failed_expected.append({
-                    'term': term.term.lower(),
-                    'expected': term.expected_values,
-                    'actual': term_value
-                })
-        failed_reasons = "'{}'".format(str(failed_expected).replace("'", '"')) #convert to string for record update
-        processed_records.append({'failed_dqa': failed_expected, 'row': row})
-        if len(failed_expected) > 0:
-            update_query = text(f"""
-                UPDATE {table_name} 
-                SET data_valid = :data_valid, invalid_data_reasons = :invalid_data_reasons 
-                WHERE {table_id} = :row_id
-            """).bindparams(data_valid=False, invalid_data_reasons=failed_reasons, row_id=row[table_id])
-            execute_query(update_query)
-            total_failed += 1
-        if failed_null_check:
-            update_query = text(f"""
-                UPDATE {table_name} 
-                SET data_required_check_fail = :data_required_check_fail
-                WHERE {table_id} = :row_id
-            """).bindparams(data_required_check_fail=True, row_id=row[table_id])
-            execute_query(update_query)
-            total_failed_null_check += 1
+    for data in keyset_query_return_dict(table_name, table_id, DQA_PAGE_SIZE, condition, params):
+        invalid_ids, invalid_reasons, null_ids = [], [], []
+        for row in data:
+            failed_expected, failed_null_check = failed_checks(row, terms)
+            if keep_records:
+                processed_records.append({'failed_dqa': failed_expected, 'row': row})
+            if len(failed_expected) > 0:
+                invalid_ids.append(str(row[table_id]))
+                #convert to string for record update
+                invalid_reasons.append("'{}'".format(str(failed_expected).replace("'", '"')))
+            if failed_null_check:
+                null_ids.append(str(row[table_id]))
+        if invalid_ids:
+            execute_query(text(f"""
+                UPDATE {table_name}
+                SET data_valid = FALSE, invalid_data_reasons = failed.reasons
+                FROM unnest(CAST(:row_ids AS uuid[]), CAST(:reasons AS text[])) AS failed(row_id, reasons)
+                WHERE {table_name}.{table_id} = failed.row_id
+            """), {"row_ids": invalid_ids, "reasons": invalid_reasons})
+        if null_ids:
+            execute_query(text(f"""
+                UPDATE {table_name}
+                SET data_required_check_fail = TRUE
+                WHERE {table_id} = ANY(CAST(:row_ids AS uuid[]))
+            """), {"row_ids": null_ids})
+        count_data += len(data)
+        total_failed += len(invalid_ids)
+        total_failed_null_check += len(null_ids)
+        if on_page:
+            on_page()
+    total_rows = count_data
+    if load_id is not None:
+        # the report still covers the whole repository, read back from the results stored on the rows
+        total_rows, total_failed, total_failed_null_check = execute_raw_data_query(text(f"""
+            SELECT COUNT(*) AS total_rows,
+                   COUNT(*) FILTER (WHERE invalid_data_reasons IS NOT NULL) AS invalid_rows,
+                   COUNT(*) FILTER (WHERE data_required_check_fail) AS null_rows
+            FROM {table_name}
+        """))[0].values()
     report = DQAReport(
         base_table_name=baselookup,
-        valid_rows=count_data - total_failed,
-        total_rows=count_data,
+        valid_rows=total_rows - total_failed,
+        total_rows=total_rows,
         invalid_rows=total_failed,
         dictionary_version=dictionary.version_number,
         null_rows=total_failed_null_check
@@ -0,0 +1,199 @@
+import json
+import logging
+import threading
+import uuid
+
+from sqlalchemy.exc import IntegrityError
+
+from database.database import SessionLocal
+from models.models import ExtractionJob, utc_now
+from serializers.extraction_job_serializer import extraction_job_entity
+from settings import settings
+from utils.repository_loader import extract_and_load, requeue_interrupted_jobs
+
+
+log = logging.getLogger()
+
+# how long an idle worker waits before looking for queued jobs again, submitting a job wakes it up sooner
+JOB_POLL_SECONDS = 5
+ACTIVE_STATUSES = ["queued", "running"]
+FINISHED_STATUSES = ["completed", "failed", "abandoned"]
+
+_workers = []
+_wakeup = threading.Event()
+_lock = threading.Lock()
+
+
+def active_job(baselookup: str, db):
+    return db.query(ExtractionJob).filter(
+        ExtractionJob.usl_repository_name == baselookup, ExtractionJob.status.in_(ACTIVE_STATUSES)
+    ).first()
+
+
+def submit_job(baselookup: str, db, full_refresh: bool = False, run_id=None):
+    """
+    Queues the extraction of a base repository for the workers.
+    :return: the queued job and True, or the job already queued or running for the repository and False
+    """
+    job = active_job(baselookup, db)
+    if job is not None:
+        return job, False
+
+    job = ExtractionJob(usl_repository_name=baselookup, run_id=run_id, full_refresh=full_refresh, status="queued",
+                        rows_loaded=0, batches_committed=0, queued_at=utc_now(), updated_at=utc_now())
+    db.add(job)
+    try:
+        db.commit()
+    except IntegrityError:
+        # another submit queued the repository between the check and the insert, the unique index kept it single
+        db.rollback()
+        job = active_job(baselookup, db)
+        if job is None:
+            raise
+        return job, False
+    _wakeup.set()
+    log.info(f"+++++++ extraction of {baselookup} queued as job {job.id} +++++++")
+    return job, True
+
+
+def resume_job(job, db) -> bool:
+    """
+    Queues a failed job again, it continues from its last checkpoint.
+    :return: False if another job of the repository is already queued or running
+    """
+    job.status = "queued"
+    job.updated_at = utc_now()
+    try:
+        db.commit()
+    except IntegrityError:
+        db.rollback()
+        return False
+    _wakeup.set()
+    return True
+
+
+def submit_run(repositories: list, db, full_refresh: bool = False):
+    """
+    Queues the extraction of several base repositories under one run id.
+    A repository that is already queued or being loaded is skipped.
+    :return: run id, skipped repositories
+    """
+    run_id = uuid.uuid4()
+    skipped = [baselookup for baselookup in repositories
+               if not submit_job(baselookup, db, full_refresh, run_id)[1]]
+    log.info(f"+++++++ extraction run {run_id} queued, skipped {skipped} +++++++")
+    return run_id, skipped
+
+
+def run_snapshot(run_id, db) -> dict:
+    """
+    Combined progress of the jobs of a run, or None if the run has no jobs.
+    """
+    jobs = db.query(ExtractionJob).filter(ExtractionJob.run_id == uuid.UUID(str(run_id))).all()
+    if not jobs:
+        return None
+    statuses = [job.status for job in jobs]
+    finished = all(status in FINISHED_STATUSES for status in statuses)
+    return {
+        "run_id": str(run_id),
+        "status": ("failed" if "failed" in statuses else "completed") if finished else "running",
+        "started_at": min((job.started_at for job in jobs if job.started_at), default=None),
+        "ended_at": max((job.ended_at for job in jobs if job.ended_at), default=None) if finished else None,
+        "total_count": sum(job.rows_loaded for job in jobs),
+        "completed": statuses.count("completed"),
+        "total": len(statuses),
+        "repositories": {job.usl_repository_name: extraction_job_entity(job) for job in jobs}
+    }
+
+
+def job_snapshot(job_id) -> dict:
+    """
+    Current state of a job read on its own session, for progress subscribers polling from the event loop.
+    """
+    db = SessionLocal()
+    try:
+        job = db.query(ExtractionJob).filter(ExtractionJob.id == uuid.UUID(str(job_id))).first()
+        return extraction_job_entity(job) if job else None
+    finally:
+        db.close()
+
+
+def claim_job(db):
+    """
+    Takes the oldest queued job. SKIP LOCKED keeps two workers from claiming the same job, and the owner
+    token set on it lets only this worker write to the job until it is requeued.
+    :return: the job and the token it was claimed with, or None and None
+    """
+    job = db.query(ExtractionJob).filter(ExtractionJob.status == "queued").order_by(
+        ExtractionJob.queued_at).with_for_update(skip_locked=True).first()
+    if job is None:
+        return None, None
+    owner = uuid.uuid4()
+    job.owner = owner
+    job.status = "running"
+    job.updated_at = utc_now()
+    db.commit()
+    return job, owner
+
+
+def _run_job(db, job, owner):
+    # concurrent queries against the source are limited by its throttle, not by the number of jobs
+    result = extract_and_load(job.usl_repository_name, db, job_id=job.id, owner=owner)
+    log.info(f"+++++++ extraction job {job.id} completed: {json.dumps(result, default=str)} +++++++")
+
+
+def _worker():
+    while True:
+        db = SessionLocal()
+        job = None
+        owner = None
+        try:
+            job, owner = claim_job(db)
+            if job is not None:
+                _run_job(db, job, owner)
+        except Exception as e:
+            log.error("Extraction worker error ==> %s", str(e))
+            if job is not None:
+                # the loader marks the jobs it fails, this covers errors before it got hold of the job
+                db.rollback()
+                db.query(ExtractionJob).filter(
+                    ExtractionJob.id == job.id, ExtractionJob.status == "running", ExtractionJob.owner == owner
+                ).update({ExtractionJob.status: "failed", ExtractionJob.error: str(e),
+                          ExtractionJob.updated_at: utc_now()})
+                db.commit()
+        finally:
+            db.close()
+
+        if job is None:
+            # jobs of a worker process that died are picked up once their heartbeat is stale
+            db = SessionLocal()
+            try:
+                requeue_interrupted_jobs(db)
+            except Exception as e:
+                log.error("Error requeueing interrupted jobs ==> %s", str(e))
+            finally:
+                db.close()
+            _wakeup.wait(JOB_POLL_SECONDS)
+            _wakeup.clear()
+
+
+def start_workers():
+    """
+    Queues jobs interrupted by the last shutdown again and starts the extraction worker threads.
+    Jobs are claimed from the database, so queued loads survive restarts and closed browser tabs.
+    Idle workers keep looking for interrupted jobs, those of a process that stopped are only requeued
+    once their heartbeat is older than EXTRACT_JOB_STALE_SECONDS.
+    """
+    with _lock:
+        if _workers:
+            return
+        db = SessionLocal()
+        try:
+            requeue_interrupted_jobs(db)
+        finally:
+            db.close()
+        for i in range(settings.EXTRACT_WORKERS):
+            worker = threading.Thread(target=_worker, name=f"extraction-worker-{i}", daemon=True)
+            worker.start()
+            _workers.append(worker)
+    log.info(f"+++++++ {settings.EXTRACT_WORKERS} extraction workers started +++++++")
@@ -0,0 +1,131 @@
+import datetime
+import uuid
+
+from sqlalchemy import text
+
+from models.models import DataDictionaryTerms, utc_now
+
+
+# namespace for ids derived from natural keys, changing it changes every derived id
+NATURAL_KEY_NAMESPACE = uuid.UUID('6f1c3d2e-8a4b-5c7d-9e0f-1a2b3c4d5e6f')
+
+
+def split_columns(columns: str) -> list:
+    if not columns:
+        return []
+    return [column.strip().lower() for column in columns.split(',') if column.strip()]
+
+
+def dictionary_key_columns(baselookup: str, db) -> list:
+    """
+    Returns the lower case terms declared as the natural key of a base repository in its data dictionary.
+    """
+    terms = db.query(DataDictionaryTerms.term).filter(
+        DataDictionaryTerms.dictionary == baselookup,
+        DataDictionaryTerms.is_natural_key == True,
+        DataDictionaryTerms.is_active == True
+    ).order_by(DataDictionaryTerms.term).all()
+    return [term.lower() for term, in terms]
+
+
+def natural_key_columns(baselookup: str, extract_query, db) -> list:
+    """
+    Natural key of a base repository: the key columns configured for its extract query, otherwise the
+    terms declared as natural key in the dictionary. Empty when rows have no natural identity.
+    """
+    return split_columns(extract_query.key_columns) or dictionary_key_columns(baselookup, db)
+
+
+def has_natural_key(row: dict, key_columns: list) -> bool:
+    return all(row.get(column) not in [None, ''] for column in key_columns)
+
+
+def natural_key_id(baselookup: str, row: dict, key_columns: list) -> uuid.UUID:
+    """
+    Derives a deterministic row id from the natural key of a base repository row,
+    so that the same source row keeps the same id across loads.
+    :param baselookup: base repository name
+    :param row: row dict with lower case keys
+    :param key_columns: lower case columns making up the natural key
+    """
+    key = '|'.join('' if row.get(column) is None else str(row.get(column)) for column in key_columns)
+    return uuid.uuid5(NATURAL_KEY_NAMESPACE, f"{baselookup.lower()}:{key}")
+
+
+def is_incremental_run(extract_query, full_refresh: bool = False, key_columns: list = None) -> bool:
+    """
+    An incremental run needs a watermark column, a key to upsert on and a high water mark from a previous load.
+    A full refresh is forced when requested or when the configured refresh interval has elapsed.
+    """
+    if full_refresh or extract_query.load_mode != 'incremental':
+        return False
+    if not extract_query.watermark_column or not (key_columns or split_columns(extract_query.key_columns)):
+        return False
+    if extract_query.high_water_mark is None:
+        return False
+    if extract_query.full_refresh_interval_days and extract_query.last_full_refresh_at:
+        refresh_due = extract_query.last_full_refresh_at + datetime.timedelta(
+            days=extract_query.full_refresh_interval_days)
+        if utc_now() >= refresh_due:
+            return False
+    return True
+
+
+def format_watermark(value) -> str:
+    """
+    Stores a watermark value as text that parse_watermark reads back to the same type:
+    ISO 8601 for dates and timestamps, the plain number otherwise.
+    """
+    if isinstance(value, (datetime.datetime, datetime.date)):
+        return value.isoformat()
+    return str(value)
+
+
+def parse_watermark(value: str):
+    """
+    Reads a stored high water mark back as an int, a timestamp or, failing both, the text itself,
+    so that it is bound to the source as a typed value rather than left to string coercion.
+    """
+    if value is None:
+        return None
+    try:
+        return int(value)
+    except ValueError:
+        pass
+    try:
+        return datetime.datetime.fromisoformat(value)
+    except ValueError:
+        return value
+
+
+def watermark_query(query: str, watermark_column: str, high_water_mark: str, dialect, order_by: str = None,
+                    text_columns: bool = False):
+    """
+    Wraps a saved extract query so that only rows from the high water mark on are returned.
+    Rows at the high water mark itself are read again: rows sharing the last timestamp may have been committed
+    after the previous read, and upserting on the natural key id makes reading the others again harmless.
+    :param dialect: dialect of the database the query runs on, used to quote the watermark column
+    :param order_by: column of the wrapped query to order by, ordering inside the subquery is not kept
+    :param text_columns: the query returns TEXT columns, as the extract tables of csv and api uploads do,
+                         the watermark column is cast to the type of the high water mark to compare them
+    """
+    value = parse_watermark(high_water_mark)
+    column = f"incremental_extract.{dialect.identifier_preparer.quote(watermark_column)}"
+    if text_columns and isinstance(value, (int, datetime.datetime)):
+        column = f"CAST(NULLIF({column}, '') AS {'bigint' if isinstance(value, int) else 'timestamp'})"
+    order_clause = f" ORDER BY incremental_extract.{order_by}" if order_by else ""
+    return text(f"""SELECT * FROM ({query.strip().rstrip(';')}) incremental_extract
+                 WHERE {column} >= :high_water_mark{order_clause}""").bindparams(high_water_mark=value)
+
+
+def max_watermark(rows: list, watermark_column: str, current=None):
+    """
+    Returns the largest watermark value seen in a batch of raw source rows, or current if none is larger.
+    """
+    values = [row[watermark_column] for row in rows if row.get(watermark_column) is not None]
+    if not values:
+        return current
+    batch_max = max(values)
+    if current is None or batch_max > current:
+        return batch_max
+    return current
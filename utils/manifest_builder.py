@@ -0,0 +1,93 @@
+import logging
+
+from sqlalchemy import select, func, literal_column, text, Integer, Numeric, Float, Date, DateTime, String, Time
+
+from database.database import engine
+from models.models import ExtractionJob, DataDictionaries
+from utils.change_tracking import ROW_HASH_COLUMN
+from utils.repository_stats import get_repository_stats
+
+
+log = logging.getLogger()
+
+# the checksum adds up the leading hex digits of every row hash, so it does not depend on the order rows are read
+# or sent in and a receiver can recompute it from the row_hash values of the rows it got
+CHECKSUM_HEX_DIGITS = 15
+CHECKSUM_MODULUS = 2 ** 64
+CHECKSUM_ALGORITHM = f"sum of int(row_hash[:{CHECKSUM_HEX_DIGITS}], 16) mod 2^64"
+# set by the DQA check on rows that failed it
+INVALID_REASONS_COLUMN = "invalid_data_reasons"
+# column types with an order, for which min and max are reported
+ORDERED_TYPES = (Integer, Numeric, Float, Date, DateTime, Time, String)
+
+
+def json_value(value):
+    return value if value is None or isinstance(value, (int, float, str)) else str(value)
+
+
+def repository_statistics(table, condition: str = None, params: dict = None) -> dict:
+    """
+    Row count, per column null counts and min/max and an order independent checksum of a base repository,
+    computed in a single scan.
+    :param table: reflected base repository table
+    :param condition: SQL filter on the rows, with its bind parameters in params
+    """
+    ordered = [column for column in table.columns if isinstance(column.type, ORDERED_TYPES)]
+    expressions = [func.count().label("count")]
+    expressions += [func.count(column).label(f"nonnull_{i}") for i, column in enumerate(table.columns)]
+    expressions += [func.min(column).label(f"min_{i}") for i, column in enumerate(ordered)]
+    expressions += [func.max(column).label(f"max_{i}") for i, column in enumerate(ordered)]
+    if INVALID_REASONS_COLUMN in table.c:
+        expressions.append(func.count().filter(table.c[INVALID_REASONS_COLUMN].isnot(None)).label("invalid"))
+    if ROW_HASH_COLUMN in table.c:
+        expressions.append(literal_column(
+            f"MOD(COALESCE(SUM(('x' || SUBSTR(COALESCE({ROW_HASH_COLUMN}, '0'), 1, {CHECKSUM_HEX_DIGITS}))"
+            f"::bit({CHECKSUM_HEX_DIGITS * 4})::bigint), 0), {CHECKSUM_MODULUS})").label("checksum"))
+    query = select(*expressions).select_from(table)
+    if condition:
+        query = query.where(text(condition))
+    with engine.connect() as connection:
+        row = connection.execute(query, params or {}).one()._mapping
+
+    columns = {column.name: {"nulls": row["count"] - row[f"nonnull_{i}"]} for i, column in enumerate(table.columns)}
+    for i, column in enumerate(ordered):
+        columns[column.name]["min"] = json_value(row[f"min_{i}"])
+        columns[column.name]["max"] = json_value(row[f"max_{i}"])
+    return {
+        "count": row["count"],
+        "invalid": row["invalid"] if "invalid" in row else None,
+        "checksum": str(row["checksum"]) if "checksum" in row else None,
+        "checksum_algorithm": CHECKSUM_ALGORITHM,
+        "columns": columns
+    }
+
+
+def load_time_statistics(baselookup: str, db) -> dict:
+    """
+    Statistics computed at the end of the last load of a repository, if nothing has written to it since:
+    the last job to touch it is that load and the dictionary was not changed after it.
+    """
+    stats = get_repository_stats(baselookup, db)
+    if stats is None or not stats["statistics"]:
+        return None
+    job = db.query(ExtractionJob).filter(ExtractionJob.usl_repository_name == baselookup)\
+        .order_by(ExtractionJob.updated_at.desc()).first()
+    if job is None or job.status != "completed" or str(job.id) != stats["last_load_id"]:
+        return None
+    dictionary = db.query(DataDictionaries).filter(DataDictionaries.name == baselookup).first()
+    if stats["dictionary_version"] != (dictionary.version_number if dictionary else 0):
+        return None
+    return stats["statistics"]
+
+
+def manifest_statistics(baselookup: str, table, db, condition: str = None, params: dict = None) -> dict:
+    """
+    Statistics for a manifest, from the last load when the whole repository is sent and they are current,
+    otherwise from one scan of the rows sent.
+    """
+    if condition is None:
+        statistics = load_time_statistics(baselookup, db)
+        if statistics is not None:
+            return statistics
+    log.info(f"+++++++ scanning {baselookup} for manifest statistics +++++++")
+    return repository_statistics(table, condition, params)
@@ -0,0 +1,310 @@
+import asyncio
+import json
+import logging
+import os
+import struct
+import threading
+import zlib
+
+from settings import settings
+from utils.payload_formats import EncodedBatch
+from utils.transmission_ledger import acknowledge_batch, fail_batch, complete_manifest
+from utils.transmitter import BatchTransmitter, TransmissionError
+
+
+log = logging.getLogger()
+
+# every record is a header of meta length, body length and crc32 of both, then the JSON meta and the body
+RECORD_HEADER = struct.Struct("!III")
+SEGMENT_PREFIX = "segment-"
+SEGMENT_SUFFIX = ".log"
+ACKS_SUFFIX = ".acks"
+
+_outbox = None
+_outbox_lock = threading.Lock()
+
+
+class OutboxFull(Exception):
+    pass
+
+
+class Segment:
+    """
+    One append-only segment file of the outbox and its index: the offsets of the records in it, with
+    their meta, and an append-only file of the offsets already acknowledged by the staging API.
+    """
+
+    def __init__(self, directory: str, number: int):
+        self.number = number
+        self.path = os.path.join(directory, f"{SEGMENT_PREFIX}{number:06d}{SEGMENT_SUFFIX}")
+        self.acks_path = os.path.join(directory, f"{SEGMENT_PREFIX}{number:06d}{ACKS_SUFFIX}")
+        self.records = {}
+        self.acknowledged = set()
+        self.size = 0
+
+    def recover(self):
+        """
+        Reads the index back from the files. A record cut short or corrupted by a crash while it was appended
+        is the last one in the segment, the file is truncated before it.
+        """
+        with open(self.path, "r+b") as segment_file:
+            while True:
+                offset = segment_file.tell()
+                header = segment_file.read(RECORD_HEADER.size)
+                if not header:
+                    break
+                if len(header) == RECORD_HEADER.size:
+                    meta_length, body_length, crc = RECORD_HEADER.unpack(header)
+                    content = segment_file.read(meta_length + body_length)
+                    if len(content) == meta_length + body_length and zlib.crc32(content) == crc:
+                        self.records[offset] = json.loads(content[:meta_length])
+                        continue
+                log.warning(f"+++++++ outbox {self.path} cut short at {offset}, truncating +++++++")
+                segment_file.truncate(offset)
+                break
+            self.size = segment_file.seek(0, os.SEEK_END)
+        if os.path.exists(self.acks_path):
+            with open(self.acks_path) as acks_file:
+                # a line without its newline was cut short and never acknowledged
+                self.acknowledged = {int(line) for line in acks_file if line.endswith("\n")} & set(self.records)
+
+    def append(self, meta: dict, body: bytes) -> int:
+        meta_bytes = json.dumps(meta, default=str).encode("utf-8")
+        record = RECORD_HEADER.pack(len(meta_bytes), len(body), zlib.crc32(meta_bytes + body)) + meta_bytes + body
+        with open(self.path, "ab") as segment_file:
+            offset = segment_file.tell()
+            segment_file.write(record)
+            segment_file.flush()
+            os.fsync(segment_file.fileno())
+        self.records[offset] = meta
+        self.size = offset + len(record)
+        return offset
+
+    def read(self, offset: int) -> bytes:
+        with open(self.path, "rb") as segment_file:
+            segment_file.seek(offset)
+            meta_length, body_length, _ = RECORD_HEADER.unpack(segment_file.read(RECORD_HEADER.size))
+            segment_file.seek(meta_length, os.SEEK_CUR)
+            return segment_file.read(body_length)
+
+    def acknowledge(self, offset: int):
+        with open(self.acks_path, "a") as acks_file:
+            acks_file.write(f"{offset}\n")
+            acks_file.flush()
+            os.fsync(acks_file.fileno())
+        self.acknowledged.add(offset)
+
+    def done(self) -> bool:
+        return len(self.acknowledged) == len(self.records)
+
+    def delete(self):
+        for path in [self.path, self.acks_path]:
+            if os.path.exists(path):
+                os.remove(path)
+
+
+class Outbox:
+    """
+    Store-and-forward spool of encoded transmission batches on local disk. Batches are appended to segment
+    files and synced before they are posted, so a batch that could not be delivered while the staging API
+    was unreachable survives until the outbox is drained. Segments are deleted once every batch in them is
+    acknowledged, and appends are refused beyond the disk budget.
+    Records handed to a sender are claimed so that the live transmission and the drainer never post the same one.
+    """
+
+    def __init__(self, directory: str = None, max_bytes: int = None, segment_bytes: int = None):
+        self.directory = directory or settings.OUTBOX_DIR
+        self.max_bytes = max_bytes or settings.OUTBOX_MAX_BYTES
+        self.segment_bytes = segment_bytes or settings.OUTBOX_SEGMENT_BYTES
+        self.segments = {}
+        self.claimed = set()
+        self.lock = threading.Lock()
+        os.makedirs(self.directory, exist_ok=True)
+        for name in sorted(os.listdir(self.directory)):
+            if name.startswith(SEGMENT_PREFIX) and name.endswith(SEGMENT_SUFFIX):
+                segment = Segment(self.directory, int(name[len(SEGMENT_PREFIX):-len(SEGMENT_SUFFIX)]))
+                segment.recover()
+                self.segments[segment.number] = segment
+        self._delete_done()
+        # appends go to a new segment, an old one may end in a record that was cut short
+        self.current = self._new_segment()
+        if self.pending():
+            log.info(f"+++++++ outbox holds {len(self.pending())} undelivered batches +++++++")
+
+    def _new_segment(self) -> Segment:
+        segment = Segment(self.directory, max(self.segments, default=0) + 1)
+        self.segments[segment.number] = segment
+        return segment
+
+    def _delete_done(self):
+        for number, segment in list(self.segments.items()):
+            if segment.done() and segment is not getattr(self, "current", None):
+                segment.delete()
+                del self.segments[number]
+
+    def size(self) -> int:
+        return sum(segment.size for segment in self.segments.values())
+
+    def append(self, url: str, manifest_id, batch_no: int, payload: EncodedBatch, claim: bool = True) -> tuple:
+        """
+        Spools an encoded batch.
+        :param claim: whether the caller posts the batch itself, otherwise it is left to the drainer
+        :return: key of the record
+        """
+        meta = {"url": url, "manifest_id": str(manifest_id), "batch_no": batch_no, "rows": payload.rows,
+                "headers": payload.headers}
+        with self.lock:
+            if self.size() + len(payload.body) > self.max_bytes:
+                raise OutboxFull(f"Outbox is over its budget of {self.max_bytes} bytes, "
+                                 f"batch {batch_no} of {manifest_id} was not spooled")
+            if self.current.size >= self.segment_bytes:
+                self.current = self._new_segment()
+            key = (self.current.number, self.current.append(meta, payload.body))
+            if claim:
+                self.claimed.add(key)
+            return key
+
+    def meta(self, key: tuple) -> dict:
+        return self.segments[key[0]].records[key[1]]
+
+    def read(self, key: tuple) -> tuple:
+        """
+        :return: meta and encoded batch of a record
+        """
+        segment = self.segments[key[0]]
+        meta = self.meta(key)
+        return meta, EncodedBatch(segment.read(key[1]), meta["headers"], meta["rows"])
+
+    def acknowledge(self, key: tuple):
+        """
+        Marks a record as delivered, or as given up on after the staging API rejected it.
+        """
+        with self.lock:
+            segment = self.segments.get(key[0])
+            if segment is not None and key[1] not in segment.acknowledged:
+                segment.acknowledge(key[1])
+            self.claimed.discard(key)
+            self._delete_done()
+
+    def claim(self, keys):
+        with self.lock:
+            self.claimed.update(keys)
+
+    def claim_batches(self, manifest_id, batch_nos) -> dict:
+        """
+        Claims the undelivered records of the given batches of a manifest that no other sender holds.
+        :return: keys of the records claimed by batch number
+        """
+        batch_nos = set(batch_nos)
+        with self.lock:
+            keys = {meta["batch_no"]: (number, offset) for number, segment in sorted(self.segments.items())
+                    for offset, meta in sorted(segment.records.items())
+                    if meta["manifest_id"] == str(manifest_id) and meta["batch_no"] in batch_nos
+                    and offset not in segment.acknowledged and (number, offset) not in self.claimed}
+            self.claimed.update(keys.values())
+            return keys
+
+    def release(self, keys):
+        with self.lock:
+            self.claimed.difference_update(keys)
+
+    def pending(self) -> list:
+        """
+        Keys of the records neither acknowledged nor claimed by a sender, in the order they were appended.
+        """
+        with self.lock:
+            return [(number, offset) for number, segment in sorted(self.segments.items())
+                    for offset in sorted(segment.records)
+                    if offset not in segment.acknowledged and (number, offset) not in self.claimed]
+
+    def snapshot(self) -> dict:
+        with self.lock:
+            return {
+                "segments": len(self.segments),
+                "bytes": self.size(),
+                "max_bytes": self.max_bytes,
+                "records": sum(len(segment.records) for segment in self.segments.values()),
+                "undelivered": sum(len(segment.records) - len(segment.acknowledged)
+                                   for segment in self.segments.values())
+            }
+
+
+def get_outbox() -> Outbox:
+    global _outbox
+    with _outbox_lock:
+        if _outbox is None:
+            _outbox = Outbox()
+        return _outbox
+
+
+def drop_batches(outbox: Outbox, manifest_id, batch_keys: dict, error: TransmissionError):
+    """
+    Gives up on the undelivered batches of a manifest once the staging API rejected one of them, so that the
+    rest of a rejected manifest is not delivered on its own. They are marked failed in the ledger and can be
+    sent again by resuming the manifest.
+    """
+    for batch_no, key in batch_keys.items():
+        fail_batch(manifest_id, batch_no, None, f"not sent, batch {error.batch_no} of the manifest was rejected")
+        outbox.acknowledge(key)
+    if batch_keys:
+        log.info(f"+++++++ {len(batch_keys)} batches of rejected manifest {manifest_id} dropped from the outbox +++++++")
+
+
+async def drain_outbox(outbox: Outbox = None) -> int:
+    """
+    Posts the undelivered batches of the outbox, one transmission at a time. Stops at the first one the
+    staging API cannot be reached for, the rest waits for the next round.
+    :return: number of batches delivered
+    """
+    outbox = outbox or get_outbox()
+    transmissions = {}
+    for key in outbox.pending():
+        meta = outbox.meta(key)
+        transmissions.setdefault((meta["url"], meta["manifest_id"]), {})[meta["batch_no"]] = key
+
+    delivered = 0
+    for (url, manifest_id), batch_keys in transmissions.items():
+        outbox.claim(batch_keys.values())
+
+        def batches():
+            for batch_no, key in sorted(batch_keys.items()):
+                yield batch_no, outbox.read(key)[1]
+
+        # batches of the manifest neither delivered nor rejected yet
+        undelivered = dict(batch_keys)
+
+        async def batch_sent(batch_no, payload, response):
+            nonlocal delivered
+            await asyncio.to_thread(acknowledge_batch, manifest_id, batch_no, response.status_code, payload.latency)
+            await asyncio.to_thread(outbox.acknowledge, undelivered.pop(batch_no))
+            delivered += 1
+
+        async def batch_failed(batch_no, payload, error):
+            await asyncio.to_thread(fail_batch, manifest_id, batch_no, getattr(error, "status_code", None), str(error))
+            if not getattr(error, "retryable", True):
+                # a rejected batch would be rejected again, it is dropped and can be resent by resuming the manifest
+                await asyncio.to_thread(outbox.acknowledge, undelivered.pop(batch_no))
+
+        try:
+            # one retry only, an unreachable staging API is tried again next round
+            await BatchTransmitter(url, retries=1).send(batches(), batch_sent, batch_failed)
+            if await asyncio.to_thread(complete_manifest, manifest_id):
+                log.info(f"+++++++ manifest {manifest_id} delivered from the outbox +++++++")
+        except TransmissionError as e:
+            log.info(f"+++++++ outbox not drained: {e} +++++++")
+            if e.retryable:
+                break
+            await asyncio.to_thread(drop_batches, outbox, manifest_id, undelivered, e)
+        finally:
+            outbox.release(batch_keys.values())
+    return delivered
+
+
+async def drain_outbox_forever():
+    while True:
+        try:
+            if await drain_outbox():
+                log.info(f"+++++++ outbox: {get_outbox().snapshot()} +++++++")
+        except Exception as e:
+            log.error("Error draining outbox ==> %s", str(e))
+        await asyncio.sleep(settings.OUTBOX_DRAIN_SECONDS)
@@ -0,0 +1,189 @@
+import logging
+import queue
+import re
+import threading
+
+from sqlalchemy import text
+
+from database.source_system_database import get_source_db
+from models.models import MappedVariables
+from settings import settings
+
+
+log = logging.getLogger()
+
+# how long a partition reader waits on a full queue before checking whether the load was abandoned
+PUT_TIMEOUT_SECONDS = 1
+
+# primary table id selected alongside the mapped columns, used to order and checkpoint a partition
+EXTRACT_KEY_COLUMN = "datamap_extract_key"
+
+
+def primary_key_expression(baselookup: str, source_system_id, db):
+    """
+    Returns table.column of the PrimaryTableId mapping of a base repository, or None for custom queries
+    and flat files which have no primary table mapped.
+    """
+    primary_table = db.query(MappedVariables).filter(
+        MappedVariables.base_repository == baselookup,
+        MappedVariables.base_variable_mapped_to == 'PrimaryTableId',
+        MappedVariables.source_system_id == source_system_id
+    ).first()
+    if primary_table is None or primary_table.tablename.strip() in ['', '-'] \
+            or primary_table.columnname.strip() in ['', '-']:
+        return None
+    return f"{primary_table.tablename.strip()}.{primary_table.columnname.strip()}"
+
+
+def can_partition(query: str) -> bool:
+    # key ranges are appended to the top level WHERE clause, so it has to be the last clause of the query
+    where_clauses = list(re.finditer(r'\bwhere\b', query, flags=re.IGNORECASE))
+    if not where_clauses:
+        return False
+    tail = query[where_clauses[-1].end():]
+    if tail.count(')') > tail.count('('):
+        # the last WHERE belongs to a subquery
+        return False
+    return not re.search(r'\b(group\s+by|order\s+by|limit|having|union)\b', tail, flags=re.IGNORECASE)
+
+
+def key_ranges(min_key: int, max_key: int, partitions: int) -> list:
+    """
+    Splits [min_key, max_key] into contiguous half open ranges of roughly equal width.
+    """
+    span = max_key - min_key + 1
+    partitions = max(1, min(partitions, span))
+    width = -(-span // partitions)
+    return [(start, min(start + width, max_key + 1)) for start in range(min_key, max_key + 1, width)]
+
+
+def plan_partitions(baselookup: str, query: str, source_system_id, db, partitions: int = None) -> list:
+    """
+    Plans key range partitions of a saved extract query on the primary table id.
+    A single partition is still planned when partitioning is off, so that the load can be checkpointed by key.
+    :return: list of partitions, or an empty list if the query has no primary table id to range over
+    """
+    partitions = partitions or settings.EXTRACT_PARTITIONS
+    if not can_partition(query):
+        return []
+
+    key_expression = primary_key_expression(baselookup, source_system_id, db)
+    if key_expression is None:
+        return []
+
+    table_name = key_expression.split('.')[0]
+    with get_source_db() as session:
+        min_key, max_key = session.execute(text(f"SELECT MIN({key_expression}), MAX({key_expression}) "
+                                                f"FROM {table_name}")).one()
+    if not isinstance(min_key, int) or not isinstance(max_key, int):
+        return []
+
+    return [{
+        "partition_no": partition_no,
+        "key_expression": key_expression,
+        "start": start,
+        "end": end,
+        "last_key": None,
+        "count": 0,
+        "completed": False
+    } for partition_no, (start, end) in enumerate(key_ranges(min_key, max_key, partitions))]
+
+
+def partition_query(query: str, partition: dict) -> str:
+    """
+    Restricts a saved extract query to the keys of a partition not yet committed, selecting the key as well.
+    The caller orders the rows by EXTRACT_KEY_COLUMN.
+    """
+    key_expression = partition["key_expression"]
+    start = partition["start"] if partition["last_key"] is None else int(partition["last_key"]) + 1
+    query = query.strip().rstrip(';')
+    if re.match(r'^select\s+\*', query, flags=re.IGNORECASE):
+        # MySQL only accepts an unqualified * first in the select list
+        query = re.sub(r'^select\s+\*', f"SELECT *, {key_expression} AS {EXTRACT_KEY_COLUMN}",
+                       query, count=1, flags=re.IGNORECASE)
+    else:
+        query = re.sub(r'^select\s', f"SELECT {key_expression} AS {EXTRACT_KEY_COLUMN}, ",
+                       query, count=1, flags=re.IGNORECASE)
+    # the original predicate is parenthesised, an OR in it would otherwise escape the key range;
+    # it ends on its own line in case the query ends in a line comment
+    where = list(re.finditer(r'\bwhere\b', query, flags=re.IGNORECASE))[-1]
+    return f"{query[:where.end()]} ({query[where.end():].strip()}\n) " \
+           f"AND {key_expression} >= {int(start)} AND {key_expression} < {int(partition['end'])}"
+
+
+def split_on_key_boundary(rows: list):
+    """
+    Splits off the trailing rows that share the last key of a batch, since more rows with that key
+    (from joined tables) may follow. Committed batches then always end on a whole key.
+    :return: rows safe to commit, rows to carry over to the next batch
+    """
+    if not rows:
+        return rows, []
+    last_key = rows[-1][EXTRACT_KEY_COLUMN]
+    boundary = len(rows)
+    while boundary > 0 and rows[boundary - 1][EXTRACT_KEY_COLUMN] == last_key:
+        boundary -= 1
+    return rows[:boundary], rows[boundary:]
+
+
+def partition_checkpoint(partitions: list) -> list:
+    return [{key: value for key, value in partition.items() if key != "carry"} for partition in partitions]
+
+
+def read_partitions(partitions: list, read_partition, workers: int = None, max_queued_batches: int = None):
+    """
+    Reads partitions concurrently, each on its own source connection, and merges their batches.
+    Yields (partition, batch) pairs, followed by (partition, None) once a partition has been read completely.
+    :param partitions: partitions from plan_partitions, completed ones are skipped
+    :param read_partition: callable returning an iterator of batches for one partition
+    :param workers: partitions read at the same time
+    :param max_queued_batches: batches buffered ahead of the consumer before readers wait
+    """
+    workers = workers or settings.EXTRACT_PARTITIONS
+    partitions = [partition for partition in partitions if not partition["completed"]]
+    batches = queue.Queue(maxsize=max_queued_batches or workers * 2)
+    pending = queue.Queue()
+    for partition in partitions:
+        pending.put(partition)
+    abandoned = threading.Event()
+
+    def put(item):
+        while not abandoned.is_set():
+            try:
+                batches.put(item, timeout=PUT_TIMEOUT_SECONDS)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def reader():
+        while not abandoned.is_set():
+            try:
+                partition = pending.get_nowait()
+            except queue.Empty:
+                return
+            try:
+                for batch in read_partition(partition):
+                    if not put((partition, batch)):
+                        return
+                put((partition, None))
+            except Exception as e:
+                put((partition, e))
+                return
+
+    threads = [threading.Thread(target=reader, name=f"partition-reader-{i}", daemon=True)
+               for i in range(min(workers, len(partitions)))]
+    for thread in threads:
+        thread.start()
+
+    try:
+        remaining = len(partitions)
+        while remaining:
+            partition, batch = batches.get()
+            if isinstance(batch, Exception):
+                raise batch
+            if batch is None:
+                remaining -= 1
+            yield partition, batch
+    finally:
+        abandoned.set()
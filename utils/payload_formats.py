@@ -0,0 +1,168 @@
+import datetime
+import gzip
+import io
+import json
+import logging
+import time
+import uuid
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import pyarrow
+    import pyarrow.ipc
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+
+log = logging.getLogger()
+
+# json: the envelope with one object per row, columnar: column names once and one value array per column,
+# arrow / parquet: the rows as an Arrow IPC stream or a Parquet file with the envelope in the schema metadata
+FORMATS = ["json", "columnar", "arrow", "parquet"]
+COMPRESSIONS = ["none", "gzip", "zstd"]
+CONTENT_TYPES = {
+    "json": "application/json",
+    "columnar": "application/json",
+    "arrow": "application/vnd.apache.arrow.stream",
+    "parquet": "application/vnd.apache.parquet"
+}
+ENVELOPE_METADATA_KEY = b"envelope"
+
+
+class EncodedBatch:
+    """
+    A batch ready to be posted: the encoded body and the headers describing its encoding.
+    """
+
+    def __init__(self, body: bytes, headers: dict, rows: int):
+        self.body = body
+        self.headers = headers
+        self.rows = rows
+        # seconds the staging API took to acknowledge the batch, set once it is sent
+        self.latency = None
+
+    @property
+    def size(self) -> int:
+        return len(self.body)
+
+
+def parse_encoding(encoding: str):
+    """
+    Splits an encoding like "columnar+gzip" into its format and compression.
+    """
+    payload_format, _, compression = (encoding or "json").lower().partition("+")
+    return payload_format, compression or "none"
+
+
+def available_encodings() -> list:
+    formats = [payload_format for payload_format in FORMATS
+               if payload_format in ["json", "columnar"] or pyarrow is not None]
+    compressions = [compression for compression in COMPRESSIONS if compression != "zstd" or zstandard is not None]
+    return [payload_format if compression == "none" else f"{payload_format}+{compression}"
+            for payload_format in formats for compression in compressions]
+
+
+def validate_encoding(encoding: str) -> str:
+    payload_format, compression = parse_encoding(encoding)
+    if payload_format not in FORMATS or compression not in COMPRESSIONS:
+        raise ValueError(f"Unknown payload encoding {encoding}, use one of {available_encodings()}")
+    if payload_format in ["arrow", "parquet"] and pyarrow is None:
+        raise ValueError(f"{payload_format} payloads need pyarrow installed")
+    if compression == "zstd" and zstandard is None:
+        raise ValueError("zstd payloads need zstandard installed")
+    return payload_format if compression == "none" else f"{payload_format}+{compression}"
+
+
+def compress(body: bytes, compression: str) -> bytes:
+    if compression == "gzip":
+        return gzip.compress(body, compresslevel=6)
+    if compression == "zstd":
+        return zstandard.ZstdCompressor(level=3).compress(body)
+    return body
+
+
+def columnar(rows: list) -> dict:
+    columns = list(rows[0].keys()) if rows else []
+    return {"columns": columns, "values": [[row.get(column) for row in rows] for column in columns]}
+
+
+def arrow_table(envelope: dict, rows: list):
+    table = pyarrow.Table.from_pylist(rows)
+    return table.replace_schema_metadata({ENVELOPE_METADATA_KEY: json.dumps(envelope, default=str)})
+
+
+def encode_batch(envelope: dict, rows: list, encoding: str) -> EncodedBatch:
+    """
+    Encodes one transmission batch.
+    :param envelope: manifest_id, batch_no and the other batch fields sent alongside the rows
+    :param rows: JSON ready row dicts
+    :param encoding: format[+compression], one of available_encodings()
+    """
+    payload_format, compression = parse_encoding(encoding)
+    headers = {"Content-Type": CONTENT_TYPES[payload_format], "X-Payload-Encoding": encoding}
+
+    if payload_format in ["json", "columnar"]:
+        data = rows if payload_format == "json" else columnar(rows)
+        body = json.dumps({**envelope, "encoding": encoding, "data": data}, default=str,
+                          separators=(",", ":")).encode("utf-8")
+        if compression != "none":
+            body = compress(body, compression)
+            headers["Content-Encoding"] = compression
+    elif payload_format == "arrow":
+        sink = io.BytesIO()
+        table = arrow_table(envelope, rows)
+        # Arrow compresses its own buffers with zstd, gzip is applied to the whole stream
+        options = pyarrow.ipc.IpcWriteOptions(compression="zstd" if compression == "zstd" else None)
+        with pyarrow.ipc.new_stream(sink, table.schema, options=options) as writer:
+            writer.write_table(table)
+        body = sink.getvalue()
+        if compression == "gzip":
+            body = compress(body, compression)
+            headers["Content-Encoding"] = compression
+    else:
+        sink = io.BytesIO()
+        pyarrow.parquet.write_table(arrow_table(envelope, rows), sink, compression=compression)
+        body = sink.getvalue()
+    return EncodedBatch(body, headers, len(rows))
+
+
+def benchmark(total_rows: int = 5000):
+    """
+    Compares bytes on the wire and encoding time of every available encoding for one batch
+    of rows shaped like a base repository.
+    Run with: python -m utils.payload_formats
+    """
+    rows = [{
+        "visit_id": str(uuid.uuid4()),
+        "patientpk": i,
+        "facilityid": "13939",
+        "visitdate": (datetime.date(2024, 1, 1) + datetime.timedelta(days=i % 365)).strftime('%Y-%m-%d'),
+        "regimen": ["TDF+3TC+DTG", "AZT+3TC+NVP", "ABC+3TC+DTG"][i % 3],
+        "weight": 40 + i % 50,
+        "viral_load_result": None if i % 4 else "LDL",
+        "data_valid": i % 7 != 0
+    } for i in range(total_rows)]
+    envelope = {"manifest_id": str(uuid.uuid1()), "batch_no": 0, "total_batches": 1,
+                "facility": "Benchmark", "facility_id": "13939"}
+
+    results = {}
+    baseline = None
+    for encoding in available_encodings():
+        started = time.perf_counter()
+        encoded = encode_batch(envelope, rows, encoding)
+        elapsed = time.perf_counter() - started
+        baseline = baseline or encoded.size
+        results[encoding] = {"bytes": encoded.size, "bytes_per_row": round(encoded.size / total_rows, 1),
+                             "ratio": round(encoded.size / baseline, 3), "encode_seconds": round(elapsed, 4)}
+        log.info(f"+++++++ {encoding}: {results[encoding]} +++++++")
+    return results
+
+
+if __name__ == "__main__":
+    for encoding, result in benchmark().items():
+        print(f"{encoding:16} {result}")
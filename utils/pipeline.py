@@ -0,0 +1,147 @@
+import queue
+import threading
+import time
+
+
+# how long a stage waits on a full or empty queue before checking whether the pipeline was abandoned
+QUEUE_TIMEOUT_SECONDS = 1
+
+_END = object()
+
+
+class _Failure:
+    def __init__(self, error):
+        self.error = error
+
+
+class StageStats:
+    """
+    Batches and rows handled by one stage, the time it spent working and how full its output queue got.
+    """
+
+    def __init__(self, name: str, output=None):
+        self.name = name
+        self.output = output
+        self.batches = 0
+        self.rows = 0
+        self.busy_seconds = 0.0
+        self.max_queue_depth = 0
+
+    def record(self, rows: int, seconds: float):
+        self.batches += 1
+        self.rows += rows
+        self.busy_seconds += seconds
+        if self.output is not None:
+            self.max_queue_depth = max(self.max_queue_depth, self.output.qsize())
+
+    def snapshot(self, elapsed: float) -> dict:
+        return {
+            "stage": self.name,
+            "batches": self.batches,
+            "rows": self.rows,
+            "rows_per_second": round(self.rows / elapsed, 1) if elapsed else None,
+            "busy_seconds": round(self.busy_seconds, 3),
+            "queue_depth": self.output.qsize() if self.output is not None else None,
+            "max_queue_depth": self.max_queue_depth if self.output is not None else None
+        }
+
+
+class Pipeline:
+    """
+    Runs a source iterator and a chain of stages on their own threads, connected by bounded queues, so
+    reading from the source, transforming and writing overlap. A full queue blocks the stage feeding it,
+    which keeps memory flat when the writer is the slowest stage. The caller iterates the pipeline and
+    acts as its last stage, recording its own work with record().
+    :param source: iterator of items
+    :param stages: (name, work) pairs, work maps one item to an iterable of output items
+    :param rows_of: number of rows in an item, for throughput
+    :param sink: name of the stage run by the caller
+    :param max_queued: items buffered between two stages
+    """
+
+    def __init__(self, source, stages: list, rows_of, sink: str = "write", max_queued: int = 4):
+        self.source = source
+        self.rows_of = rows_of
+        self.abandoned = threading.Event()
+        self.queues = [queue.Queue(maxsize=max_queued) for _ in range(len(stages) + 1)]
+        self.stages = [("read", None)] + list(stages)
+        self.stats = [StageStats(name, output) for (name, _), output in zip(self.stages, self.queues)]
+        self.sink = StageStats(sink)
+        self.started = None
+
+    def _put(self, output, item):
+        while not self.abandoned.is_set():
+            try:
+                output.put(item, timeout=QUEUE_TIMEOUT_SECONDS)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _read(self, stats: StageStats, output):
+        try:
+            source = iter(self.source)
+            while not self.abandoned.is_set():
+                start = time.perf_counter()
+                try:
+                    item = next(source)
+                except StopIteration:
+                    break
+                stats.record(self.rows_of(item), time.perf_counter() - start)
+                if not self._put(output, item):
+                    break
+            self._put(output, _END)
+        except Exception as e:
+            self._put(output, _Failure(e))
+        finally:
+            if hasattr(self.source, "close"):
+                self.source.close()
+
+    def _work(self, stats: StageStats, work, source, output):
+        while not self.abandoned.is_set():
+            try:
+                item = source.get(timeout=QUEUE_TIMEOUT_SECONDS)
+            except queue.Empty:
+                continue
+            if item is _END or isinstance(item, _Failure):
+                self._put(output, item)
+                return
+            try:
+                start = time.perf_counter()
+                results = list(work(item))
+                stats.record(self.rows_of(item), time.perf_counter() - start)
+            except Exception as e:
+                self._put(output, _Failure(e))
+                return
+            for result in results:
+                if not self._put(output, result):
+                    return
+
+    def record(self, rows: int, seconds: float):
+        self.sink.record(rows, seconds)
+
+    def report(self) -> list:
+        elapsed = time.perf_counter() - self.started if self.started else 0
+        return [stats.snapshot(elapsed) for stats in self.stats + [self.sink]]
+
+    def __iter__(self):
+        self.started = time.perf_counter()
+        threads = [threading.Thread(target=self._read, args=(self.stats[0], self.queues[0]),
+                                    name="pipeline-read", daemon=True)]
+        for i, (name, work) in enumerate(self.stages[1:], start=1):
+            threads.append(threading.Thread(target=self._work, args=(self.stats[i], work, self.queues[i - 1],
+                                                                     self.queues[i]),
+                                            name=f"pipeline-{name}", daemon=True))
+        for thread in threads:
+            thread.start()
+
+        try:
+            while True:
+                item = self.queues[-1].get()
+                if item is _END:
+                    return
+                if isinstance(item, _Failure):
+                    raise item.error
+                yield item
+        finally:
+            self.abandoned.set()
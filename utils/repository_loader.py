@@ -0,0 +1,444 @@
+import datetime
+import json
+import logging
+import threading
+import time
+import uuid
+
+from sqlalchemy import text, update
+
+from database.database import stream_query_return_dict, engine as postgres_engine
+from database.source_system_database import stream_source_query, source_system_dialect
+from models.models import AccessCredentials, SiteConfig, TransmissionHistory, ExtractsQueries, ExtractionJob, \
+    DataDictionaries, utc_now
+from settings import settings
+from utils.bulk_loader import load_rows, upsert_rows, create_shadow_table, swap_shadow_table, drop_shadow_table, \
+    get_shadow_table
+from utils.coercion import get_coercion_plan, DateParser
+from utils.dqa_check import dqa_check
+from utils.incremental import is_incremental_run, max_watermark, natural_key_id, natural_key_columns, \
+    has_natural_key, watermark_query, format_watermark
+from utils.manifest_builder import repository_statistics
+from utils.repository_stats import record_repository_stats
+from utils.pipeline import Pipeline
+from utils.source_throttle import get_throttle, throttled
+from utils.table_cache import get_repository_table, invalidate_repository_tables
+from utils.change_tracking import ensure_change_tracking, content_columns, row_hash, compare_with_live, \
+    ROW_HASH_COLUMN, LOAD_ID_COLUMN
+from utils.partitioning import plan_partitions, read_partitions, partition_query, split_on_key_boundary, \
+    partition_checkpoint, EXTRACT_KEY_COLUMN
+
+
+log = logging.getLogger()
+
+# how often the throughput and queue depths of a running load are logged
+STATS_LOG_SECONDS = 30
+
+
+class JobLost(Exception):
+    """
+    The job was requeued and claimed by another worker, this one must stop writing to it and its tables.
+    """
+    pass
+
+
+def check_owner(connection, job_id, owner):
+    """
+    Refreshes the heartbeat of a job if the given owner still holds it. Run in the transaction of every job,
+    checkpoint and table write of a load, the row lock it takes keeps the job owned until that commits.
+    :raises JobLost: if the job is no longer the owner's
+    """
+    jobs = ExtractionJob.__table__
+    updated = connection.execute(update(jobs).where(jobs.c.id == job_id, jobs.c.owner == owner)
+                                 .values(updated_at=utc_now())).rowcount
+    if not updated:
+        raise JobLost(f"Extraction job {job_id} was taken over by another worker")
+
+
+class JobHeartbeat(threading.Thread):
+    """
+    Refreshes the updated_at heartbeat of a running job on its own connection for the whole load, so that a
+    load waiting on the source or in a long statement is not taken for interrupted and run a second time.
+    """
+
+    def __init__(self, job_id, owner):
+        super().__init__(name=f"job-heartbeat-{job_id}", daemon=True)
+        self.job_id = job_id
+        self.owner = owner
+        self.interval = max(1, settings.EXTRACT_JOB_STALE_SECONDS // 3)
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                with postgres_engine.connect() as connection:
+                    check_owner(connection, self.job_id, self.owner)
+                    connection.commit()
+            except JobLost as e:
+                log.warning(f"+++++++ {e} +++++++")
+                return
+            except Exception as e:
+                log.error("Error refreshing extraction job heartbeat ==> %s", str(e))
+
+    def stop(self):
+        self.stopped.set()
+
+
+def extract_and_load(baselookup: str, db, full_refresh: bool = False, on_progress=None, job_id=None,
+                     owner=None) -> dict:
+    """
+    Extracts a base repository from the active source system and loads it into the datamap database.
+    Blocking, so it is run by the extraction workers off the event loop.
+    :param baselookup: base repository name
+    :param db: datamap database session, used only by this load
+    :param full_refresh: reload everything even if the repository is configured for incremental loads
+    :param on_progress: called with the number of rows loaded so far after every committed batch
+    :param job_id: queued extraction job to run, a job that already loaded rows continues from its checkpoint
+    :param owner: token the job was claimed with, the load stops once the job is no longer held with it
+    :return: extraction job id, number of rows loaded, whether the run was incremental and the partitions read
+    """
+    job = None
+    job_heartbeat = None
+    # a partially loaded shadow is kept until it is known whether the job can continue from it
+    keep_shadow = True
+    try:
+        # system config data
+        source_system = db.query(AccessCredentials).filter(
+            AccessCredentials.is_active == True).first()
+        site_config = db.query(SiteConfig).filter(
+            SiteConfig.is_active == True).first()
+
+        existingQuery = db.query(ExtractsQueries).filter(
+            ExtractsQueries.base_repository==baselookup,
+            ExtractsQueries.source_system_id==source_system.id
+        ).first()
+        extract_source_data_query = existingQuery.query
+
+        # ------ started extraction -------
+
+        if job_id:
+            job = db.query(ExtractionJob).filter(ExtractionJob.id == job_id).first()
+            if job is None or job.usl_repository_name != baselookup or job.status in ["completed", "abandoned"]:
+                job = None
+                raise ValueError(f"Extraction job {job_id} of {baselookup} cannot be run")
+            full_refresh = bool(job.full_refresh)
+        else:
+            job = ExtractionJob(usl_repository_name=baselookup, full_refresh=full_refresh, owner=uuid.uuid4(),
+                                rows_loaded=0, batches_committed=0, queued_at=utc_now())
+            db.add(job)
+        # claim_job hands the job over with the token of this worker
+        owner = owner or job.owner
+
+        if job.transmission_history_id is None:
+            # a new load replaces the shadow of any earlier failed load, those can no longer be resumed
+            db.query(ExtractionJob).filter(
+                ExtractionJob.usl_repository_name == baselookup, ExtractionJob.status == "failed",
+                ExtractionJob.id != job.id
+            ).update({ExtractionJob.status: "abandoned"})
+
+            loadedHistory = TransmissionHistory(usl_repository_name=baselookup, action="Loaded",
+                                                facility=f'{site_config.site_name}-{site_config.site_code}',
+                                                source_system_id=source_system.id,
+                                                source_system_name=site_config.primary_system,
+                                                ended_at=None,
+                                                manifest_id=None)
+            db.add(loadedHistory)
+            db.flush()
+            job.transmission_history_id = loadedHistory.id
+            job.source_system_id = source_system.id
+            job.incremental = is_incremental_run(existingQuery, full_refresh,
+                                                 natural_key_columns(baselookup, existingQuery, db))
+            job.started_at = utc_now()
+        else:
+            loadedHistory = db.query(TransmissionHistory).filter(
+                TransmissionHistory.id == job.transmission_history_id).first()
+        job.status = "running"
+        job.error = None
+        job.updated_at = utc_now()
+        db.flush()
+        check_owner(db.connection(), job.id, owner)
+        db.commit()
+        job_heartbeat = JobHeartbeat(job.id, owner)
+        job_heartbeat.start()
+
+        count_inserted = job.rows_loaded
+        idColumn = baselookup.lower() + "_id"
+        chunk_size = settings.EXTRACT_CHUNK_SIZE
+        coercion_plan = get_coercion_plan(baselookup, db)
+        date_parser = DateParser()
+
+        # incremental runs only pull rows past the high water mark and upsert them on their natural key
+        incremental = job.incremental
+        # with a natural key, rows keep their id across loads and are upserted on it, so re-runs are idempotent
+        key_columns = natural_key_columns(baselookup, existingQuery, db)
+        keyless_rows = 0
+        watermark_column = existingQuery.watermark_column
+        high_water_mark = None
+        throttle = get_throttle(source_system)
+        source_dialect = source_system_dialect() if source_system.conn_type not in ["csv", "api"] \
+            else postgres_engine.dialect
+
+        if incremental:
+            log.info(f"+++++++ incremental load of {baselookup} from {existingQuery.high_water_mark} +++++++")
+
+        # keyed partitions are read in key order, so the last key committed in each is a checkpoint to resume from
+        partitions = json.loads(job.checkpoint) if job.checkpoint else []
+        if not partitions:
+            if count_inserted:
+                log.info(f"+++++++ {baselookup} has no key to resume from, restarting the load +++++++")
+                count_inserted = job.rows_loaded = job.batches_committed = 0
+            if source_system.conn_type not in ["csv", "api"]:
+                partitions = plan_partitions(baselookup, extract_source_data_query, source_system.id, db)
+            job.checkpoint = json.dumps(partitions) if partitions else None
+            db.commit()
+        keep_shadow = bool(partitions) and not incremental
+
+        def read(query: str, ordered: bool = False):
+            if incremental:
+                query = watermark_query(query, watermark_column, existingQuery.high_water_mark, source_dialect,
+                                        order_by=EXTRACT_KEY_COLUMN if ordered else None,
+                                        text_columns=source_system.conn_type in ["csv", "api"])
+            else:
+                query = text(f"{query} ORDER BY {EXTRACT_KEY_COLUMN}" if ordered else query)
+            if source_system.conn_type not in ["csv", "api"]:
+                # extract data from source DB, paced so the EMR stays usable
+                return throttled(stream_source_query(query, chunk_size), throttle)
+            # extract data from imported csv/api schema
+            return stream_query_return_dict(query, chunk_size)
+
+        if partitions:
+            log.info(f"+++++++ extracting {baselookup} in {len(partitions)} key range partitions +++++++")
+            source_chunks = read_partitions(
+                partitions, lambda partition: read(partition_query(extract_source_data_query, partition), True))
+        else:
+            source_chunks = ((None, batch) for batch in read(extract_source_data_query))
+        # ------ --------------- -------
+        # ------ started loading -------
+
+        USLDictionaryModel = get_repository_table(baselookup, db)
+        if USLDictionaryModel is None:
+            raise ValueError(f"Table {baselookup} does not exist in the database.")
+        if ensure_change_tracking(USLDictionaryModel):
+            invalidate_repository_tables()
+            USLDictionaryModel = get_repository_table(baselookup, db)
+        hash_columns = content_columns(USLDictionaryModel, idColumn)
+        # read once here, the job is expired by every commit and must not be refreshed from the coercion thread
+        load_id = job.id
+
+        def guard(connection):
+            check_owner(connection, load_id, owner)
+
+        def commit():
+            # every commit of the load only goes through while this worker still owns the job
+            guard(db.connection())
+            db.commit()
+
+        # full loads fill a shadow table that replaces the live repository once loaded and checked,
+        # so readers never see a partially loaded repository. A resumed full load continues its shadow.
+        targetTable = None
+        if incremental:
+            targetTable = USLDictionaryModel
+        elif count_inserted:
+            targetTable = get_shadow_table(USLDictionaryModel)
+            if targetTable is None:
+                keep_shadow = False
+                raise ValueError(f"The partially loaded {baselookup} table is gone, start a new load")
+
+        def transform(rows: list) -> list:
+            nonlocal high_water_mark, keyless_rows
+            if watermark_column:
+                high_water_mark = max_watermark(rows, watermark_column, high_water_mark)
+            coercion_plan.apply(rows, date_parser)
+
+            dataToBeInserted = []
+            for data in rows:
+                # for db case sensitivity
+                newRecordObj = {}
+                for key, val in data.items():
+                    newRecordObj[key.lower()] = val
+                newRecordObj.pop(EXTRACT_KEY_COLUMN, None)
+                if watermark_column and watermark_column.lower() not in USLDictionaryModel.c:
+                    newRecordObj.pop(watermark_column.lower(), None)
+                if key_columns and has_natural_key(newRecordObj, key_columns):
+                    newRecordObj[idColumn] = natural_key_id(baselookup, newRecordObj, key_columns)
+                else:
+                    # rows missing part of their key would all collapse into one id, they get their own instead
+                    keyless_rows += 1 if key_columns else 0
+                    newRecordObj[idColumn] = uuid.uuid4()
+                newRecordObj[ROW_HASH_COLUMN] = row_hash(newRecordObj, hash_columns)
+                newRecordObj[LOAD_ID_COLUMN] = load_id
+                dataToBeInserted.append(newRecordObj)
+            return dataToBeInserted
+
+        # rows of one key may span two batches, only whole keys are committed
+        carry = {}
+
+        def prepare(item):
+            """
+            Coercion stage, runs on its own thread between the source readers and the writer.
+            :return: (partition, rows, last key) to write, and (partition, None, None) once a partition is read
+            """
+            partition, batch = item
+            if partition is None:
+                return [(None, transform(batch), None)]
+
+            rows = carry.pop(partition["partition_no"], []) + (batch or [])
+            if batch is not None:
+                rows, carry[partition["partition_no"]] = split_on_key_boundary(rows)
+            prepared = []
+            if rows:
+                last_key = rows[-1][EXTRACT_KEY_COLUMN]
+                prepared.append((partition, transform(rows), last_key))
+            if batch is None:
+                prepared.append((partition, None, None))
+            return prepared
+
+        def load_batch(partition, dataToBeInserted, last_key):
+            nonlocal count_inserted, targetTable
+            if targetTable is None:
+                targetTable = create_shadow_table(USLDictionaryModel, guard)
+
+            if incremental:
+                # unchanged rows are skipped and keep the id of the load that last changed them
+                changes = upsert_rows(db.connection(), targetTable, dataToBeInserted, idColumn,
+                                      compare_column=ROW_HASH_COLUMN)
+                job.rows_inserted = (job.rows_inserted or 0) + changes["inserted"]
+                job.rows_updated = (job.rows_updated or 0) + changes["updated"]
+                job.rows_unchanged = (job.rows_unchanged or 0) + changes["unchanged"]
+            elif key_columns:
+                upsert_rows(db.connection(), targetTable, dataToBeInserted, idColumn)
+            else:
+                load_rows(db.connection(), targetTable, dataToBeInserted)
+            count_inserted += len(dataToBeInserted)
+
+            # the checkpoint is committed in the same transaction as the rows it covers
+            if partition is not None:
+                partition["count"] += len(dataToBeInserted)
+                partition["last_key"] = last_key
+            job.rows_loaded = count_inserted
+            job.batches_committed += 1
+            job.checkpoint = json.dumps(partition_checkpoint(partitions), default=str) if partitions else None
+            job.updated_at = utc_now()
+            commit()
+
+            if on_progress:
+                on_progress(count_inserted)
+            log.info("+++++++ data batch +++++++")
+            log.info(f"+++++++ step i : count_inserted +++++++ {count_inserted} records")
+
+        # source reads, coercion and writes overlap, bounded queues between them hold back a faster stage
+        pipeline = Pipeline(source_chunks, [("coerce", prepare)], rows_of=lambda item: len(item[1] or []),
+                            max_queued=settings.EXTRACT_QUEUE_BATCHES)
+        stats_logged_at = time.monotonic()
+        for partition, rows, last_key in pipeline:
+            start = time.perf_counter()
+            if rows:
+                load_batch(partition, rows, last_key)
+
+            if partition is not None and rows is None:
+                partition["completed"] = True
+                job.checkpoint = json.dumps(partition_checkpoint(partitions), default=str)
+                commit()
+                log.info(f"+++++++ partition {partition['partition_no']} of {baselookup} loaded: "
+                         f"{partition['count']} records +++++++")
+            pipeline.record(len(rows or []), time.perf_counter() - start)
+
+            if time.monotonic() - stats_logged_at > STATS_LOG_SECONDS:
+                stats_logged_at = time.monotonic()
+                log.info(f"+++++++ {baselookup} pipeline: {pipeline.report()} +++++++")
+        log.info(f"+++++++ {baselookup} pipeline: {pipeline.report()} +++++++")
+
+        if count_inserted > 0:
+            commit()
+            if incremental:
+                # an incremental load does not see deleted source rows
+                job.rows_deleted = 0
+                dqa_check(baselookup, db, load_id=job.id, keep_records=False, on_page=commit)
+            else:
+                changes = compare_with_live(db.connection(), targetTable.name, baselookup.lower(), idColumn,
+                                            keyed=bool(key_columns), load_id=load_id)
+                job.rows_inserted, job.rows_updated, job.rows_unchanged, job.rows_deleted = changes.values()
+                commit()
+                dqa_check(baselookup, db, table_name=targetTable.name, keep_records=False, on_page=commit)
+                swap_shadow_table(baselookup.lower(), guard=guard)
+            log.info(f"+++++++ {baselookup} changes: {job.rows_inserted} inserted, {job.rows_updated} updated, "
+                     f"{job.rows_unchanged} unchanged, {job.rows_deleted} deleted +++++++")
+            log.info("+++++++ USL Base Repository Data saved +++++++")
+
+        if watermark_column:
+            if high_water_mark is not None:
+                existingQuery.high_water_mark = format_watermark(high_water_mark)
+            if not incremental:
+                existingQuery.last_full_refresh_at = utc_now()
+
+        if keyless_rows:
+            log.warning(f"+++++++ {baselookup}: {keyless_rows} rows without a complete natural key "
+                        f"were given random ids +++++++")
+        if date_parser.failures:
+            log.warning(f"+++++++ {baselookup} dates that could not be parsed and were loaded empty: "
+                        f"{date_parser.failures} +++++++")
+
+        # ended loading
+        result = {"job_id": job.id, "count": count_inserted, "incremental": incremental,
+                  "partitions": partition_checkpoint(partitions), "date_formats": date_parser.formats,
+                  "date_parse_failures": date_parser.failures, "pipeline": pipeline.report(),
+                  "throttle": throttle.snapshot(), "natural_key": key_columns, "keyless_rows": keyless_rows,
+                  "changes": {"inserted": job.rows_inserted, "updated": job.rows_updated,
+                              "unchanged": job.rows_unchanged, "deleted": job.rows_deleted}}
+        ended_at = utc_now()
+        if loadedHistory is not None:
+            loadedHistory.ended_at = ended_at
+        job.status = "completed"
+        job.summary = json.dumps(result, default=str)
+        job.ended_at = job.updated_at = ended_at
+        commit()
+
+        try:
+            # kept once here so that manifests and the dashboard do not have to scan or count the repository
+            dictionary = db.query(DataDictionaries).filter(DataDictionaries.name == baselookup).first()
+            record_repository_stats(baselookup, repository_statistics(USLDictionaryModel),
+                                    dictionary.version_number if dictionary else 0, job.id, db)
+        except Exception as e:
+            db.rollback()
+            log.warning(f"+++++++ statistics of {baselookup} not kept: {e} +++++++")
+
+        return result
+    except Exception as e:
+        db.rollback()
+        if isinstance(e, JobLost):
+            # the job, its checkpoint and its shadow table belong to the worker that claimed it since
+            log.warning(f"+++++++ load of {baselookup} stopped: {e} +++++++")
+            raise
+        owned = job is not None and owner is not None and db.query(ExtractionJob).filter(
+            ExtractionJob.id == job.id, ExtractionJob.owner == owner
+        ).update({ExtractionJob.status: "failed", ExtractionJob.error: str(e),
+                  ExtractionJob.updated_at: utc_now()},
+                 synchronize_session=False) > 0
+        db.commit()
+        if not keep_shadow and owned:
+            # the live repository is untouched by a failed full load, only its shadow is discarded
+            drop_shadow_table(baselookup.lower())
+        raise
+    finally:
+        if job_heartbeat is not None:
+            job_heartbeat.stop()
+
+
+def requeue_interrupted_jobs(db):
+    """
+    Jobs still running when their process stopped are queued again, they continue from their last checkpoint.
+    A running job is only taken for interrupted once its updated_at heartbeat, refreshed by the JobHeartbeat of
+    the load, is stale: other worker processes may still be running it. Its owner is cleared, so that the
+    worker which had it stops at its next write if it was still running after all.
+    """
+    stale_before = utc_now() - datetime.timedelta(seconds=settings.EXTRACT_JOB_STALE_SECONDS)
+    interrupted = db.query(ExtractionJob).filter(
+        ExtractionJob.status == "running", ExtractionJob.updated_at < stale_before
+    ).update({
+        ExtractionJob.status: "queued",
+        ExtractionJob.owner: None,
+        ExtractionJob.updated_at: utc_now()
+    })
+    db.commit()
+    if interrupted:
+        log.info(f"+++++++ {interrupted} interrupted extraction jobs queued again +++++++")
@@ -0,0 +1,92 @@
+import json
+import logging
+import threading
+
+from sqlalchemy import text
+
+from database.database import engine
+from models.models import RepositoryStats, utc_now
+from serializers.repository_stats_serializer import repository_stats_entity
+
+
+log = logging.getLogger()
+
+# repository_stats rows as entities keyed by repository name, read from the database once
+_stats = {}
+_stats_loaded = False
+_stats_lock = threading.Lock()
+
+
+def record_repository_stats(baselookup: str, statistics: dict, dictionary_version: int, load_id, db) -> dict:
+    """
+    Saves the statistics of a base repository computed at the end of a load and caches them.
+    :param statistics: repository_statistics() of the loaded repository
+    """
+    with engine.connect() as connection:
+        byte_size = connection.execute(text("SELECT pg_total_relation_size(:table_name)"),
+                                       {"table_name": baselookup.lower()}).scalar()
+    stats = db.query(RepositoryStats).filter(RepositoryStats.usl_repository_name == baselookup).first()
+    if stats is None:
+        stats = RepositoryStats(usl_repository_name=baselookup)
+        db.add(stats)
+    now = utc_now()
+    stats.row_count = statistics["count"]
+    stats.invalid_count = statistics["invalid"]
+    stats.valid_count = statistics["count"] - statistics["invalid"] if statistics["invalid"] is not None else None
+    stats.byte_size = byte_size
+    stats.dictionary_version = dictionary_version
+    stats.last_load_id = load_id
+    stats.last_loaded_at = now
+    stats.statistics = json.dumps(statistics, default=str)
+    stats.updated_at = now
+    db.commit()
+
+    entity = repository_stats_entity(stats)
+    with _stats_lock:
+        _stats[baselookup] = entity
+    return entity
+
+
+def _load_stats(db):
+    global _stats_loaded
+    entities = {stats.usl_repository_name: repository_stats_entity(stats) for stats in db.query(RepositoryStats).all()}
+    with _stats_lock:
+        # entries recorded while reading are newer than what was read
+        _stats.update({name: entity for name, entity in entities.items() if name not in _stats})
+        _stats_loaded = True
+
+
+def get_repository_stats(baselookup: str, db) -> dict:
+    """
+    :return: statistics of the last load of a repository, or None if it has not been loaded since they were kept
+    """
+    if not _stats_loaded:
+        _load_stats(db)
+    with _stats_lock:
+        return _stats.get(baselookup)
+
+
+def list_repository_stats(db) -> list:
+    if not _stats_loaded:
+        _load_stats(db)
+    with _stats_lock:
+        return sorted(_stats.values(), key=lambda entity: entity["usl_repository_name"])
+
+
+def invalidate_repository_stats(baselookup: str = None):
+    """
+    Forgets the statistics of a repository whose table was recreated, they are kept again by its next load.
+    """
+    global _stats_loaded
+    with _stats_lock:
+        if baselookup is None:
+            _stats.clear()
+            _stats_loaded = False
+        else:
+            for name in [name for name in _stats if name.lower() == baselookup.lower()]:
+                del _stats[name]
+    if baselookup is not None:
+        with engine.connect() as connection:
+            connection.execute(text("DELETE FROM repository_stats WHERE lower(usl_repository_name) = lower(:name)"),
+                               {"name": baselookup})
+            connection.commit()
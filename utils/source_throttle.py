@@ -0,0 +1,135 @@
+import logging
+import threading
+import time
+from contextlib import contextmanager
+
+from settings import settings
+
+
+log = logging.getLogger()
+
+# the rate is cut by this factor whenever a batch takes longer than the target latency
+BACKOFF_FACTOR = 0.5
+# and raised by this factor for every batch within it, until the configured ceiling is reached
+RECOVERY_FACTOR = 1.1
+MIN_ROWS_PER_SECOND = 50
+# unused rate saved up while the source was idle, in seconds
+BURST_SECONDS = 1
+
+_throttles = {}
+_throttles_lock = threading.Lock()
+
+
+class SourceThrottle:
+    """
+    Limits the load extraction puts on one source system: how many extract queries run against it at once
+    and how many rows per second are read from it across all of them. The fetch latency of every batch is
+    watched, when the source slows down (the EMR is busy) the rate backs off and recovers gradually.
+    """
+
+    def __init__(self, source_key: str, max_rows_per_second: int = None, max_concurrent_queries: int = None,
+                 target_latency_ms: int = None):
+        self.source_key = source_key
+        self.max_rows_per_second = max_rows_per_second or None
+        self.max_concurrent_queries = max_concurrent_queries or settings.EXTRACT_MAX_CONCURRENT_PER_SOURCE
+        self.target_latency = (target_latency_ms or settings.EXTRACT_TARGET_LATENCY_MS) / 1000
+        self.queries = threading.BoundedSemaphore(self.max_concurrent_queries)
+        self.rate = self.max_rows_per_second
+        self.available_at = time.monotonic()
+        self.backoffs = 0
+        self.throttled_seconds = 0.0
+        self.last_latency = None
+        self.lock = threading.Lock()
+
+    def config(self) -> tuple:
+        return self.max_rows_per_second, self.max_concurrent_queries, int(self.target_latency * 1000)
+
+    @contextmanager
+    def query(self):
+        """
+        Holds one of the concurrent query slots of the source for as long as an extract query is open.
+        """
+        with self.queries:
+            yield
+
+    def _adapt(self, rows: int, latency: float):
+        self.last_latency = latency
+        source_rate = rows / latency if latency > 0 else None
+        if latency > self.target_latency:
+            current = self.rate or source_rate or MIN_ROWS_PER_SECOND
+            self.rate = max(MIN_ROWS_PER_SECOND, current * BACKOFF_FACTOR)
+            self.backoffs += 1
+            log.info(f"+++++++ source {self.source_key} slow ({latency:.2f}s per batch), "
+                     f"backing off to {self.rate:.0f} rows/sec +++++++")
+        elif self.rate is not None:
+            self.rate *= RECOVERY_FACTOR
+            if self.max_rows_per_second and self.rate >= self.max_rows_per_second:
+                self.rate = self.max_rows_per_second
+            elif not self.max_rows_per_second and source_rate and self.rate >= source_rate:
+                # no ceiling configured and the source keeps up again, stop limiting
+                self.rate = None
+
+    def throttle(self, rows: int, latency: float, adapt: bool = True):
+        """
+        Accounts for a batch read from the source and waits as long as the current rate requires.
+        :param rows: rows in the batch
+        :param latency: seconds the source took to return the batch
+        :param adapt: whether the latency says anything about the source load, the first batch of a query
+                      also includes running the query itself
+        """
+        with self.lock:
+            if adapt:
+                self._adapt(rows, latency)
+            if self.rate is None:
+                return
+            now = time.monotonic()
+            self.available_at = max(self.available_at, now - BURST_SECONDS) + rows / self.rate
+            delay = self.available_at - now
+            if delay > 0:
+                self.throttled_seconds += delay
+        if delay > 0:
+            time.sleep(delay)
+
+    def snapshot(self) -> dict:
+        return {
+            "source": self.source_key,
+            "max_rows_per_second": self.max_rows_per_second,
+            "max_concurrent_queries": self.max_concurrent_queries,
+            "target_latency_ms": int(self.target_latency * 1000),
+            "current_rows_per_second": round(self.rate) if self.rate else None,
+            "last_batch_latency_ms": int(self.last_latency * 1000) if self.last_latency is not None else None,
+            "backoffs": self.backoffs,
+            "throttled_seconds": round(self.throttled_seconds, 1)
+        }
+
+
+def get_throttle(source_system) -> SourceThrottle:
+    """
+    Returns the shared throttle of an AccessCredentials source, replaced when its limits are changed.
+    """
+    source_key = str(source_system.id)
+    throttle = SourceThrottle(source_key, source_system.max_rows_per_second, source_system.max_concurrent_queries,
+                              source_system.target_latency_ms)
+    with _throttles_lock:
+        current = _throttles.get(source_key)
+        if current is None or current.config() != throttle.config():
+            _throttles[source_key] = throttle
+        return _throttles[source_key]
+
+
+def throttled(batches, throttle: SourceThrottle):
+    """
+    Reads batches from a source query while holding a query slot, pacing them to the throttle's rate.
+    """
+    with throttle.query():
+        batches = iter(batches)
+        first = True
+        while True:
+            start = time.monotonic()
+            try:
+                batch = next(batches)
+            except StopIteration:
+                return
+            throttle.throttle(len(batch), time.monotonic() - start, adapt=not first)
+            first = False
+            yield batch
@@ -0,0 +1,43 @@
+import logging
+import threading
+
+from sqlalchemy import MetaData, Table
+from sqlalchemy.exc import NoSuchTableError
+
+from database.database import engine
+from models.models import DataDictionaries
+
+
+log = logging.getLogger()
+
+# reflected base repository tables keyed by (dictionary name, dictionary version)
+_tables = {}
+_tables_lock = threading.Lock()
+
+
+def get_repository_table(baselookup: str, db) -> Table:
+    """
+    Returns the reflected base repository table for the current version of its dictionary,
+    reflecting only that table and only the first time it is asked for.
+    :return: the table, or None if it has not been created yet
+    """
+    dictionary = db.query(DataDictionaries).filter(DataDictionaries.name == baselookup).first()
+    version = dictionary.version_number if dictionary else 0
+    key = (baselookup, version)
+
+    with _tables_lock:
+        table = _tables.get(key)
+    if table is None:
+        try:
+            table = Table(baselookup.lower(), MetaData(), autoload_with=engine)
+        except NoSuchTableError:
+            return None
+        with _tables_lock:
+            _tables[key] = table
+        log.info(f"+++++++ reflected {baselookup} v{version} +++++++")
+    return table
+
+
+def invalidate_repository_tables():
+    with _tables_lock:
+        _tables.clear()
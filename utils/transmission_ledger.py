@@ -0,0 +1,123 @@
+import logging
+import uuid
+
+from sqlalchemy import func, select, update
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+
+from database.database import engine
+from models.models import TransmissionBatch, TransmissionHistory, utc_now
+
+
+log = logging.getLogger()
+
+PENDING = "pending"
+ACKNOWLEDGED = "acknowledged"
+FAILED = "failed"
+# what a batch carries, repository rows or the ids of deleted rows
+ROWS = "rows"
+TOMBSTONES = "tombstones"
+
+# the ledger is written from the thread reading batches and from the event loop sending them,
+# so every call uses its own connection rather than the request session
+batches = TransmissionBatch.__table__
+
+
+def record_batch(manifest_id, usl_repository_name: str, batch_no: int, rows: int, after_key, last_key,
+                 payload_bytes: int, kind: str = ROWS, last_batch: bool = False):
+    """
+    Records a batch as pending once it is read and encoded, before it is posted, so that a batch which never
+    got an answer is known to a resume. Recording a batch of the manifest again counts another attempt.
+    """
+    now = utc_now()
+    values = {
+        "usl_repository_name": usl_repository_name,
+        "batch_size": rows,
+        "kind": kind,
+        "last_batch": last_batch,
+        "after_key": str(after_key) if after_key is not None else None,
+        "last_key": str(last_key) if last_key is not None else None,
+        "payload_bytes": payload_bytes,
+        "status": PENDING,
+        "updated_at": now
+    }
+    insert_stmt = pg_insert(batches).values(id=uuid.uuid4(), manifest_id=manifest_id, batch_no=batch_no,
+                                            created_at=now, attempts=1, **values)
+    with engine.connect() as connection:
+        connection.execute(insert_stmt.on_conflict_do_update(
+            index_elements=[batches.c.manifest_id, batches.c.batch_no],
+            set_={**values, "response_code": None, "error": None, "latency_ms": None,
+                  "attempts": batches.c.attempts + 1}
+        ))
+        connection.commit()
+
+
+def _update_batch(manifest_id, batch_no: int, **values):
+    with engine.connect() as connection:
+        connection.execute(update(batches)
+                           .where(batches.c.manifest_id == manifest_id, batches.c.batch_no == batch_no)
+                           .values(updated_at=utc_now(), **values))
+        connection.commit()
+
+
+def acknowledge_batch(manifest_id, batch_no: int, response_code: int, latency: float):
+    _update_batch(manifest_id, batch_no, status=ACKNOWLEDGED, response_code=response_code,
+                  latency_ms=int(latency * 1000), error=None)
+
+
+def fail_batch(manifest_id, batch_no: int, response_code: int = None, error: str = None):
+    _update_batch(manifest_id, batch_no, status=FAILED, response_code=response_code, error=error)
+
+
+def unacknowledged_batches(manifest_id) -> list:
+    with engine.connect() as connection:
+        return connection.execute(select(batches)
+                                  .where(batches.c.manifest_id == manifest_id, batches.c.status != ACKNOWLEDGED)
+                                  .order_by(batches.c.batch_no)).mappings().all()
+
+
+def ledger_summary(manifest_id) -> dict:
+    """
+    Batch counts of a manifest by status, and where reading stopped: the highest batch number recorded
+    and the last key it read and from what, after which a resume continues with batches that were never read.
+    """
+    with engine.connect() as connection:
+        counts = connection.execute(select(
+            func.count().filter(batches.c.status == ACKNOWLEDGED),
+            func.count().filter(batches.c.status == PENDING),
+            func.count().filter(batches.c.status == FAILED),
+            func.coalesce(func.sum(batches.c.batch_size).filter(batches.c.status == ACKNOWLEDGED), 0),
+            func.max(batches.c.batch_no),
+            func.count().filter(batches.c.last_batch == True)
+        ).where(batches.c.manifest_id == manifest_id)).one()
+        last = connection.execute(select(batches.c.last_key, batches.c.kind)
+                                  .where(batches.c.manifest_id == manifest_id, batches.c.last_key.isnot(None))
+                                  .order_by(batches.c.batch_no.desc()).limit(1)).first()
+    acknowledged, pending, failed, rows_acknowledged, last_batch_no, last_batch_read = counts
+    return {
+        "acknowledged": acknowledged,
+        "pending": pending,
+        "failed": failed,
+        "rows_acknowledged": rows_acknowledged,
+        "last_batch_no": last_batch_no,
+        "last_batch_read": last_batch_read > 0,
+        "last_key": last.last_key if last else None,
+        "last_kind": (last.kind or ROWS) if last else None
+    }
+
+
+def complete_manifest(manifest_id) -> bool:
+    """
+    Closes the Sent history of a manifest once all of its batches, up to the last one, are acknowledged.
+    :return: whether the manifest is complete
+    """
+    summary = ledger_summary(manifest_id)
+    if not summary["last_batch_read"] or summary["pending"] or summary["failed"]:
+        return False
+    history = TransmissionHistory.__table__
+    with engine.connect() as connection:
+        connection.execute(update(history)
+                           .where(history.c.manifest_id == manifest_id, history.c.action == "Sent",
+                                  history.c.ended_at.is_(None))
+                           .values(ended_at=utc_now()))
+        connection.commit()
+    return True
@@ -0,0 +1,140 @@
+import asyncio
+import logging
+import random
+import time
+
+import httpx
+
+from settings import settings
+from utils.batch_sizer import BatchSizer
+from utils.payload_formats import EncodedBatch
+
+
+log = logging.getLogger()
+
+# first retry waits about this long, every further retry twice as long up to the cap
+RETRY_BASE_SECONDS = 1
+RETRY_MAX_SECONDS = 60
+RETRY_STATUS_CODES = {408, 425, 429, 500, 502, 503, 504}
+
+
+class TransmissionError(Exception):
+    def __init__(self, batch_no: int, message: str, status_code: int = None):
+        super().__init__(f"Batch {batch_no} could not be sent: {message}")
+        self.batch_no = batch_no
+        self.status_code = status_code
+        # unreachable or overloaded rather than rejecting the batch, it can be sent again later
+        self.retryable = status_code is None or status_code in RETRY_STATUS_CODES
+
+
+def retry_delay(attempt: int) -> float:
+    # full jitter keeps facilities that lost their uplink at the same time from retrying in lockstep
+    return random.uniform(0, min(RETRY_MAX_SECONDS, RETRY_BASE_SECONDS * 2 ** attempt))
+
+
+async def next_batch(batches):
+    # batches are read from the database on a worker thread so the event loop stays free
+    return await asyncio.to_thread(next, batches, None)
+
+
+class BatchTransmitter:
+    """
+    Posts batches to the staging API over one pooled keep-alive client, with up to `concurrency` batches
+    in flight. Failed posts are retried with exponential backoff. Batches may complete out of order, but
+    on_sent is called in batch order, so bookkeeping only ever records a contiguous run of sent batches.
+    The round trip of every batch is reported to the sizer, if one is given, to size the batches still to read.
+    """
+
+    def __init__(self, url: str, concurrency: int = None, retries: int = None, timeout: float = None,
+                 sizer: BatchSizer = None):
+        self.url = url
+        self.sizer = sizer
+        self.concurrency = concurrency or settings.TRANSMIT_CONCURRENCY
+        self.retries = settings.TRANSMIT_RETRIES if retries is None else retries
+        self.timeout = timeout or settings.TRANSMIT_TIMEOUT_SECONDS
+
+    async def post(self, client: httpx.AsyncClient, batch_no: int, payload: EncodedBatch) -> httpx.Response:
+        attempt = 0
+        while True:
+            status_code = None
+            try:
+                start = time.monotonic()
+                response = await client.post(self.url, content=payload.body, headers=payload.headers)
+                if response.status_code < 400:
+                    payload.latency = time.monotonic() - start
+                    if self.sizer:
+                        self.sizer.observe(payload.rows, payload.size, payload.latency)
+                    return response
+                status_code = response.status_code
+                if status_code not in RETRY_STATUS_CODES:
+                    raise TransmissionError(batch_no, f"staging API answered {status_code}", status_code)
+                error = f"staging API answered {status_code}"
+            except httpx.TransportError as e:
+                error = f"{type(e).__name__}: {e}"
+            if attempt >= self.retries:
+                raise TransmissionError(batch_no, f"{error}, gave up after {attempt + 1} attempts", status_code)
+            delay = retry_delay(attempt)
+            log.info(f"+++++++ batch {batch_no} failed ({error}), retrying in {delay:.1f}s +++++++")
+            await asyncio.sleep(delay)
+            attempt += 1
+
+    async def send(self, batches, on_sent=None, on_failed=None) -> int:
+        """
+        Sends every batch of a transmission.
+        :param batches: iterator of (batch_no, EncodedBatch) in batch order, read lazily as slots free up
+        :param on_sent: async callable receiving (batch_no, payload, response) for each batch, in batch order
+        :param on_failed: async callable receiving (batch_no, payload, error) for a batch that could not be sent,
+                          the transmission stops after it
+        :return: number of batches sent
+        """
+        limits = httpx.Limits(max_connections=self.concurrency, max_keepalive_connections=self.concurrency)
+        slots = asyncio.Semaphore(self.concurrency)
+        # responses by position in the transmission, reported once every earlier batch is done
+        completed = {}
+        failures = []
+        in_flight = set()
+        reported = 0
+
+        async def report():
+            nonlocal reported
+            while reported in completed:
+                batch_no, payload, response = completed.pop(reported)
+                if on_sent:
+                    await on_sent(batch_no, payload, response)
+                reported += 1
+            if failures:
+                raise failures[0]
+
+        async with httpx.AsyncClient(limits=limits, timeout=self.timeout) as client:
+            async def send_one(position, batch_no, payload):
+                try:
+                    completed[position] = (batch_no, payload, await self.post(client, batch_no, payload))
+                except Exception as e:
+                    failures.append(e)
+                    if on_failed:
+                        await on_failed(batch_no, payload, e)
+                finally:
+                    slots.release()
+
+            try:
+                position = 0
+                while True:
+                    await slots.acquire()
+                    await report()
+                    item = await next_batch(batches)
+                    if item is None:
+                        slots.release()
+                        break
+                    batch_no, payload = item
+                    task = asyncio.create_task(send_one(position, batch_no, payload))
+                    in_flight.add(task)
+                    task.add_done_callback(in_flight.discard)
+                    position += 1
+
+                await asyncio.gather(*in_flight)
+                await report()
+            except BaseException:
+                for task in in_flight:
+                    task.cancel()
+                raise
+        return reported